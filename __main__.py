@@ -8,30 +8,86 @@
 
 import sys
 import argparse
-from dssat_wth import dssat_wth
-from update_wth import update_wth
+from functools import partial
+import metrics
 
 def main():
     parser = argparse.ArgumentParser()
     subparser = parser.add_subparsers(dest='command')
     getwth = subparser.add_parser('get')
     updatewth = subparser.add_parser('update')
+    statuswth = subparser.add_parser('status')
+    ingestprec = subparser.add_parser('ingest')
 
     getwth.add_argument('in_file', type=str, help='CSV file with the points required. It must contain ID, Latitude, Longitude, nasapid, LatNP, LonNP columns.')
     getwth.add_argument('startDate', type=int, help='Start date with format YYYYMMDD (e.g. 19841224)')
     getwth.add_argument('endDate', type=int, help='End date with format YYYYMMDD (e.g. 19841231)')
     getwth.add_argument('out_dir', type=str, help='Path of output directory for the new WTH files.')
+    getwth.add_argument('--subset-margin', type=float, default=None, help='Crop the CHIRPS files to the bounding box of the points plus this margin in degrees (e.g. 1).')
+    getwth.add_argument('--workers', type=int, default=None, help='Number of processes writing the WTH files (all CPUs by default).')
+    getwth.add_argument('--stream', action='store_true', help='Overlap the downloads, the CHIRPS extraction and the writing of the WTH files.')
+    getwth.add_argument('--tile', type=float, default=None, help='Run in shards of tiles of this size in degrees (e.g. 5), in a shards directory next to in_file.')
+    getwth.add_argument('--processes', type=int, default=1, help='Number of shards run at the same time with --tile.')
+    getwth.add_argument('--resume', action='store_true', help='Continue an interrupted run with the same arguments, skipping the steps already done.')
+    getwth.add_argument('--metrics', type=str, default=None, help='Prometheus textfile (.prom) to write the metrics of the run to at the end.')
+    getwth.add_argument('--archive', type=str, default=None, help='Precipitation archive made with ingest to take the CHIRPS series from (not with --stream).')
 
     updatewth.add_argument('in_file', type=str, help='CSV file with the points required. It must contain ID, Latitude, Longitude, nasapid, LatNP, LonNP columns.')
     updatewth.add_argument('in_dir', type=str, help='Path directory of current WTH files to update.')
     updatewth.add_argument('out_dir', type=str, help='Path of output directory for the new WTH files.')
+    updatewth.add_argument('--subset-margin', type=float, default=None, help='Crop the CHIRPS files to the bounding box of the points plus this margin in degrees (e.g. 1).')
+    updatewth.add_argument('--workers', type=int, default=None, help='Number of processes writing the WTH files (all CPUs by default).')
+    updatewth.add_argument('--tile', type=float, default=None, help='Run in shards of tiles of this size in degrees (e.g. 5), in a shards directory next to in_file.')
+    updatewth.add_argument('--processes', type=int, default=1, help='Number of shards run at the same time with --tile.')
+    updatewth.add_argument('--resume', action='store_true', help='Continue an interrupted run with the same arguments, skipping the steps already done.')
+    updatewth.add_argument('--metrics', type=str, default=None, help='Prometheus textfile (.prom) to write the metrics of the run to at the end.')
+
+    statuswth.add_argument('in_dir', type=str, help='Path directory of WTH files made by get or update.')
+    statuswth.add_argument('--before', type=int, default=None, help='List the files ending before this date, with format YYYYMMDD.')
+
+    ingestprec.add_argument('archive', type=str, help='Directory of the precipitation archive, created if it does not exist.')
+    ingestprec.add_argument('startDate', type=int, help='Start date with format YYYYMMDD (e.g. 19810101)')
+    ingestprec.add_argument('endDate', type=int, help='End date with format YYYYMMDD (e.g. 20211231)')
+    ingestprec.add_argument('--bbox', type=float, nargs=4, default=None, metavar=('MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'), help='Region of a new archive, on whole degrees.')
+    ingestprec.add_argument('--tile', type=float, default=1.0, help='Size of the tiles of a new archive in degrees.')
+    ingestprec.add_argument('--metrics', type=str, default=None, help='Prometheus textfile (.prom) to write the metrics of the run to at the end.')
 
     args = parser.parse_args()
+    if args.command == 'get' and args.archive is not None and args.stream:
+        parser.error('--archive cannot be used with --stream')
 
-    if args.command == 'get':
-        dssat_wth(args.in_file, args.startDate, args.endDate, args.out_dir)
-    elif args.command == 'update':
-        update_wth(args.in_file, args.in_dir, args.out_dir)
+    #The modules of every command (and GDAL, pandas and requests with them) are only imported
+    #once the arguments are parsed, so --help and argument errors do not wait for them.
+    try:
+        if args.command == 'get' and args.tile is not None:
+            from dssat_wth import dssat_wth
+            from shards import run_sharded
+            run_sharded(args.in_file, args.out_dir, args.tile, partial(dssat_wth, startDate=args.startDate, endDate=args.endDate,
+                        subset_margin=args.subset_margin, workers=args.workers, stream=args.stream, resume=args.resume,
+                        archive=args.archive), args.processes)
+        elif args.command == 'get':
+            from dssat_wth import dssat_wth
+            dssat_wth(args.in_file, args.startDate, args.endDate, args.out_dir, args.subset_margin, args.workers, args.stream,
+                      args.resume, args.archive)
+        elif args.command == 'update' and args.tile is not None:
+            from update_wth import update_wth
+            from shards import run_sharded
+            run_sharded(args.in_file, args.out_dir, args.tile, partial(update_wth, in_dir=args.in_dir,
+                        subset_margin=args.subset_margin, workers=args.workers, resume=args.resume), args.processes)
+        elif args.command == 'update':
+            from update_wth import update_wth
+            update_wth(args.in_file, args.in_dir, args.out_dir, args.subset_margin, args.workers, args.resume)
+        elif args.command == 'status':
+            from wthindex import status
+            status(args.in_dir, args.before)
+        elif args.command == 'ingest':
+            from precarchive import ingest
+            ingest(args.archive, args.startDate, args.endDate, args.bbox, args.tile)
+    finally:
+        #A run stopped by an error is logged as failed, and the metrics are written anyway.
+        metrics.finish('failed')
+        if getattr(args, 'metrics', None):
+            metrics.write_prom(args.metrics)
 
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import json
+import time
+import shutil
+import random
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import http.server
+import urllib.parse
+import multiprocessing
+import numpy
+import pandas as pd
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+
+#Offline benchmarks of the stages of get and update, with synthetic data. A local HTTP server
+#stands in for the CHIRPS and NASA POWER servers: it serves CHIRPS-like NetCDF files (with the
+#time#units and NETCDF_DIM_time_VALUES metadata GDAL reads from the real ones) and ICASA
+#records with a share of missing SRAD values. Every scenario (points x years x SRAD gaps) runs
+#each stage in its own process, so the peak memory is the one of the stage, and the wall time,
+#peak RSS and throughput of every stage are written as JSON.
+#python bench.py --points 100 1000 --years 1 2 --gaps 0 0.05 --out bench.json
+REGION = (-80.0, -5.0, -70.0, 5.0)  # Area of the synthetic points (min lon, min lat, max lon, max lat)
+RES = 0.05  # CHIRPS p05 grid
+POWER_RES = 0.5  # NASA POWER grid
+END = datetime(2021, 12, 31)  # Last day of every scenario; the period goes back `years` years.
+ORIGIN = datetime(1980, 1, 1)  # Origin of the CHIRPS time values.
+STAGES = ['chirps_download', 'chirps1', 'chirps2', 'precstore', 'power', 'nasachirps', 'mergeWTH']
+
+#####Synthetic data
+#Daily rainfall of the region for some days, the same for the same days in every run.
+def rain_grid(days):
+    rows = int(round((REGION[3] - REGION[1]) / RES))
+    cols = int(round((REGION[2] - REGION[0]) / RES))
+    grid = numpy.empty((len(days), rows, cols), dtype=numpy.float32)
+    for i, d in enumerate(days):
+        rnd = numpy.random.default_rng(d)
+        wet = rnd.random((rows, cols)) < 0.4
+        grid[i] = numpy.where(wet, rnd.gamma(0.8, 9.0, (rows, cols)), 0).round(2)
+    return grid
+
+#Writes a CHIRPS-like NetCDF file of the days (datetime) with GDAL.
+def make_nc(nc_file, dates):
+    from osgeo import gdal
+    days = [(d - ORIGIN).days for d in dates]
+    grid = rain_grid(days)
+    mem = gdal.GetDriverByName('MEM').Create('', grid.shape[2], grid.shape[1], len(days), gdal.GDT_Float32)
+    mem.SetGeoTransform((REGION[0], RES, 0.0, REGION[3], 0.0, -RES))
+    mem.SetMetadata({'time#units': 'days since 1980-1-1 0:0:0', 'NETCDF_DIM_EXTRA': '{time}',
+                     'NETCDF_DIM_time_DEF': '{' + str(len(days)) + ',6}',
+                     'NETCDF_DIM_time_VALUES': '{' + ','.join(str(d) for d in days) + '}'})
+    for i, d in enumerate(days):
+        band = mem.GetRasterBand(i + 1)
+        band.WriteArray(grid[i])
+        band.SetNoDataValue(-9999.0)
+        band.SetMetadata({'NETCDF_VARNAME': 'precip', 'NETCDF_DIM_time': str(d)})
+    if gdal.GetDriverByName('netCDF').CreateCopy(nc_file + '.tmp', mem) is None:
+        raise RuntimeError('Could not write ' + nc_file)
+    mem = None
+    os.replace(nc_file + '.tmp', nc_file)
+
+#Days of the CHIRPS file of a request: 'chirps-v2.0.YYYY.MM.days_p05.nc' (corrected month) or
+#'chirps-v2.0.YYYY.days_p05.nc' (preliminary year, up to END). None for other names.
+def nc_dates(name):
+    part = name.split('.')
+    if len(part) == 5 and part[0] == 'chirps-v2' and part[3] == 'days_p05':
+        first = datetime(int(part[2]), 1, 1)
+        last = datetime(int(part[2]), 12, 31)
+    elif len(part) == 6 and part[0] == 'chirps-v2' and part[4] == 'days_p05':
+        first = datetime(int(part[2]), int(part[3]), 1)
+        last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        return None
+    last = min(last, END)
+    return [first + timedelta(days=n) for n in range((last - first).days + 1)] if first <= last else None
+
+#ICASA text of a NASA POWER cell for startDate to endDate, with a share `gaps` of missing SRAD.
+def icasa(lat, lon, startDate, endDate, gaps):
+    rnd = random.Random(str((lat, lon)))
+    elev = round(rnd.uniform(0, 2500), 1)
+    lines = ['-BEGIN HEADER-', 'NASA/POWER CERES/MERRA2 Native Resolution Daily Data',
+             'Dates (month/day/year): ' + startDate + ' through ' + endDate,
+             'Location: Latitude  ' + str(lat) + '   Longitude ' + str(lon), 'Elevation from MERRA-2: ' + str(elev),
+             'Value for missing model data cannot be computed or out of model availability range: -99',
+             'Parameter(s):', 'ALLSKY_SFC_SW_DWN  MERRA-2 All Sky Surface Shortwave Downward Irradiance (MJ/m^2/day)',
+             '-END HEADER-', '$WEATHER DATA : NASA POWER', '',
+             '@ INSI   WTHLAT  WTHLONG  WELEV   TAV   AMP  REFHT  WNDHT',
+             '{:>6} {:>8} {:>8} {:>6} {:>5} {:>5} {:>6} {:>6}'.format('NASA', lat, lon, elev, 24.1, 2.8, 2, 10), '',
+             '@  DATE   T2M  TMIN  TMAX  TDEW  RH2M  PREC  WIND  SRAD']
+    dt = datetime.strptime(startDate, '%Y%m%d')
+    dt_e = datetime.strptime(endDate, '%Y%m%d')
+    while dt <= dt_e:
+        day = random.Random(str((lat, lon, dt.toordinal())))  # The same values whatever the request period
+        t2m = day.uniform(18, 30)
+        srad = '-99' if day.random() < gaps else '{:.1f}'.format(day.uniform(5, 28))
+        lines.append('{:>7} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:>5}'.format(
+            dt.strftime('%Y%j'), t2m, t2m - 5, t2m + 6, t2m - 4, day.uniform(60, 95), day.expovariate(0.3),
+            day.uniform(0.5, 5), srad))
+        dt += timedelta(days=1)
+    return '\n'.join(lines) + '\n'
+
+#Input CSV file of n random points of the region.
+def make_points(in_file, n, seed=0):
+    rnd = numpy.random.default_rng(seed)
+    lat = rnd.uniform(REGION[1], REGION[3], n).round(5)
+    lon = rnd.uniform(REGION[0], REGION[2], n).round(5)
+    lat_np = (numpy.floor(lat / POWER_RES) * POWER_RES + POWER_RES / 2).round(4)
+    lon_np = (numpy.floor(lon / POWER_RES) * POWER_RES + POWER_RES / 2).round(4)
+    nasapid = ((lat_np + 90) / POWER_RES).astype(int) * 1000 + ((lon_np + 180) / POWER_RES).astype(int)
+    pd.DataFrame({'ID': numpy.arange(1, n + 1), 'Latitude': lat, 'Longitude': lon, 'nasapid': nasapid,
+                  'LatNP': lat_np, 'LonNP': lon_np}).to_csv(in_file, index=False)
+
+#####Local server
+#Serves the CHIRPS files from the fixtures directory (made on the first request) and the
+#NASA POWER ICASA records. Requests and bytes sent are counted in stats.
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixtures, gaps):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.fixtures = fixtures
+        self.gaps = gaps
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0}
+
+    def nc_file(self, name):
+        nc_file = self.fixtures + '/' + name
+        with self.lock:
+            if not os.path.exists(nc_file):
+                make_nc(nc_file, nc_dates(name))
+        return nc_file
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['bytes'] += len(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.startswith('/power'):
+            q = dict(urllib.parse.parse_qsl(url.query))
+            self.send(icasa(float(q['latitude']), float(q['longitude']), q['start'], q['end'],
+                            self.server.gaps).encode())
+            return
+
+        name = os.path.basename(url.path)
+        if not url.path.startswith('/chirps/') or nc_dates(name) is None:
+            self.send_error(404)
+            return
+        nc_file = self.server.nc_file(name)
+        modified = int(os.path.getmtime(nc_file))
+        since = self.headers.get('If-Modified-Since')
+        if since is not None and parsedate_to_datetime(since).timestamp() >= modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(nc_file, 'rb') as f:
+            self.send(f.read(), [('Last-Modified', formatdate(modified, usegmt=True))])
+
+def start_server(fixtures, gaps):
+    server = Server(fixtures, gaps)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#####Stages
+#Runs one stage in this (child) process and sends back its time, peak RSS and work done.
+def stage_main(conn, name, sc):
+    from chirps import get_correc_nc, chirps1, chirps2
+    from precstore import read_prec
+    from getnasap import get_data, nasachirps
+    from update_wth import mergeWTH
+
+    dt_s = datetime.strptime(sc['startDate'], '%Y%m%d')
+    dt_e = datetime.strptime(sc['endDate'], '%Y%m%d')
+    point_days = sc['points'] * sc['days']
+    t0 = time.perf_counter()
+    if name == 'chirps_download':
+        failed = get_correc_nc(dt_s, dt_e, sc['work'] + '/nc')
+        size = sum(os.path.getsize(sc['work'] + '/nc/' + f) for f in os.listdir(sc['work'] + '/nc'))
+        work = (size / 2**20, 'MB/s', {'failed': len(failed)})
+    elif name == 'chirps1':
+        chirps1(sc['in_file'], sc['work'] + '/nc', sc['work'] + '/prec1')
+        work = (point_days, 'point-days/s', {})
+    elif name == 'chirps2':
+        chirps2(sc['in_file'], sc['work'] + '/nc', sc['work'] + '/prec2')
+        work = (point_days, 'point-days/s', {})
+    elif name == 'precstore':
+        #The series of all the points as a table, as the old prec pickles (precpkl) were read.
+        prec = read_prec(sc['work'] + '/prec1')
+        work = (prec.size, 'point-days/s', {})
+    elif name == 'power':
+        #No rate limit, to time the client and the store rather than the limiter.
+        failed = get_data(sc['in_file'], sc['startDate'], sc['endDate'], sc['work'] + '/nasap', rate=1e6)
+        work = (sc['cells'], 'cells/s', {'failed': len(failed)})
+    elif name == 'nasachirps':
+        nasachirps(sc['in_file'], sc['work'] + '/nasap', sc['work'] + '/prec1', sc['work'] + '/wth', sc['workers'])
+        rows = sum(len(open(sc['work'] + '/wth/' + f).readlines()) - 6 for f in os.listdir(sc['work'] + '/wth'))
+        work = (rows, 'rows/s', {'files': len(os.listdir(sc['work'] + '/wth'))})
+    elif name == 'mergeWTH':
+        mergeWTH(sc['work'] + '/hist', sc['work'] + '/wth', sc['work'] + '/merged')
+        work = (len(os.listdir(sc['work'] + '/merged')), 'files/s', {})
+    seconds = time.perf_counter() - t0
+
+    #ru_maxrss is in KB on Linux (bytes on macOS); the worker processes count as well.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result = {'seconds': round(seconds, 3), 'peak_rss_mb': round(rss * scale / 2**20, 1),
+              'throughput': round(work[0] / max(seconds, 1e-9), 1), 'unit': work[1]}
+    result.update(work[2])
+    conn.send(result)
+
+def run_stage(name, sc):
+    ctx = multiprocessing.get_context('spawn')  # A fresh interpreter, so memory is the stage's only.
+    recv, send = ctx.Pipe(False)
+    p = ctx.Process(target=stage_child, args=(send, name, sc, sc['work'] + '/' + name + '.log'))
+    p.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if result is None:
+        result = {'error': 'exit code ' + str(p.exitcode) + ', see ' + sc['work'] + '/' + name + '.log'}
+    return result
+
+#The output of the stage goes to its log file instead of the screen.
+def stage_child(conn, name, sc, log_file):
+    log = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    sys.stdout = os.fdopen(1, 'w', buffering=1)
+    sys.stderr = os.fdopen(2, 'w', buffering=1)
+    stage_main(conn, name, sc)
+
+#Historical files for mergeWTH: the WTH files of nasachirps without their last `days` rows.
+#Files left with no rows (cut short by the SRAD quality control) are not in it.
+def make_hist(wth_dir, hist_dir, days=30):
+    os.makedirs(hist_dir, exist_ok=True)
+    for wth_file in os.listdir(wth_dir):
+        with open(wth_dir + '/' + wth_file, 'r') as f:
+            lines = f.readlines()
+        if len(lines) - days > 6:
+            with open(hist_dir + '/' + wth_file, 'w') as f:
+                f.writelines(lines[:-days])
+
+#Runs all the stages of a scenario in work (a new directory) against the local server.
+def run_scenario(points, years, gaps, work, fixtures, workers=None):
+    os.makedirs(work)
+    server = start_server(fixtures, gaps)
+    url = 'http://127.0.0.1:' + str(server.server_port)
+    #The stage processes read these when they import the modules: empty cache and store.
+    os.environ['NASAPCHIRPS_CHIRPS_URL'] = url + '/chirps'
+    os.environ['NASAPCHIRPS_POWER_URL'] = url + '/power'
+    os.environ['NASAPCHIRPS_CACHE'] = work + '/cache'
+    os.environ['NASAPCHIRPS_POWER_STORE'] = work + '/cache/power.sqlite'
+
+    dt_s = datetime(END.year - years + 1, 1, 1)
+    sc = {'points': points, 'years': years, 'srad_gaps': gaps, 'startDate': dt_s.strftime('%Y%m%d'),
+          'endDate': END.strftime('%Y%m%d'), 'days': (END - dt_s).days + 1, 'work': work,
+          'in_file': work + '/pts.csv', 'workers': workers}
+    make_points(sc['in_file'], points)
+    sc['cells'] = int(pd.read_csv(sc['in_file'])['nasapid'].nunique())
+
+    #The CHIRPS files are made before timing the download.
+    t0 = time.perf_counter()
+    for m in range(years * 12):
+        month = datetime(dt_s.year + m // 12, m % 12 + 1, 1)
+        server.nc_file('chirps-v2.0.' + month.strftime('%Y.%m') + '.days_p05.nc')
+    print('Fixtures ready in', round(time.perf_counter() - t0, 1), 's.')
+
+    stages = {}
+    for name in STAGES:
+        if name == 'mergeWTH':
+            make_hist(work + '/wth', work + '/hist')
+        sent = dict(server.stats)
+        stages[name] = run_stage(name, sc)
+        stages[name]['requests'] = server.stats['requests'] - sent['requests']
+        stages[name]['bytes_sent'] = server.stats['bytes'] - sent['bytes']
+        print('  ', name.ljust(16), ', '.join(k + ': ' + str(v) for k, v in stages[name].items()))
+    server.shutdown()
+    server.server_close()
+    return {'points': points, 'years': years, 'srad_gaps': gaps, 'cells': sc['cells'], 'days': sc['days'],
+            'stages': stages}
+
+#Commit of the code measured, None outside a git repository.
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the stages with synthetic data.')
+    parser.add_argument('--points', type=int, nargs='+', default=[100, 1000], help='Numbers of points.')
+    parser.add_argument('--years', type=int, nargs='+', default=[1], help='Numbers of years, ending on ' + END.strftime('%Y-%m-%d') + '.')
+    parser.add_argument('--gaps', type=float, nargs='+', default=[0.0, 0.05], help='Shares of missing SRAD values.')
+    parser.add_argument('--workers', type=int, default=None, help='Processes writing the WTH files (all CPUs by default).')
+    parser.add_argument('--work', type=str, default=None, help='Directory for the runs, kept at the end (a temporary one by default).')
+    parser.add_argument('--out', type=str, default='bench.json', help='JSON file with the results.')
+    args = parser.parse_args()
+
+    work = args.work or tempfile.mkdtemp(prefix='nasapchirps_bench_')
+    os.makedirs(work + '/fixtures', exist_ok=True)
+    results = {'started': datetime.now().isoformat(), 'host': socket.gethostname(), 'cpus': os.cpu_count(),
+               'python': sys.version.split()[0], 'commit': git_commit(), 'scenarios': []}
+    try:
+        for years in args.years:
+            for points in args.points:
+                for gaps in args.gaps:
+                    print('Scenario:', points, 'points,', years, 'year(s),', gaps, 'SRAD gaps')
+                    name = 'p{}_y{}_g{}'.format(points, years, gaps)
+                    results['scenarios'].append(run_scenario(points, years, gaps, work + '/' + name,
+                                                             work + '/fixtures', args.workers))
+                    with open(args.out, 'w') as f:  # Written after every scenario, in case of a stop.
+                        json.dump(results, f, indent=1)
+    finally:
+        if args.work is None:
+            shutil.rmtree(work)
+    print('Results written to', args.out)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import json
+import shutil
+from datetime import datetime
+
+#Checkpoints of a run (temp/state.json): the arguments of the run, when it started and the
+#steps already done. With resume, a run with the same arguments keeps the temp directory
+#and skips the steps done; otherwise the temp directory is emptied as before.
+
+def save_state(state):
+    with open(state['file'] + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state['file'] + '.tmp', state['file'])
+
+def start_run(tempdir, params, resume=False):
+    state_file = tempdir + '/state.json'
+    if resume and os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        if state['params'] == params:
+            print('Resuming the run started on', state['started'], '| steps done:',
+                  ', '.join(sorted(state['done'])) or 'none')
+            state['file'] = state_file
+            state['resumed'] = True
+            return state
+        print('The previous run had other arguments, starting again.')
+    elif resume:
+        print('No previous run to resume, starting again.')
+
+    if os.path.exists(tempdir):
+        shutil.rmtree(tempdir)
+    os.mkdir(tempdir)
+    state = {'params': params, 'started': datetime.now().isoformat(), 'done': {}, 'file': state_file,
+             'resumed': False}
+    save_state(state)
+    return state
+
+def is_done(state, step):
+    return step in state['done']
+
+#Marks a step as done, with an optional value to get back on resume.
+def mark_done(state, step, value=True):
+    state['done'][step] = value
+    save_state(state)
+
+#Items (e.g. files) done in a step made of many of them.
+def done_items(state, step):
+    return set(state['done'].get(step, []))
+
+def add_done(state, step, item):
+    state['done'].setdefault(step, []).append(item)
+    save_state(state)
+
+#Start of the run when resuming (outputs written after it are complete), None otherwise.
+def resumed_since(state):
+    return datetime.fromisoformat(state['started']) if state['resumed'] else None
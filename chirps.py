@@ -7,219 +7,391 @@
 #######################################
 
 import os, sys
-from osgeo import ogr, gdal
-from osgeo.gdalconst import *
+import math
 import numpy
 import pandas as pd
 from datetime import datetime, timedelta
-import joblib
+import precstore
+import metrics
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dateutil.relativedelta import relativedelta
-
-# register all of the GDAL drivers
-gdal.AllRegister()
+from nccache import cache_get
+
+#GDAL is loaded when the first NetCDF file is opened or cropped, so the commands and stages
+#that do not read CHIRPS files do not wait for it.
+gdal = None
+def load_gdal():
+    global gdal
+    if gdal is None:
+        from osgeo import gdal as osgeo_gdal
+        osgeo_gdal.AllRegister()  # register all of the GDAL drivers
+        gdal = osgeo_gdal
+    return gdal
 
 #####Download CHIRPS data
-#Corrected data
-def get_correc_nc(dt_s, dt_e, out_cor_nc):
-    s = requests.Session()
-    s.mount("https://data.chc.ucsb.edu", requests.adapters.HTTPAdapter(max_retries=10))
+#Files go through the persistent cache (nccache.py), so a month or year already downloaded
+#by a previous run is not fetched again. Downloads run in a pool of worker threads, each
+#one with its own session. The server can be changed with the NASAPCHIRPS_CHIRPS_URL
+#environment variable (a mirror, or the local server of bench.py).
+NC_WORKERS = 4
+CHIRPS_URL = os.environ.get('NASAPCHIRPS_CHIRPS_URL', 'https://data.chc.ucsb.edu/products/CHIRPS-2.0')
+local = threading.local()
+
+def chirps_session():
+    if not hasattr(local, 's'):
+        local.s = requests.Session()
+        local.s.mount(CHIRPS_URL, requests.adapters.HTTPAdapter(max_retries=10))
+    return local.s
+
+#Bounding box (min lon, min lat, max lon, max lat) of the points in the input CSV file plus
+#a margin in degrees, rounded outwards to whole degrees so close requests share the cache.
+def pt_bbox(in_file, margin):
+    id, lat, lon = read_points(in_file)
+    return (max(-180, math.floor(lon.min() - margin)), max(-50, math.floor(lat.min() - margin)),
+            min(180, math.ceil(lon.max() + margin)), min(50, math.ceil(lat.max() + margin)))
+
+#Crops a downloaded NetCDF file to bbox. The time dimension and its metadata are kept, so
+#the extraction functions read the subset as they read the global file.
+def subset_nc(bbox):
+    def crop(src, dst):
+        ds = load_gdal().Translate(dst, src, format='netCDF', projWin=[bbox[0], bbox[3], bbox[2], bbox[1]],
+                            creationOptions=['FORMAT=NC4C', 'COMPRESS=DEFLATE'])
+        if ds is None:
+            raise RuntimeError('Could not crop ' + src)
+        ds = None  # Close the file
+    return crop
+
+#Downloads a list of (name, url, cache key, output file, revalidate) jobs concurrently.
+#With bbox only the crop of every file to it is stored in the cache. done(job, ok) is called
+#as every job ends, to start using the files while the rest are downloading.
+#Returns the failed jobs as (name, reason); a file not published yet gives a 404.
+def download_nc(jobs, workers=NC_WORKERS, bbox=None, done=None):
+    transform = None
+    suffix = ''
+    if bbox is not None:
+        transform = subset_nc(bbox)
+        suffix = '@' + '_'.join(str(int(c)) for c in bbox)
+
+    def fetch(job):
+        name, url, key, out_file, revalidate = job
+        if cache_get(chirps_session(), url, key + suffix, out_file, revalidate, transform=transform):
+            metrics.count('chirps_files', result='downloaded')
+            print(name + " file downloaded.")
+        else:
+            metrics.count('chirps_files', result='cached')
+            print(name + " file taken from cache.")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch, job): job for job in jobs}
+        for future in as_completed(futures):
+            n_failed = len(failed)
+            try:
+                future.result()
+            except requests.exceptions.HTTPError as err:
+                failed.append((futures[future][0], 'HTTP ' + str(err.response.status_code)))
+            except (requests.exceptions.RequestException, RuntimeError) as err:
+                failed.append((futures[future][0], type(err).__name__))
+            if len(failed) > n_failed:
+                metrics.count('chirps_files', result='failed')
+            if done is not None:
+                done(futures[future], len(failed) == n_failed)
+
+    if failed:
+        failed.sort()
+        print(len(failed), 'of', len(jobs), 'CHIRPS file(s) not downloaded:')
+        for name, reason in failed:
+            print('   ', name, reason)
+    return failed
+
+#Failed jobs that leave a hole in the CHIRPS series: every failure other than a 404, and a 404
+#before the last file downloaded. A 404 after it is a file not published yet, whose days are
+#taken from the preliminary data or left for the next run.
+def download_holes(jobs, failed):
+    reasons = dict(failed)
+    got = [job[0] for job in jobs if job[0] not in reasons]
+    last = max(got) if got else None
+    return sorted((name, reason) for name, reason in failed
+                  if reason != 'HTTP 404' or (last is not None and name < last))
+
+#Stops the run when the failed jobs leave a hole in the series, as its days would be NODATA.
+def check_download(jobs, failed):
+    holes = download_holes(jobs, failed)
+    if holes:
+        print('Program terminated. CHIRPS file(s) missing before the last one published:',
+              ', '.join(name + ' (' + reason + ')' for name, reason in holes))
+        sys.exit(1)
+
+#Downloads the jobs whose name is not in skip (downloaded by a previous run) and stops the run
+#on a hole in the series. done(name) is called for every file downloaded.
+def get_nc(jobs, bbox=None, skip=(), done=None):
+    def landed(job, ok):
+        if ok and done is not None:
+            done(job[0])
+    check_download(jobs, download_nc([job for job in jobs if job[0] not in skip], bbox=bbox, done=landed))
 
+#Corrected data
+def correc_jobs(dt_s, dt_e, out_cor_nc):
+    jobs = []
     diff_month = (dt_e.year - dt_s.year) * 12 + (dt_e.month - dt_s.month)
     for n in range(diff_month+1):
         yymm = dt_s + relativedelta(months=+n)
         yy = yymm.strftime("%Y")
         mm = yymm.strftime("%m")
 
-        try:
-            #Monthly basis
-            response = s.get('https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/netcdf/p05/by_month/chirps-v2.0.'
-                + yy + '.' + mm + '.days_p05.nc', timeout=80)
-            #Yearly basis
-    #        response = s.get('https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/netcdf/p05/chirps-v2.0.'
-    #                         + dt_st_y + '.days_p05.nc', timeout=80)
-            response.raise_for_status()
-
-            if response.ok:
-                # Create target Directory if it doesn't exist.
-                if not os.path.exists(out_cor_nc):
-                    os.mkdir(out_cor_nc)
-                open(out_cor_nc + '/corr_chirps_' + yy + mm + '.nc', 'wb').write(response.content)
-                print('corr_chirps_' + yy + mm + ".nc file downloaded.")
-    #            open(out_cor_nc + '/corr_chirps_' + dt_st_y + '.nc', 'wb').write(response.content)
-    #            print('corr_chirps_' + dt_st_y + ".nc file downloaded.")
-
-        except requests.exceptions.HTTPError as err:
-            pass
-#            raise SystemExit(err)
-
-        response.close() #Close the connection with the server.
+        #Monthly basis. Corrected months never change, so the cached copy is used as it is.
+        url = (CHIRPS_URL + '/global_daily/netcdf/p05/by_month/chirps-v2.0.'
+               + yy + '.' + mm + '.days_p05.nc')
+        jobs.append(('corr_chirps_' + yy + mm + '.nc', url, 'corrected/' + yy + '.' + mm,
+                     out_cor_nc + '/corr_chirps_' + yy + mm + '.nc', False))
+    return jobs
 
-#Preliminary data
-def get_prelim_nc(dt_s, dt_e, out_pre_nc):
-    s = requests.Session()
-    s.mount("https://data.chc.ucsb.edu", requests.adapters.HTTPAdapter(max_retries=10))
+def get_correc_nc(dt_s, dt_e, out_cor_nc, workers=NC_WORKERS, bbox=None, done=None):
+    return download_nc(correc_jobs(dt_s, dt_e, out_cor_nc), workers, bbox, done)
 
+#Preliminary data
+def prelim_jobs(dt_s, dt_e, out_pre_nc):
+    jobs = []
     for y in range(dt_e.year - dt_s.year + 1):
         single_y = str(dt_s.year + y)
 
-        try:
-            response = s.get('https://data.chc.ucsb.edu/products/CHIRPS-2.0/prelim/global_daily/fixed/netcdf/chirps-v2.0.'
-                             + single_y + '.days_p05.nc', timeout=80)
-            response.raise_for_status()
-
-            if response.ok:
-                # Create target Directory if it doesn't exist.
-                if not os.path.exists(out_pre_nc):
-                    os.mkdir(out_pre_nc)
-                open(out_pre_nc  + '/prelim_nc_' + single_y + '.nc', 'wb').write(response.content)
-                print('prelim_nc_' + single_y + ".nc file downloaded.")
-        except requests.exceptions.HTTPError as err:
-            pass
-    #        raise SystemExit(err)
-        response.close()  # Close the connection with the server.
-
-#To read corrected and preliminary data and then merge them properly.
-def precpkl(outdir_prec):
-    df1 = joblib.load(outdir_prec + '/prec_corr.pkl')
-    df2 = joblib.load(outdir_prec + '/prec_prelim.pkl')
-    last_dt_corr = df1.columns[-1]
-    dt_s_pre = datetime.strptime(last_dt_corr, '%Y%j') + timedelta(days=1)
-    dt_st_p = dt_s_pre.strftime('%Y%j')
-    df3 = df2.loc[:, dt_st_p:]
-    result = pd.concat([df1, df3], axis=1)
-    joblib.dump(result, outdir_prec + '/prec.pkl')
-
-#Intended for long time series but few points (<10000)
-def chirps1(in_file, in_nc_dir, outprec_file):
-    nc_lst = os.listdir(in_nc_dir)  # To list all .sol files in the input folder.
-    nc_lst.sort()  # Sort the files in a sequential date
-    df_chirps = pd.DataFrame()
-
-    # To read the input CSV file
-    with open(in_file, "r") as f1:
-        in_pt = [line for line in f1.readlines() if line.strip()]
-
-        for row in in_pt[1:]:
-            id = int(row.split(',')[0])
-            lat = float(row.split(',')[1])
-            lon = float(row.split(',')[2])
-            time_lst = []
-            precval = []
-
-            for nc_file in nc_lst:
-                if nc_file.endswith(".nc"):
-                    # open the image file
-                    dsi = gdal.Open(in_nc_dir + "/" + nc_file, GA_ReadOnly)
-
-                    if dsi is None:
-                        print('Could not open NetCDF file')
-                        sys.exit(1)
-
-                    meta_nc = dsi.GetMetadata()  # To get metadata of the file
-                    date_start = meta_nc['time#units'][
-                                 -14:]  # The origin date of the file (For CHIRPS '1980-1-1 0:0:0')
-                    datetime_st = datetime.strptime(date_start, '%Y-%m-%d %H:%M:%S')
-                    bands_time = meta_nc['NETCDF_DIM_time_VALUES'][1:-1].split(
-                        ',')  # Get the band timestamp point of the file. "[1:-1]" removes the first and last character
-                    bands_time = list(map(int, bands_time))  # Convert all strings in a list of integers.
-
-                    # Geotransformation
-                    gt = dsi.GetGeoTransform()
-                    px = int((lon - gt[0]) / gt[1])
-                    py = int((lat - gt[3]) / gt[5])
-
-                    # get image size
-                    #rowsY = dsi.RasterYSize
-                    #colsX = dsi.RasterXSize
-                    bands = dsi.RasterCount
-
-                    for i in range(1, bands + 1):
-                        d = dsi.GetRasterBand(i).ReadAsArray(px, py, 1, 1)
-                        dt_st = datetime_st + timedelta(days=bands_time[i - 1])  # Get the band timestamp in date format
-                        band_t = dt_st.strftime('%Y%j')  #strftime() to reformat the date to DSSAT format.
-                        time_lst.append(band_t)
-
-                        if d is None:
-                            d = numpy.float32([[-9999.0]])
-
-                        precval.append(d[0][0])
-
-            df_chirps[id] = precval
-
-    df_chirps = df_chirps.T  # Array transpose
-    df_chirps.index.name = 'ID'  # Set an index name
-    df_chirps.columns = time_lst  # Set column names as actual dates.
-
-    if not os.path.exists(os.path.dirname(outprec_file)):
-        os.mkdir(os.path.dirname(outprec_file))
-    joblib.dump(df_chirps, outprec_file)
-
-#Intended for short time series (< 2 years) but many points. It requires more RAM memory available.
-def chirps2(in_file, in_nc_dir, outprec_file):
-
-    nc_lst = os.listdir(in_nc_dir) #To list all .sol files in the input folder.
-    nc_lst.sort() #Sort the files in a sequential date
-    data = {}
-    time_lst = []
-    start2 = datetime.now()
+        #Yearly files grow with new days, so the cached copy is revalidated with the server.
+        url = (CHIRPS_URL + '/prelim/global_daily/fixed/netcdf/chirps-v2.0.'
+               + single_y + '.days_p05.nc')
+        jobs.append(('prelim_nc_' + single_y + '.nc', url, 'prelim/' + single_y,
+                     out_pre_nc + '/prelim_nc_' + single_y + '.nc', True))
+    return jobs
+
+def get_prelim_nc(dt_s, dt_e, out_pre_nc, workers=NC_WORKERS, bbox=None, done=None):
+    return download_nc(prelim_jobs(dt_s, dt_e, out_pre_nc), workers, bbox, done)
+
+#Reads the band timestamps of a CHIRPS NetCDF file as dates in DSSAT format ('%Y%j').
+def nc_times(dsi):
+    meta_nc = dsi.GetMetadata()  # To get metadata of the file
+    date_start = meta_nc['time#units'][-14:]  # The origin date of the file (For CHIRPS '1980-1-1 0:0:0')
+    datetime_st = datetime.strptime(date_start, '%Y-%m-%d %H:%M:%S')
+    bands_time = meta_nc['NETCDF_DIM_time_VALUES'][1:-1].split(',')  # "[1:-1]" removes the first and last character
+    bands_time = list(map(int, bands_time))  # Convert all strings in a list of integers.
+    return [(datetime_st + timedelta(days=t)).strftime('%Y%j') for t in bands_time]
+
+#Reads ID, Latitude and Longitude of the points in the input CSV file.
+def read_points(in_file):
+    pt = pd.read_csv(in_file)
+    id = pt['ID'].to_numpy()
+    lat = pt['Latitude'].to_numpy()
+    lon = pt['Longitude'].to_numpy()
+    return id, lat, lon
+
+#Pixel offsets of the points from the geotransformation of the file. The pixels are found on
+#the global CHIRPS grid and shifted by the offset of the origin of the file, so a crop of the
+#file (--subset-margin, precipitation archive) gives the pixels of the global file, also for
+#points on the edge of a pixel. A small epsilon keeps those on the pixel they start.
+CHIRPS_ORIGIN = (-180.0, 50.0)  # Top left corner of the global CHIRPS grid (lon, lat).
+def pt_offsets(gt, lat, lon):
+    x0 = int(round((gt[0] - CHIRPS_ORIGIN[0]) / gt[1]))
+    y0 = int(round((gt[3] - CHIRPS_ORIGIN[1]) / gt[5]))
+    px = numpy.floor((lon - CHIRPS_ORIGIN[0]) / gt[1] + 1e-6).astype(int) - x0
+    py = numpy.floor((lat - CHIRPS_ORIGIN[1]) / gt[5] + 1e-6).astype(int) - y0
+    return px, py
+
+#Groups the sorted raster rows holding points into blocks (first row, last row + 1).
+#Rows closer than max_gap are read together, and a block never exceeds max_rows.
+def row_blocks(rows, max_gap, max_rows):
+    blocks = []
+    start = prev = rows[0]
+    for r in rows[1:]:
+        if r - prev > max_gap or r - start >= max_rows:
+            blocks.append((start, prev + 1))
+            start = r
+        prev = r
+    blocks.append((start, prev + 1))
+    return blocks
+
+#Reads the precipitation of all points for every band of an open NetCDF file.
+#Only the window covering the points of each row block is read, and the points are then
+#sampled with NumPy fancy indexing. Points outside the raster get -9999.0.
+#max_mem (bytes) caps the size of a single window read.
+def sample_bands(dsi, px, py, max_gap=8, max_rows=256, max_mem=None):
+    bands = dsi.RasterCount
+    prec = numpy.full((bands, len(px)), -9999.0, dtype=numpy.float32)
+    inside = (px >= 0) & (px < dsi.RasterXSize) & (py >= 0) & (py < dsi.RasterYSize)
+    if not inside.any():
+        return prec
+
+    if max_mem is not None:
+        width = int(px[inside].max() - px[inside].min()) + 1
+        max_rows = max(1, min(max_rows, int(max_mem // (4 * width))))  # float32 rows fitting in max_mem
+
+    reads = 0
+    for y0, y1 in row_blocks(numpy.unique(py[inside]), max_gap, max_rows):
+        sel = numpy.flatnonzero(inside & (py >= y0) & (py < y1))
+        x0 = int(px[sel].min())
+        x1 = int(px[sel].max()) + 1
+        for i in range(bands):
+            d = dsi.GetRasterBand(i + 1).ReadAsArray(x0, int(y0), x1 - x0, int(y1 - y0))
+            reads += 1
+            if d is not None:
+                prec[i, sel] = d[py[sel] - y0, px[sel] - x0]
+
+    metrics.count('gdal_band_reads', reads)
+    return prec
+
+#Samples the points in one NetCDF file and appends their series to the store outprec.
+def extract_file(nc_file, outprec, lat, lon, max_gap, max_rows, max_mem=None):
+    # open the image file
+    load_gdal()
+    dsi = gdal.Open(nc_file, gdal.GA_ReadOnly)
+    if dsi is None:
+        print('Could not open NetCDF file')
+        sys.exit(1)
+
+    # Geotransformation
+    px, py = pt_offsets(dsi.GetGeoTransform(), lat, lon)
+    precstore.append(outprec, nc_times(dsi), sample_bands(dsi, px, py, max_gap, max_rows, max_mem))
+    metrics.count('chirps_point_days', len(lat) * dsi.RasterCount)
+    dsi = None  # Close the file
+
+#NetCDF files of a directory in date order, none if the directory was not made (no file of
+#the period was published yet).
+def nc_files(in_nc_dir):
+    if not os.path.isdir(in_nc_dir):
+        return []
+    return sorted(f for f in os.listdir(in_nc_dir) if f.endswith(".nc"))
+
+#Extracts the precipitation series of all points from the NetCDF files of a directory and
+#appends them to the precipitation store outprec (precstore.py), created if it does not exist.
+#Files are streamed one at a time: every band is sampled right after it is read and the
+#series of each file are appended to the store, so memory stays bounded whatever the period
+#length. Days already in the store (e.g. preliminary days of corrected months) are skipped.
+#Files in skip are not read (already extracted by a previous run) and done(nc_file) is called
+#after every file appended.
+def extract_prec(in_file, in_nc_dir, outprec, max_gap, max_rows, max_mem=None, verbose=False, skip=(), done=None):
+    nc_lst = nc_files(in_nc_dir)
+    id, lat, lon = read_points(in_file)
+    if not os.path.exists(outprec + '/meta.json'):
+        precstore.create(outprec, id)
 
-    #Loop through dates
     for nc_file in nc_lst:
-        if nc_file.endswith(".nc"):
+        if nc_file not in skip:
             start3 = datetime.now()
-            # open the image file
-            dsi = gdal.Open(in_nc_dir + "/" + nc_file, GA_ReadOnly)
-            print(nc_file)
-            if dsi is None:
-                print('Could not open NetCDF file')
-                sys.exit(1)
-
-            meta_nc = dsi.GetMetadata() #To get metadata of the file
-            date_start = meta_nc['time#units'][-14:] #The origin date of the file (For CHIRPS '1980-1-1 0:0:0')
-            datetime_st = datetime.strptime(date_start, '%Y-%m-%d %H:%M:%S')
-            bands_time = meta_nc['NETCDF_DIM_time_VALUES'][1:-1].split(',') #Get the band timestamp point of the file. "[1:-1]" removes the first and last character
-            bands_time = list(map(int, bands_time)) #Convert all strings in a list of integers.
-
-            #Geotransformation data
+            if verbose:
+                print(nc_file)
+            extract_file(in_nc_dir + "/" + nc_file, outprec, lat, lon, max_gap, max_rows, max_mem)
+            if done is not None:
+                done(nc_file)
+
+            if verbose:
+                end3 = datetime.now()
+                print("Time of execution for", nc_file, "is:", str(end3-start3))
+
+
+#Available RAM in bytes (Linux), None when it cannot be found.
+def avail_mem():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+#Pixels and number of reads per band needed to sample the points with a row grouping.
+def read_cost(px, py, max_gap, max_rows):
+    pixels = 0
+    reads = 0
+    for y0, y1 in row_blocks(numpy.unique(py), max_gap, max_rows):
+        sel = (py >= y0) & (py < y1)
+        pixels += int(y1 - y0) * (int(px[sel].max() - px[sel].min()) + 1)
+        reads += 1
+    return pixels, reads
+
+#Cost of one GDAL read call, in pixels, used to compare the reading strategies.
+READ_OVERHEAD = 50000
+
+#Chooses how to read the NetCDF files from the number of points, their spatial spread,
+#the number of bands in the directory and the available RAM. The chirps1 reads (rows
+#holding points), the chirps2 reads (whole bounding box) and a hybrid in between are
+#compared and the cheapest one is returned. nc_lst can give the files to plan for instead.
+def plan_chirps(in_file, in_nc_dir, mem=None, nc_lst=None):
+    id, lat, lon = read_points(in_file)
+    if nc_lst is None:
+        nc_lst = nc_files(in_nc_dir)
+    bands = 0
+    max_bands = 0
+    gt = None
+    load_gdal()
+    for nc_file in nc_lst:
+        dsi = gdal.Open(in_nc_dir + "/" + nc_file, gdal.GA_ReadOnly)
+        if dsi is None:
+            print('Could not open NetCDF file')
+            sys.exit(1)
+        bands += dsi.RasterCount
+        max_bands = max(max_bands, dsi.RasterCount)
+        if gt is None:
             gt = dsi.GetGeoTransform()
-
-            # get image size
-            rowsY = dsi.RasterYSize
             colsX = dsi.RasterXSize
-            bands = dsi.RasterCount
-
-            for i in range(1, bands+1):
-                dt_st = datetime_st + timedelta(days=bands_time[i-1]) #Get the band timestamp in date format
-                band_t = dt_st.strftime('%Y%j')  # we use strftime() to reformat the date to DSSAT format.
-                data[band_t] = dsi.GetRasterBand(i).ReadAsArray(0, 0, colsX, rowsY)
-                time_lst.append(band_t)
-
-            end3 = datetime.now()
-            print("Time of execution for", nc_file, "is:", str(end3-start3))
-
-    #Reads an input CSV file as an array.
-    pt = pd.read_csv(in_file)
-    id = pt['ID'].to_numpy()
-    lon = pt['Longitude'].to_numpy()
-    lat = pt['Latitude'].to_numpy()
-
-    px = ((lon - gt[0]) / gt[1]).astype(int)
-    py = ((lat - gt[3]) / gt[5]).astype(int)
-
-    df_chirps = pd.DataFrame()
-    df_chirps['ID'] = id
-    df_chirps = df_chirps.set_index('ID')
-
-    for t in time_lst:
-        prec_val = data[t][py, px]
-        df_chirps[t] = prec_val
+            rowsY = dsi.RasterYSize
+        dsi = None
+
+    if mem is None:
+        mem = avail_mem()
+    max_mem = 512 * 2**20 if mem is None else max(2**20, min(512 * 2**20, mem // 4))
+    plan = {'name': 'chirps1', 'max_gap': 8, 'max_rows': 256, 'max_mem': max_mem}
+    if gt is None:
+        return plan
+
+    px, py = pt_offsets(gt, lat, lon)
+    inside = (px >= 0) & (px < colsX) & (py >= 0) & (py < rowsY)
+    if not inside.any():
+        return plan
+    px = px[inside]
+    py = py[inside]
+
+    width = int(px.max() - px.min()) + 1
+    mem_rows = max(1, int(max_mem // (4 * width)))
+    options = [('chirps1', 8, 256), ('hybrid', 64, mem_rows), ('chirps2', numpy.inf, mem_rows)]
+    best = None
+    for name, max_gap, max_rows in options:
+        pixels, reads = read_cost(px, py, max_gap, max_rows)
+        cost = bands * (pixels + READ_OVERHEAD * reads)
+        if best is None or cost < best[0]:
+            best = (cost, name, max_gap, max_rows, pixels, reads)
+
+    cost, name, max_gap, max_rows, pixels, reads = best
+    plan = {'name': name, 'max_gap': max_gap, 'max_rows': max_rows, 'max_mem': max_mem}
+    out_mem = max_bands * len(id) * 4 * 2  # Series of one file, kept until appended to the store.
+    print('CHIRPS extraction plan:', name, '|', len(id), 'points,', bands, 'bands in', len(nc_lst), 'files |',
+          bands * reads, 'reads,', round(bands * pixels * 4 / 2**20, 1), 'MB read,',
+          round(out_mem / 2**20, 1), 'MB for the series of a file')
+    if mem is not None and out_mem > mem:
+        print('Warning: the extracted series may not fit in the available RAM (',
+              round(mem / 2**20, 1), 'MB).')
+    return plan
 
-    if not os.path.exists(os.path.dirname(outprec_file)):
-        os.mkdir(os.path.dirname(outprec_file))
+#Intended for long time series but few points (<10000)
+#Every NetCDF file is opened once and the series of all points are read in row blocks.
+def chirps1(in_file, in_nc_dir, outprec):
+    extract_prec(in_file, in_nc_dir, outprec, max_gap=8, max_rows=256)
+
+#Intended for short time series (< 2 years) but many points.
+#Each band is read only over the bounding box of the points, split in row blocks so a single
+#read never takes more than max_mem bytes (512 MB by default).
+def chirps2(in_file, in_nc_dir, outprec, max_mem=512 * 2**20):
+    start2 = datetime.now()
 
-    joblib.dump(df_chirps, outprec_file)
+    extract_prec(in_file, in_nc_dir, outprec, max_gap=numpy.inf, max_rows=numpy.inf, max_mem=max_mem,
+                 verbose=True)
 
     end2 = datetime.now()
     print("Time of execution for reading the netCDF file: ", str(end2-start2))
 
+#Extracts the CHIRPS data with the reading strategy chosen by plan_chirps.
+def chirps_auto(in_file, in_nc_dir, outprec, skip=(), done=None):
+    plan = plan_chirps(in_file, in_nc_dir)
+    extract_prec(in_file, in_nc_dir, outprec, plan['max_gap'], plan['max_rows'], plan['max_mem'], skip=skip, done=done)
@@ -6,68 +6,119 @@
 #Contact email: ocastilloromero@ufl.edu
 #######################################
 
-import os, sys
-import argparse
-import shutil
+import os
 import pandas as pd
-from datetime import datetime, date, timedelta
+import metrics
+from datetime import datetime, timedelta
 from chirps import *
-import joblib
+from precstore import last_date
+import precarchive
+from wthindex import open_index, record
+from pipeline import dssat_stream
+from checkpoint import start_run, is_done, mark_done, done_items, add_done, resumed_since
 from getnasap import nasa, nasachirps
 
-def dssat_wth(in_file, startDate, endDate, out_dir):
+def dssat_wth(in_file, startDate, endDate, out_dir, subset_margin=None, workers=None, stream=False, resume=False,
+              archive=None):
     s1 = datetime.now()
+    archive = None if archive is None else os.path.abspath(archive)
+    #Metrics of every stage, in metrics.jsonl next to in_file (metrics.py).
+    metrics.start(os.path.dirname(os.path.abspath(in_file)) + '/metrics.jsonl', 'get')
 
     os.chdir(os.path.dirname(in_file))
     tempdir = os.path.dirname(in_file) + '/temp'
-    if os.path.exists(tempdir):
-        shutil.rmtree(tempdir)
-        os.mkdir(tempdir)
+    #Checkpoints of the run (checkpoint.py); a resumed run skips the steps already done.
+    #The streaming mode has no steps to skip and always starts again.
+    state = start_run(tempdir, {'command': 'get', 'in_file': os.path.abspath(in_file), 'startDate': str(startDate),
+                                'endDate': str(endDate), 'out_dir': os.path.abspath(out_dir),
+                                'subset_margin': subset_margin, 'archive': archive}, resume and not stream)
+
+    #Bounding box to crop the CHIRPS files to, if requested.
+    bbox = None if subset_margin is None else pt_bbox(in_file, subset_margin)
+
+    if stream:
+        #Downloads, CHIRPS extraction and WTH writing overlapped (pipeline.py).
+        metrics.stage('stream')
+        lastday_corr = dssat_stream(in_file, startDate, endDate, tempdir, out_dir, bbox, workers)
     else:
-        os.mkdir(tempdir)
+        print('Getting NASA POWER data...')
+        nasa_outdir = tempdir + '/nasap'
+        #Getting NASA POWER data for the update period
+        metrics.stage('nasa')
+        if not is_done(state, 'nasa'):
+            nasa(in_file, str(startDate), str(endDate), nasa_outdir)
+            mark_done(state, 'nasa')
 
-    print('Getting NASA POWER data...')
-    nasa_outdir = tempdir + '/nasap'
-    #Getting NASA POWER data for the update period
-    nasa(in_file, str(startDate), str(endDate), nasa_outdir)
+        dt_s = datetime.strptime(str(startDate), '%Y%m%d')
+        dt_e = datetime.strptime(str(endDate), '%Y%m%d')
+        outdir_prec = tempdir + '/prec'
 
-    #Getting corrected data
-    print('Getting corrected data from CHIRPS server...')
-    out_cor_nc = tempdir + '/in_nc_cor'
-    dt_s = datetime.strptime(str(startDate), '%Y%m%d')
-    dt_e = datetime.strptime(str(endDate), '%Y%m%d')
-    get_correc_nc(dt_s, dt_e, out_cor_nc)
+        #Series from the local archive (precarchive.py), if it covers the points and the start;
+        #the corrected data are then downloaded from the day after its last day.
+        dt_s_c = dt_s
+        if archive is not None:
+            metrics.stage('archive')
+            if not is_done(state, 'archive'):
+                last_arch = precarchive.extract(archive, in_file, outdir_prec, dt_s, dt_e)
+                mark_done(state, 'archive', None if last_arch is None else last_arch.strftime('%Y%j'))
+            if state['done']['archive'] is not None:
+                dt_s_c = datetime.strptime(state['done']['archive'], '%Y%j') + timedelta(days=1)
 
-    #Run chirps for corrected data
-    outdir_prec = tempdir + '/prec_pkl'
-    print('Processing CHIRPS data...')
-    chirps1(in_file, out_cor_nc, outdir_prec + '/prec_corr.pkl')
+        #Getting corrected data
+        #The files downloaded are kept in the checkpoints, so a resumed run only tries the failed ones again.
+        print('Getting corrected data from CHIRPS server...')
+        out_cor_nc = tempdir + '/in_nc_cor'
+        metrics.stage('corrected_nc')
+        if not is_done(state, 'corrected_nc'):
+            os.makedirs(out_cor_nc, exist_ok=True)
+            get_nc(correc_jobs(dt_s_c, dt_e, out_cor_nc), bbox, done_items(state, 'corrected_nc_files'),
+                   lambda name: add_done(state, 'corrected_nc_files', name))
+            mark_done(state, 'corrected_nc')
 
-    #Getting the latest day available in prec corrected data.
-    df = joblib.load(outdir_prec + '/prec_corr.pkl')
-    lastday_corr = df.columns[-1]
-    dt_s_p = datetime.strptime(lastday_corr, '%Y%j') + timedelta(days=1)
+        #Run chirps for corrected data
+        print('Processing CHIRPS data...')
+        metrics.stage('corrected')
+        if not is_done(state, 'corrected'):
+            chirps_auto(in_file, out_cor_nc, outdir_prec, done_items(state, 'corrected_files'),
+                        lambda nc_file: add_done(state, 'corrected_files', nc_file))
+            lastday_corr = last_date(outdir_prec)
+            mark_done(state, 'corrected', None if lastday_corr is None else lastday_corr.strftime('%Y%j'))
 
-    if dt_s_p < dt_e:
-        #Getting preliminary data
-        print('Getting preliminary data from CHIRPS server...')
-        out_pre_nc = tempdir + '/in_nc_pre'
-        get_prelim_nc(dt_s_p, dt_e, out_pre_nc)
-        print('CHIRPS netCDF files in disk.')
+        #Getting the latest day available in prec corrected data (kept in the checkpoints, as the
+        #store may have preliminary days of a previous run too).
+        lastday_corr = state['done']['corrected']
+        lastday_corr = None if lastday_corr is None else datetime.strptime(lastday_corr, '%Y%j')
+        dt_s_p = dt_s if lastday_corr is None else lastday_corr + timedelta(days=1)
 
-        #Run chirps for preliminary data
-        chirps1(in_file, out_pre_nc, outdir_prec + '/prec_prelim.pkl')
+        if dt_s_p < dt_e:
+            #Getting preliminary data
+            print('Getting preliminary data from CHIRPS server...')
+            out_pre_nc = tempdir + '/in_nc_pre'
+            metrics.stage('prelim_nc')
+            if not is_done(state, 'prelim_nc'):
+                get_nc(prelim_jobs(dt_s_p, dt_e, out_pre_nc), bbox, done_items(state, 'prelim_nc_files'),
+                       lambda name: add_done(state, 'prelim_nc_files', name))
+                mark_done(state, 'prelim_nc')
+            print('CHIRPS netCDF files in disk.')
 
-        #Merging corrected and preliminary precipitation data.
-        precpkl(outdir_prec)
-        print('CHIRPS processing data are complete.')
+            #Run chirps for preliminary data. Only the days after the corrected data are appended.
+            metrics.stage('prelim')
+            chirps_auto(in_file, out_pre_nc, outdir_prec, done_items(state, 'prelim_files'),
+                        lambda nc_file: add_done(state, 'prelim_files', nc_file))
+            print('CHIRPS processing data are complete.')
 
-    else:
-        os.rename(outdir_prec + '/prec_corr.pkl', outdir_prec + '/prec.pkl')
+        #Fusing NASA POWER and CHIRPS with QC on SRAD.
+        print('Building the WTH files...')
+        metrics.stage('nasachirps')
+        nasachirps(in_file, nasa_outdir, outdir_prec, out_dir, workers, resumed_since(state))
 
-    #Fusing NASA POWER and CHIRPS with QC on SRAD.
-    print('Building the WTH files...')
-    nasachirps(in_file, nasa_outdir, outdir_prec + '/prec.pkl', out_dir)
+    #Index of the new files, with the dates of corrected and preliminary CHIRPS.
+    metrics.stage('index')
+    con = open_index(out_dir)
+    record(con, out_dir, [str(x) + ".WTH" for x in pd.read_csv(in_file)['ID']],
+           None if lastday_corr is None else int(lastday_corr.strftime('%Y%j')))
+    con.close()
 
+    metrics.finish()
     e1 = datetime.now()
     print("Time for execution is: ", str(e1-s1))
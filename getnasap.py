@@ -8,17 +8,26 @@
 
 import os
 import sys
-import queue
-import threading
-import requests
-import time
+import json
 import logging
+import threading
+from multiprocessing import Pool
+import numpy
 import pandas as pd
-import joblib
+import metrics
 from datetime import datetime
+from powerstore import open_store, missing_ranges, put_text, write_wth, SRAD_MISSING
+from powerclient import PowerClient
+from precstore import open_prec, NODATA
 
 #Function to get the data from the NASAPOWER API v2
-def get_data(user_input, startDate, endDate, nasa_outdir):
+#Only the dates missing in the local store (powerstore.py) are requested to the API, through
+#the rate-limited client of powerclient.py (workers concurrent requests to start with, rate
+#requests per second at most). Failed points are queued again in the same pool, up to
+#attempts tries each. Returns the points that could not be downloaded.
+#With done, the file of every point is written as soon as all its requests are in, and
+#done(nasapid) is called then (from the request threads).
+def get_data(user_input, startDate, endDate, nasa_outdir, workers=5, rate=5.0, attempts=3, done=None):
 
     # Create target Directory if it doesn't exist
     if not os.path.exists(nasa_outdir):
@@ -26,121 +35,236 @@ def get_data(user_input, startDate, endDate, nasa_outdir):
     else:
         print("Directory ", nasa_outdir, " already exists. Data will be added/overwritten")
 
-    def download(q):
-        s = requests.Session()
-        s.mount("https://power.larc.nasa.gov", requests.adapters.HTTPAdapter(max_retries=30))
-        while True:
-            pt = q.get()
-            id = pt[0]
-            logging.info("Requesting data for: %s", id)
-
-            try:
-                response = s.get('https://power.larc.nasa.gov/api/temporal/daily/point', params=pt[1], timeout=80)
-                response.raise_for_status()
-            except:
-                logging.info("Error in point %s with code %s", id, response.status_code)
-            else:
-                write_nasawth(response.text, nasa_outdir, id)
-                logging.info("Data obtained for: %s", id)
-
-            q.task_done()
-            time.sleep(delay)
+    written = set()
+    pending = {}
+    count = threading.Lock()
+
+    def write_point(id):
+        if not write_wth(con, id, startDate, endDate, nasa_outdir + "/" + id + ".WTH"):
+            return False
+        with count:
+            written.add(id)
+        if done is not None:
+            done(id)
+        return True
+
+    def store(id, params, text):
+        put_text(con, id, text, params['start'], params['end'])
+        logging.info("Data obtained for: %s (%s to %s)", id, params['start'], params['end'])
+        if done is not None:
+            with count:
+                pending[id] -= 1
+                ready = pending[id] == 0
+            if ready:
+                write_point(id)
 
     format = "%(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
-    NUM_THREADS = 5
-    delay = 0  # seconds
-    q = queue.Queue()
-
-    for i in range(NUM_THREADS):
-        t = threading.Thread(target=download, args=(q,))
-        t.daemon = True
-        t.start()
+    con = open_store()
+    client = PowerClient(workers=workers, rate=rate)
 
     pt = pd.read_csv(user_input)
     pt_nasa = pt.drop_duplicates(subset=['nasapid'])
 
     try:
+        jobs = []
         for index, row in pt_nasa.iterrows():
             nasa_id = str(int(row['nasapid']))
             lat_np = round(row['LatNP'], 4)
             lon_np = round(row['LonNP'], 4)
-            loc_param = {'parameters': 'T2M', 'community': 'AG', 'longitude': lon_np, 'latitude': lat_np,
-                         'start': startDate, 'end': endDate, 'format': 'ICASA'}
-            url = [nasa_id, loc_param]
-            q.put(url)
-        q.join()
+            for start, end in missing_ranges(con, nasa_id, startDate, endDate):
+                loc_param = {'parameters': 'T2M', 'community': 'AG', 'longitude': lon_np, 'latitude': lat_np,
+                             'start': start, 'end': end, 'format': 'ICASA'}
+                jobs.append((nasa_id, loc_param))
+        print(len(jobs), "request(s) to NASA POWER for", len(pt_nasa), "point(s), the rest is in the local store.")
+        for job in jobs:
+            pending[job[0]] = pending.get(job[0], 0) + 1
+        if done is not None:
+            #Points already in the store are ready right away.
+            for nasa_id in pt_nasa['nasapid']:
+                nasa_id = str(int(nasa_id))
+                if nasa_id not in pending:
+                    write_point(nasa_id)
+        failed = [{'nasapid': f[0], 'start': f[1]['start'], 'end': f[1]['end'], 'attempts': f[2],
+                   'status': getattr(getattr(f[3], 'response', None), 'status_code', None), 'error': str(f[3])}
+                  for f in client.run(jobs, store, attempts)]
+        client.summary()
+
+        #Write the files of the points from the local store.
+        failed_ids = set(f['nasapid'] for f in failed)
+        metrics.count('power_points', len(pt_nasa))
+        for nasa_id in pt_nasa['nasapid']:
+            nasa_id = str(int(nasa_id))
+            if nasa_id not in failed_ids and nasa_id not in written:
+                if not write_point(nasa_id):
+                    failed.append({'nasapid': nasa_id, 'start': startDate, 'end': endDate, 'attempts': 0,
+                                   'status': None, 'error': 'No data in the local store'})
+        con.close()
+        metrics.count('power_points_failed', len(set(f['nasapid'] for f in failed)))
+        return failed
 
     except KeyboardInterrupt:
         sys.exit(1)
 
-#Function to check the NASAP files requested are downloaded in disk.
-def check_files(user_input, nasa_outdir):
-    # Getting the number of NASAP files requested.
-    pt = pd.read_csv(user_input).drop_duplicates(subset=["nasapid"])
-    pts_req = pt['nasapid'].to_list()
-    n_pt = len(pts_req)
-    print("Number of points requested:", n_pt)
-
-    # List of files downloaded.
-    wth_files = [int(x[:-4]) for x in os.listdir(nasa_outdir) if x.endswith(".WTH")]
-    n_wth = len(wth_files)
-    print("Number of points downloaded:", n_wth)
-
-    m_pts = list(set(pts_req) - set(wth_files))
-    if m_pts:
-        return [m_pts, n_pt, n_wth, pt]
-    else:
-        print("All requested data were downloaded successfully.")
-        return False
-
-#Function to check that all NASAPOWER files requested are downloaded.
-def get_data2(user_input, cf):
-
-    if cf[2] < cf[1]:
-        print(cf[1] - cf[2], "missing file(s):", cf[0])
-        pt_m = cf[3].loc[cf[3]['nasapid'].isin(cf[0])]
-        missing_pt = os.path.dirname(user_input) + "/missing_pt.csv"
-        pt_m.to_csv(missing_pt, index=False)
-        get_data(missing_pt, startDate, endDate, nasa_outdir)
-
-    elif cf[2] > cf[1]:
-        print("Something is wrong with the input file index.")
-        sys.exit(1)
-    else:
-        print("All requested files were downloaded successfully.")
-
-#Function to write all NASAPOWER data to WTH files
-def write_nasawth(dat, out_dir, id):
-    with open(out_dir + "/" + id + ".WTH", "w", newline='') as f:
-        f.write(dat)
+#Manifest of the points that failed after all their attempts.
+def write_failed(user_input, startDate, endDate, failed, manifest=None):
+    if manifest is None:
+        manifest = os.path.dirname(user_input) + "/failed_pt.json"
+    with open(manifest, "w") as f:
+        json.dump({'startDate': startDate, 'endDate': endDate, 'failed': failed}, f, indent=1)
+    print(len(set(f['nasapid'] for f in failed)), "point(s) could not be downloaded, see", manifest)
 
 #Function to download the NASA POWER data.
-def nasa(user_input, startDate, endDate, nasa_outdir):
+#The points that fail are written to manifest (failed_pt.json next to user_input by default).
+def nasa(user_input, startDate, endDate, nasa_outdir, manifest=None):
     s1 = datetime.now()
-    get_data(user_input, startDate, endDate, nasa_outdir)
-    cf = check_files(user_input, nasa_outdir) #To check that all files requested were downloaded.
-    if cf:
-        get_data2(user_input, cf)
-        if check_files(user_input, nasa_outdir):
-            print('Program terminated. Please check manually NASAPOWER server response.')
-            sys.exit(1)
+    failed = get_data(user_input, startDate, endDate, nasa_outdir)
+    if failed:
+        write_failed(user_input, startDate, endDate, failed, manifest)
+        print('Program terminated. Please check manually NASAPOWER server response.')
+        sys.exit(1)
+    print("All requested data were downloaded successfully.")
 
     e1 = datetime.now()
     print("Execution time getting NASAPOWER data: ", str(e1 - s1))
 
-#Function to merge NASAPOWER and CHIRPS data, including the quality control for SRAD.
-def nasachirps(user_input, nasa_outdir, chirps_input, out_dir):
-
-    df_prec = joblib.load(chirps_input)
-    df_prec = df_prec.sort_index(axis=1)
-    d = df_prec.columns.values.tolist()  # All dates available in CHIRPS
-    ids_ch = df_prec.index.values.tolist()  # All IDs available in CHIRPS
+#SRAD quality control over the whole series at once.
+#Returns the number of rows to write and the SRAD column, with the same rules as row by row:
+#one missing value is the mean of its neighbours, two in a row are interpolated, three in a
+#row (or two at the end) truncate the file after the first of them, and missing values at
+#the start or at the end take the next or previous value. The missing values are the ones of
+#the local store (powerstore.SRAD_MISSING), so they are never taken as settled there.
+def srad_qc(solar):
+    solar = numpy.array(solar, dtype=object)
+    n = len(solar)
+    miss = numpy.isin(solar, list(SRAD_MISSING))
+    if not miss.any():
+        return n, solar
+    if miss[0] and (n == 1 or miss[1]):  # The series starts with two missing values or has only one
+        return 0, solar[:0]
+
+    nxt = numpy.append(miss[1:], False)  # Next record missing
+    nxt2 = numpy.append(miss[2:], [False, False])  # Record after the next missing
+    prv = numpy.insert(miss[:-1], 0, False)  # Previous record missing
+    idx = numpy.arange(n)
+    stop = miss & nxt & (nxt2 | (idx + 2 == n))  # Three missing values in a row, or two at the end
+    cut = int(numpy.argmax(stop)) + 1 if stop.any() else n
+
+    #Values around every missing record before the cutoff.
+    k = numpy.flatnonzero(miss[:cut])
+    val = numpy.where(miss, numpy.nan, solar).astype(float)
+    v = lambda j: val[numpy.clip(k + j, 0, n - 1)]
+    interp = numpy.select([nxt[k], prv[k]],
+                          [v(-1) + (v(2) - v(-1)) / 3,  # Two consecutive missing values. First value
+                           v(-2) + 2 * (v(1) - v(-2)) / 3],  # Two consecutive missing values. Second value
+                          (v(-1) + v(1)) / 2)  # One missing value
+    copy_prev = stop[k] | (~nxt[k] & ~prv[k] & (k + 1 == n))  # Truncation, or missing last record
+    copy_next = ~copy_prev & ~nxt[k] & ~prv[k] & (k == 0)  # Missing first record
+
+    srad = solar[:cut].copy()
+    for j, i in enumerate(k):
+        if copy_prev[j]:
+            srad[i] = solar[i - 1]
+        elif copy_next[j]:
+            srad[i] = solar[i + 1]
+        else:
+            srad[i] = round(float(interp[j]), 1)
+    return cut, srad
+
+#WTH header and row layouts.
+s1 = '{:>6} {:>9} {:>9} {:>7} {:>5} {:>5} {:>5} {:>5}'
+hdr1 = s1.format("@ INSI", "LAT", "LONG", "ELEV", "TAV", "AMP", "REFHT", "WNDHT" + "\n")
+s2 = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} {:>6}'
+hdr3 = s2.format("@  DATE", "T2M", "TMIN", "TMAX", "TDEW", "RHUM", "RAIN2", "WIND", "SRAD", "RAIN")
+s2_rows = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} '  # s2 up to RAIN
+
+#Fixed-width text of the rows of a NASA POWER cell up to RAIN, the same for all its IDs.
+def rows_text(rows, srad):
+    return numpy.array([s2_rows.format(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], SRAD2)
+                        for r, SRAD2 in zip(rows, srad)], dtype=object)
+
+#RAIN column (6 characters and the end of line) of an ID: the NASA POWER text rain2 (already
+#padded) with the CHIRPS values val at the rows in idx, formatted once per distinct value.
+def rain_text(rain2, val, idx):
+    rain = rain2.copy()
+    if len(idx):
+        u, inv = numpy.unique(val[idx], return_inverse=True)
+        rain[idx] = numpy.array(['{:>6}'.format(round(float(v), 1)) + '\n' for v in u], dtype=object)[inv.ravel()]
+    return rain
+
+#Reads a NASA POWER file and applies the SRAD quality control.
+#Returns the first line, the station header values, the rows to write and their SRAD.
+def read_power(nasa_outdir, nasa_id):
+    with open(nasa_outdir + "/" + nasa_id + ".WTH", "r") as f1:  # Reading nasap files
+        data = [line for line in f1.readlines() if line.strip()]
+    hdr2 = data[11].split()
+    rows = [line.split() for line in data[13:]]
+    cut, srad = srad_qc([r[8] for r in rows])  # SRAD quality control
+    return data[0], hdr2, rows[:cut], srad
+
+#Writes the WTH files of all the IDs sharing a NASA POWER cell. The NASA POWER file is parsed,
+#quality controlled and formatted once; each ID only gets its coordinates and CHIRPS rainfall,
+#and every file is written with a single call. Returns the number of rows written.
+def write_group(nasa_id, members, nasa_outdir, out_dir, prec, start, ids_ch):
+    title, hdr2, rows, srad = read_power(nasa_outdir, nasa_id)
+    text = rows_text(rows, srad)
+    rain2 = numpy.array(['{:>6}'.format(r[6]) + '\n' for r in rows], dtype=object)
+    pos = None
+    if rows and len(prec):
+        #Row of every date in the CHIRPS store, -1 for dates out of it.
+        pos = numpy.array((pd.to_datetime([r[0] for r in rows], format='%Y%j') - start).days, dtype=int)
+        pos[(pos < 0) | (pos >= len(prec))] = -1
+
+    for id, lat, lon in members:
+        #CHIRPS rainfall aligned with the NASA POWER dates; NASA POWER rainfall where CHIRPS
+        #has no data for the date or the point.
+        rain = rain2
+        if id in ids_ch and pos is not None:
+            val = prec[pos, ids_ch[id]]
+            rain = rain_text(rain2, val, numpy.flatnonzero((pos >= 0) & (val != NODATA)))
+
+        #Written to a temporary file and renamed, so a file is never left half written.
+        out_file = out_dir + "/" + str(id) + ".WTH"
+        with open(out_file + ".tmp", "w") as f2:  # Writing requested files
+            f2.write(title + '\n\n' + hdr1 + s1.format(hdr2[0], lat, lon, hdr2[3], hdr2[4], hdr2[5], hdr2[6],
+                                                       hdr2[7]) +
+                     '\n\n' + hdr3 + '\n' + ''.join(text + rain))  # Header and rows
+        os.replace(out_file + ".tmp", out_file)
+    return len(rows) * len(members)
+
+#Writes the WTH files of a shard of NASA POWER cells in a worker process. The CHIRPS store is
+#opened memory-mapped, so all the workers share it read-only instead of each one receiving a
+#copy. Returns the worker id, number of points, rows written and seconds taken.
+def wth_shard(args):
+    shard, nasa_outdir, out_dir, chirps_input = args
+    t0 = datetime.now()
+    ids, start, prec = open_prec(chirps_input)
+    ids_ch = {id: i for i, id in enumerate(ids)}  # Column of every ID in CHIRPS
+    rows = 0
+    for nasa_id, members in shard:
+        rows += write_group(nasa_id, members, nasa_outdir, out_dir, prec, start, ids_ch)
+    return os.getpid(), sum(len(m) for nasa_id, m in shard), rows, (datetime.now() - t0).total_seconds()
+
+#Counts the WTH files and rows written by the shards (in the metrics of this process, as
+#the workers may be other processes).
+def count_shards(times):
+    metrics.count('wth_files_written', sum(t[1] for t in times))
+    metrics.count('wth_rows_written', sum(t[2] for t in times))
+
+#IDs (with their coordinates) grouped by NASA POWER cell, in the order of the input file.
+def cell_groups(pt):
+    groups = {}
+    for index, row in pt.iterrows():
+        groups.setdefault(str(int(row['nasapid'])), []).append(
+            (int(row['ID']), round(row['Latitude'], 5), round(row['Longitude'], 5)))
+    return groups
 
-    s1 = '{:>6} {:>9} {:>9} {:>7} {:>5} {:>5} {:>5} {:>5}'
-    hdr1 = s1.format("@ INSI", "LAT", "LONG", "ELEV", "TAV", "AMP", "REFHT", "WNDHT" + "\n")
-    s2 = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} {:>6}'
-    hdr3 = s2.format("@  DATE", "T2M", "TMIN", "TMAX", "TDEW", "RHUM", "RAIN2", "WIND", "SRAD", "RAIN")
+#Function to merge NASAPOWER and CHIRPS data, including the quality control for SRAD.
+#The NASA POWER cells are split in contiguous shards written by `workers` processes (all CPUs
+#by default). chirps_input is the precipitation store (precstore.py).
+#With since (datetime), the cells whose WTH files were all written after it are skipped, as
+#they are complete (a resumed run).
+def nasachirps(user_input, nasa_outdir, chirps_input, out_dir, workers=None, since=None):
 
     try:
         pt = pd.read_csv(user_input)
@@ -156,78 +280,34 @@ def nasachirps(user_input, nasa_outdir, chirps_input, out_dir):
         if nasa_outdir is None:
             nasa_outdir = os.path.dirname(user_input) + "/NASAP"
 
-        for index, row in pt.iterrows():
-
-            id = int(row['ID'])
-            lat = round(row['Latitude'], 5)
-            lon = round(row['Longitude'], 5)
-            nasa_id = str(int(row['nasapid']))
+        groups = list(cell_groups(pt).items())
+        if since is not None:
+            n_cells = len(groups)
+            groups = [(nasa_id, members) for nasa_id, members in groups if not all(
+                os.path.exists(out_dir + "/" + str(m[0]) + ".WTH") and
+                os.path.getmtime(out_dir + "/" + str(m[0]) + ".WTH") >= since.timestamp() for m in members)]
+            print(n_cells - len(groups), "NASA POWER cell(s) already written.")
+
+        #Contiguous shards of cells with about the same number of points.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(groups)))
+        n_pt = numpy.cumsum([len(m) for nasa_id, m in groups])
+        bounds = numpy.searchsorted(n_pt, [n_pt[-1] * i / workers for i in range(1, workers)]) + 1 if groups else []
+        shards = [groups[a:b] for a, b in zip([0] + list(bounds), list(bounds) + [len(groups)])]
+        shards = [shard for shard in shards if shard]
+        workers = max(1, len(shards))
+        jobs = [(shard, nasa_outdir, out_dir, chirps_input) for shard in shards]
+
+        if workers == 1:
+            times = [wth_shard(job) for job in jobs]
+        else:
+            with Pool(workers) as pool:
+                times = pool.map(wth_shard, jobs)
 
-            with open(nasa_outdir + "/" + nasa_id + ".WTH", "r") as f1:  # Reading nasap files
-                data = [line for line in f1.readlines() if line.strip()]
-                hdr2 = data[11].split()
-                solar = [sr.split()[8] for sr in data[13:]]  # To get solar radiation values
-                i_srad = [i for i, e in enumerate(solar) if
-                          e == 'nan' or e == '-99' or e == '-99.0' or e == '-3596.4']  # To find missing srad values
-
-                with open(out_dir + "/" + str(id) + ".WTH", "w") as f2:  # Writing requested files
-                    f2.write(data[0] + '\n\n' + hdr1 + s1.format(hdr2[0], lat, lon, hdr2[3], hdr2[4], hdr2[5], hdr2[6],
-                                                                 hdr2[7]) +
-                             '\n\n' + hdr3 + '\n')  # Writing the header
-
-                    for index2, row in enumerate(data[13:]):
-                        c = 0  # Controls when to cutoff the end of weather file. c=1 means, the script stops writing rows.
-                        r = row.split()  # row of values one line at a time
-
-                        # SRAD quality control
-                        if index2 in i_srad:
-                            if ((index2 + 1 in i_srad) and (
-                                    index2 + 2 in i_srad) and index2 == 0):  # Three first consecutive records have srad missing values
-                                break
-                            if ((
-                                    index2 + 1 in i_srad) and index2 == 0):  # Two first consecutive records have srad missing values
-                                break
-                            if (len(data[
-                                    13:]) == 1):  # The first record has srad missing value and there is no more data
-                                break
-                            if ((index2 + 1 in i_srad) and (index2 + 2 in i_srad)):
-                                SRAD2 = solar[index2 - 1]  # Three consecutive records have srad missing values
-                                c = 1
-                            elif ((index2 + 1) in i_srad and (index2 + 2) == len(data[13:])):
-                                SRAD2 = solar[index2 - 1]  # Two last records have srad missing values
-                                c = 1
-                            elif (index2 + 1) in i_srad:  # Two consecutive missing values. First value
-                                SRAD2 = round(float(solar[index2 - 1]) + (
-                                        float(solar[index2 + 2]) - float(solar[index2 - 1])) / 3, 1)
-                            elif (index2 - 1) in i_srad:  # Two consecutive missing values. Second value
-                                SRAD2 = round(float(solar[index2 - 2]) + 2 * (
-                                        float(solar[index2 + 1]) - float(solar[index2 - 2])) / 3, 1)
-                            elif (index2 + 1) == len(data[13:]):  # The last record has a srad missing value
-                                SRAD2 = solar[index2 - 1]
-                            elif (index2 == 0):  # The first record has a srad missing value but the next has valid data
-                                SRAD2 = solar[index2 + 1]
-                            else:
-                                SRAD2 = round((float(solar[index2 - 1]) + float(solar[index2 + 1])) / 2,
-                                              1)  # One consecutive missing value
-                        else:
-                            SRAD2 = r[8]  # To keep the original (no missing) value
-
-                        if (r[0] in d) and (
-                                id in ids_ch):  # Evaluates if date from NASA file (r[0]) is in list of dates available in dates of chirps (d) and if the ID is in the CHIRPS
-                            #                            start4 = datetime.now()
-
-                            RAIN_CHIRPS = df_prec.loc[id, r[0]]
-
-                            if RAIN_CHIRPS == -9999.0:
-                                RAIN = r[6]
-                            else:
-                                RAIN = round(float(RAIN_CHIRPS), 1)
-                        else:
-                            RAIN = r[6]
-
-                        f2.write(s2.format(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], SRAD2, RAIN) + '\n')
-                        if c == 1:
-                            break
+        count_shards(times)
+        for pid, n, rows, t in times:
+            print("Worker", pid, "wrote", n, "WTH files in", round(t, 1), "s.")
 
     except KeyboardInterrupt:
         sys.exit(1)
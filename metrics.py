@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import json
+import time
+import resource
+import threading
+from datetime import datetime
+
+#Metrics of the runs: counters (bytes downloaded, HTTP responses and retries, GDAL band
+#reads, points extracted, WTH rows written...) and the time and peak memory of every stage.
+#A run (start to finish) is split in stages with stage(name), each one ending where the next
+#starts. Every stage and the whole run write a JSON line to the metrics log of the run, with
+#the counters added during it and their rate per second, and write_prom dumps the totals of
+#the process in the Prometheus textfile format at the end.
+lock = threading.Lock()
+counters = {}  # (name, labels) -> value
+stages = {}  # stage -> total seconds
+run = None  # Open run: log file, command, start and counters at the start
+current = None  # Open stage: name, start and counters at the start
+
+#Adds value to a counter; labels tell apart e.g. the sources or status codes.
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+#Peak resident memory of the process and of its finished worker processes, in bytes.
+def peak_rss():
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in KB on Linux
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def snapshot():
+    with lock:
+        return dict(counters)
+
+#Counters added since the snapshot before, as 'name{label=value}' keys, with the rate per
+#second of every one (but the counters of seconds).
+def delta(before, seconds):
+    out = {}
+    for key, value in snapshot().items():
+        value -= before.get(key, 0)
+        if value:
+            name = key[0] + ('{' + ','.join(k + '=' + v for k, v in key[1]) + '}' if key[1] else '')
+            out[name] = round(value, 3)
+            if not key[0].endswith('_seconds'):
+                out[name + '_per_s'] = round(value / max(seconds, 1e-6), 1)
+    return out
+
+#Appends an event to the log of the open run. Nothing is logged when there is no run or the
+#directory of the log is gone, so an error is never hidden by its metrics.
+def log(event):
+    if run is None or run['log'] is None or not os.path.isdir(os.path.dirname(os.path.abspath(run['log']))):
+        return
+    event = dict(event, time=datetime.now().isoformat(), command=run['command'], run=run['started'])
+    with open(run['log'], 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+#Starts a run logging to log_file (JSON lines, appended). A run left open by an error is
+#closed as failed first.
+def start(log_file, command):
+    global run
+    if run is not None:
+        finish('failed')
+    run = {'log': log_file, 'command': command, 'started': datetime.now().isoformat(), 't0': time.monotonic(),
+           'counters': snapshot()}
+
+#Ends the open stage, if any, and starts the stage name (None to only end it).
+def stage(name):
+    global current
+    now = time.monotonic()
+    if current is not None:
+        seconds = now - current['t0']
+        with lock:
+            stages[current['name']] = stages.get(current['name'], 0) + seconds
+        log({'event': 'stage', 'stage': current['name'], 'seconds': round(seconds, 3),
+             'peak_rss_mb': round(peak_rss() / 2**20, 1), 'counters': delta(current['counters'], seconds)})
+    current = None if name is None else {'name': name, 't0': now, 'counters': snapshot()}
+
+#Ends the run with its status ('done' or 'failed'). Nothing to do if no run is open.
+def finish(status='done'):
+    global run
+    if run is None:
+        return
+    stage(None)
+    seconds = time.monotonic() - run['t0']
+    log({'event': 'run', 'status': status, 'seconds': round(seconds, 3), 'peak_rss_mb': round(peak_rss() / 2**20, 1),
+         'counters': delta(run['counters'], seconds)})
+    count('runs', 1, command=run['command'], status=status)
+    run = None
+
+#Writes the totals of the process to prom_file in the Prometheus textfile format (for the
+#node_exporter textfile collector), through a temporary file so it is never read half written.
+def write_prom(prom_file):
+    lines = []
+    names = {}
+    for (name, labels), value in sorted(snapshot().items()):
+        names.setdefault(name, []).append((labels, value))
+    for name, values in names.items():
+        lines.append('# TYPE nasapchirps_' + name + '_total counter')
+        for labels, value in values:
+            lines.append('nasapchirps_' + name + '_total' + prom_labels(labels) + ' ' + repr(float(value)))
+    lines.append('# TYPE nasapchirps_stage_seconds gauge')
+    with lock:
+        for name, seconds in sorted(stages.items()):
+            lines.append('nasapchirps_stage_seconds' + prom_labels([('stage', name)]) + ' ' + repr(round(seconds, 3)))
+    lines.append('# TYPE nasapchirps_peak_rss_bytes gauge')
+    lines.append('nasapchirps_peak_rss_bytes ' + str(peak_rss()))
+    lines.append('# TYPE nasapchirps_last_run_timestamp_seconds gauge')
+    lines.append('nasapchirps_last_run_timestamp_seconds ' + repr(round(time.time(), 3)))
+
+    with open(prom_file + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(prom_file + '.tmp', prom_file)
+
+def prom_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(k + '="' + v.replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels) + '}'
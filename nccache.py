@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+import contextlib
+import requests
+import metrics
+from datetime import datetime
+
+#Persistent cache of the CHIRPS NetCDF files, shared by all runs.
+#Files are stored once by content (objects/<sha256>.nc) and index.json maps every key
+#(e.g. 'corrected/2020.01', 'prelim/2021') to its file, ETag and Last-Modified.
+#Several processes (sharded runs) can use the cache at once: a key is downloaded by one
+#process at a time (lock file next to its partial file) and index.json is only changed under
+#index.lock. Without fcntl (Windows) the locks only hold between the threads of a process.
+CACHE_DIR = os.environ.get('NASAPCHIRPS_CACHE', os.path.expanduser('~/.cache/nasapchirps_dssat'))
+CACHE_MAX = int(os.environ.get('NASAPCHIRPS_CACHE_MAX', 100 * 2**30))  # Bytes kept before eviction.
+
+lock = threading.Lock()
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#Exclusive lock of the file path between processes while the with block runs.
+@contextlib.contextmanager
+def file_lock(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+#Index of the cache changed by update(index) under the locks of the threads and processes.
+def update_index(cache_dir, update):
+    with lock, file_lock(cache_dir + '/index.lock'):
+        index = load_index(cache_dir)
+        update(index)
+        save_index(cache_dir, index)
+
+def load_index(cache_dir):
+    try:
+        with open(cache_dir + '/index.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+#The index is written to a temporary file and then renamed, so it is never left half written.
+def save_index(cache_dir, index):
+    with open(cache_dir + '/index.json.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(cache_dir + '/index.json.tmp', cache_dir + '/index.json')
+
+def obj_path(cache_dir, sha):
+    return cache_dir + '/objects/' + sha + '.nc'
+
+#A cached file is used only if it is there with the size it was stored with.
+def valid_entry(cache_dir, entry):
+    path = obj_path(cache_dir, entry['sha256'])
+    return os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+#Hard link (or copy if the cache is on another file system) a cached file into the run directory.
+def link_file(src, out_file):
+    if not os.path.exists(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    try:
+        os.link(src, out_file)
+    except OSError:
+        shutil.copy2(src, out_file)
+
+#Removes the least recently used files until the cache is below max_size bytes.
+def evict(cache_dir, index, max_size, keep=None):
+    sizes = {}
+    for key, e in index.items():
+        sizes[e['sha256']] = e['size']
+    total = sum(sizes.values())
+
+    for key in sorted(index, key=lambda k: index[k]['used']):
+        if total <= max_size:
+            break
+        if key == keep or (keep in index and index[key]['sha256'] == index[keep]['sha256']):
+            continue
+        sha = index.pop(key)['sha256']
+        if sha not in [e['sha256'] for e in index.values()]:
+            if os.path.exists(obj_path(cache_dir, sha)):
+                os.remove(obj_path(cache_dir, sha))
+            total -= sizes[sha]
+            print('Evicted', key, 'from the CHIRPS cache.')
+
+#Streams url into the partial file part, resuming a previous partial download with a Range
+#request (If-Range makes the server send the whole file again if it changed meanwhile).
+#Interrupted transfers are resumed up to retries times. Returns the response, or None when
+#the server answered 304 Not Modified to the conditional headers.
+def stream_file(s, url, part, name, headers=None, retries=3):
+    for attempt in range(retries + 1):
+        req_headers = dict(headers or {})
+        if os.path.exists(part) and os.path.exists(part + '.json'):
+            with open(part + '.json', 'r') as f:
+                validator = json.load(f).get('validator')
+            if validator and not validator.startswith('W/'):
+                req_headers['Range'] = 'bytes=' + str(os.path.getsize(part)) + '-'
+                req_headers['If-Range'] = validator
+
+        try:
+            response = s.get(url, headers=req_headers, timeout=80, stream=True)
+            metrics.count('http_responses', source='chirps', code=response.status_code)
+            try:
+                if response.status_code == 304:
+                    return None
+                if response.status_code == 416:  # The partial file is not valid anymore.
+                    os.remove(part)
+                    metrics.count('http_retries', source='chirps')
+                    continue
+                response.raise_for_status()
+
+                if response.status_code == 206:
+                    mode = 'ab'
+                    done = os.path.getsize(part)
+                    print(name, 'resuming download at', round(done / 2**20, 1), 'MB.')
+                else:
+                    mode = 'wb'
+                    done = 0
+                    with open(part + '.json', 'w') as f:
+                        json.dump({'url': url, 'validator': response.headers.get('ETag') or
+                                   response.headers.get('Last-Modified')}, f)
+                total = done + int(response.headers.get('Content-Length', 0))
+
+                #Write the file in chunks, reporting progress every 10 seconds.
+                start = last = time.time()
+                got = 0
+                with open(part, mode) as f:
+                    for chunk in response.iter_content(chunk_size=2**20):
+                        f.write(chunk)
+                        got += len(chunk)
+                        metrics.count('download_bytes', len(chunk), source='chirps')
+                        if time.time() - last >= 10:
+                            last = time.time()
+                            print(name, round((done + got) / 2**20, 1), 'of', round(total / 2**20, 1), 'MB,',
+                                  round(got / 2**20 / (last - start), 2), 'MB/s')
+                elapsed = max(time.time() - start, 1e-6)
+                metrics.count('download_seconds', elapsed, source='chirps')
+                if response.headers.get('Content-Length') and os.path.getsize(part) != total:
+                    raise requests.exceptions.ChunkedEncodingError(name + ' is not complete.')
+                print(name, 'downloaded', round(got / 2**20, 1), 'MB in', round(elapsed, 1), 's (',
+                      round(got / 2**20 / elapsed, 2), 'MB/s).')
+                return response
+            finally:
+                response.close()  # Close the connection with the server.
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout):
+            if attempt == retries:
+                raise
+            metrics.count('http_retries', source='chirps')
+            print(name, 'download interrupted, resuming...')
+
+    raise requests.exceptions.RetryError('Could not download ' + url)
+
+#Gets the file of url into out_file through the cache.
+#Without revalidate a cached file is used as it is (corrected CHIRPS never changes); with
+#revalidate the server is asked with If-None-Match/If-Modified-Since and the file is only
+#downloaded again when it changed (preliminary CHIRPS). Returns True if it was downloaded.
+#transform(src, dst) is applied to the downloaded file before it is stored (e.g. to crop it),
+#so only its result is kept in the cache; key must then identify the transformation too.
+def cache_get(s, url, key, out_file, revalidate=False, cache_dir=None, max_size=None, transform=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_size is None:
+        max_size = CACHE_MAX
+    os.makedirs(cache_dir + '/objects', exist_ok=True)
+    os.makedirs(cache_dir + '/partial', exist_ok=True)
+
+    #One process at a time downloads a key; the others wait and then find it in the cache.
+    part = cache_dir + '/partial/' + key.replace('/', '_') + '.part'
+    with file_lock(part + '.lock'):
+        with lock:
+            entry = load_index(cache_dir).get(key)
+        if entry is not None and not valid_entry(cache_dir, entry):
+            entry = None
+
+        headers = {}
+        if entry is not None:
+            if not revalidate:
+                link_file(obj_path(cache_dir, entry['sha256']), out_file)
+                touch(cache_dir, key)
+                return False
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = stream_file(s, url, part, os.path.basename(out_file), headers)
+        if response is None:
+            link_file(obj_path(cache_dir, entry['sha256']), out_file)
+            touch(cache_dir, key)
+            return False
+
+        #The transformed file is written next to the partial file, whose validator is dropped before
+        #the partial file itself, so an interrupted run never resumes the download onto a crop.
+        done = part
+        if transform is not None:
+            done = part + '.nc'
+            transform(part, done)
+            os.remove(part + '.json')
+            os.remove(part)
+
+        #Hash the complete file and move it into the cache.
+        sha = hashlib.sha256()
+        with open(done, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha.update(chunk)
+        sha = sha.hexdigest()
+        size = os.path.getsize(done)
+        os.replace(done, obj_path(cache_dir, sha))
+        if os.path.exists(part + '.json'):
+            os.remove(part + '.json')
+        link_file(obj_path(cache_dir, sha), out_file)
+
+        def add(index):
+            index[key] = {'url': url, 'sha256': sha, 'size': size, 'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified'),
+                          'used': datetime.now().isoformat()}
+            evict(cache_dir, index, max_size, keep=key)
+        update_index(cache_dir, add)
+    return True
+
+#Records the last use of a cached file for the eviction order.
+def touch(cache_dir, key):
+    def used(index):
+        if key in index:
+            index[key]['used'] = datetime.now().isoformat()
+    update_index(cache_dir, used)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import queue
+import threading
+from multiprocessing import Pool
+import pandas as pd
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import precstore
+from chirps import correc_jobs, prelim_jobs, download_nc, download_holes, plan_chirps, read_points, extract_file
+from getnasap import get_data, write_failed, cell_groups, wth_shard, count_shards
+
+#Streaming version of dssat_wth: NASA POWER and CHIRPS are downloaded at the same time, every
+#CHIRPS file is extracted as soon as it lands (in date order, as the store only appends) and
+#the WTH files of a NASA POWER cell are written as soon as its file is in and the CHIRPS store
+#is complete. The CHIRPS files go through a bounded queue, so the downloads wait when the
+#extraction falls behind.
+QUEUE_SIZE = 4  # CHIRPS files downloaded and waiting for the extraction.
+SHARD_CELLS = 64  # NASA POWER cells per write job.
+
+#Downloads the corrected CHIRPS months, then the preliminary years after the last corrected
+#month, into the files queue: ('jobs', list) before every batch, then ('done', file, ok) for
+#every file and None at the end. Returns the last corrected day in state['corr_last'].
+def chirps_download(dt_s, dt_e, tempdir, bbox, files, state):
+    def landed(job, ok):
+        files.put(('done', job[3], ok))
+
+    try:
+        jobs = correc_jobs(dt_s, dt_e, tempdir + '/in_nc_cor')
+        files.put(('jobs', jobs))
+        failed = download_nc(jobs, bbox=bbox, done=landed)
+        if download_holes(jobs, failed):
+            raise RuntimeError('corrected CHIRPS file(s) missing before the last one published')
+        failed = set(name for name, reason in failed)
+
+        #Day after the last corrected month downloaded.
+        months = [datetime.strptime(job[0][12:18], '%Y%m') for job in jobs if job[0] not in failed]
+        dt_s_p = dt_s if not months else max(months) + relativedelta(months=+1)
+        state['corr_last'] = None if not months else dt_s_p - timedelta(days=1)
+
+        if dt_s_p < dt_e:
+            jobs = prelim_jobs(dt_s_p, dt_e, tempdir + '/in_nc_pre')
+            files.put(('jobs', jobs))
+            if download_holes(jobs, download_nc(jobs, bbox=bbox, done=landed)):
+                raise RuntimeError('preliminary CHIRPS file(s) missing before the last one published')
+    except Exception as err:
+        print('CHIRPS download stopped:', err)
+        state['error'] = err
+    finally:
+        files.put(None)
+
+#Extracts the CHIRPS files from the queue into the store outprec, in the order of the jobs.
+#After an error the queue is still emptied, so the downloads do not wait forever.
+def chirps_extract(in_file, outprec, files, state):
+    id, lat, lon = read_points(in_file)
+    precstore.create(outprec, id)
+    order = []
+    status = {}
+    plan = None
+    i = 0
+    while True:
+        item = files.get()
+        if item is None:
+            break
+        if item[0] == 'jobs':
+            order += [job[3] for job in sorted(item[1])]
+        else:
+            status[item[1]] = item[2]
+
+        while i < len(order) and order[i] in status:
+            if status[order[i]] and 'error' not in state:
+                try:
+                    if plan is None:
+                        plan = plan_chirps(in_file, os.path.dirname(order[i]), nc_lst=[os.path.basename(order[i])])
+                    extract_file(order[i], outprec, lat, lon, plan['max_gap'], plan['max_rows'], plan['max_mem'])
+                    print(os.path.basename(order[i]), 'extracted.')
+                except BaseException as err:
+                    print('CHIRPS extraction stopped at', os.path.basename(order[i]))
+                    state['error'] = err
+            i += 1
+    if 'error' not in state:
+        print('CHIRPS processing data are complete.')
+
+#Writes the WTH files of the NASA POWER cells from the ready queue (None at the end) with
+#the pool of workers, in shards of up to SHARD_CELLS cells.
+def wth_write(pool, groups, ready, nasa_outdir, outprec, out_dir):
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    results = []
+    end = False
+    while not end:
+        cells = [ready.get()]
+        while True:  # Everything ready at this moment goes in the same batch.
+            try:
+                cells.append(ready.get_nowait())
+            except queue.Empty:
+                break
+        if None in cells:
+            end = True
+            cells = [c for c in cells if c is not None]
+        shard = [(c, groups[c]) for c in cells if c in groups]
+        for n in range(0, len(shard), SHARD_CELLS):
+            results.append(pool.apply_async(wth_shard, ((shard[n:n + SHARD_CELLS], nasa_outdir, out_dir, outprec),)))
+    times = [r.get() for r in results]
+    count_shards(times)
+    print(sum(t[1] for t in times), "WTH files written in", len(times), "shard(s).")
+
+#Runs get with the stages overlapped. Returns the last corrected CHIRPS day (datetime).
+def dssat_stream(in_file, startDate, endDate, tempdir, out_dir, bbox=None, workers=None):
+    dt_s = datetime.strptime(str(startDate), '%Y%m%d')
+    dt_e = datetime.strptime(str(endDate), '%Y%m%d')
+    nasa_outdir = tempdir + '/nasap'
+    outprec = tempdir + '/prec'
+    groups = cell_groups(pd.read_csv(in_file))
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    #The worker processes are started before the threads, so they are not forked from them.
+    pool = Pool(workers)
+
+    #NASA POWER: the cells are queued for writing as their files are done.
+    ready = queue.Queue()
+    power = {}
+    def get_power():
+        try:
+            power['failed'] = get_data(in_file, str(startDate), str(endDate), nasa_outdir, done=ready.put)
+        finally:
+            power.setdefault('failed', None)
+            ready.put(None)
+
+    #CHIRPS: downloads and extraction.
+    files = queue.Queue(QUEUE_SIZE)
+    state = {}
+    threads = [threading.Thread(target=get_power),
+               threading.Thread(target=chirps_download, args=(dt_s, dt_e, tempdir, bbox, files, state)),
+               threading.Thread(target=chirps_extract, args=(in_file, outprec, files, state))]
+    for t in threads:
+        t.start()
+
+    #The WTH files need the whole CHIRPS series, so the writing starts when it is extracted.
+    threads[1].join()
+    threads[2].join()
+    if 'error' in state:
+        threads[0].join()
+        pool.terminate()
+        print('Program terminated. The CHIRPS data could not be processed.')
+        sys.exit(1)
+    wth_write(pool, groups, ready, nasa_outdir, outprec, out_dir)
+    threads[0].join()
+    pool.close()
+    pool.join()
+
+    failed = power['failed']
+    if failed is None:
+        print('Program terminated. The NASA POWER download stopped.')
+        sys.exit(1)
+    if failed:
+        write_failed(in_file, str(startDate), str(endDate), failed)
+        print('Program terminated. Please check manually NASAPOWER server response.')
+        sys.exit(1)
+    print("All requested data were downloaded successfully.")
+    return state.get('corr_last')
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import time
+import random
+import logging
+import threading
+import requests
+import metrics
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#Client for the NASA POWER point requests with a rate limit and adaptive concurrency.
+POWER_URL = os.environ.get('NASAPCHIRPS_POWER_URL', 'https://power.larc.nasa.gov/api/temporal/daily/point')
+THROTTLE = (429, 502, 503, 504)  # Status codes telling the server is overloaded.
+
+#Token bucket: up to burst requests at once, then rate requests per second.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+#Seconds to wait from a Retry-After header (seconds or HTTP date), None if not given.
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+#Errors worth queueing the request again: throttling, connection errors and timeouts. Other
+#HTTP errors (e.g. 400 for a point out of range) fail the same way every time.
+def retryable(err):
+    if isinstance(err, requests.exceptions.HTTPError):
+        return err.response is not None and err.response.status_code in THROTTLE
+    return isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+#Runs the requests in a pool of max_workers threads, but only `limit` of them are sent at
+#the same time: the limit grows by one after `limit` successes in a row and is halved when
+#the server throttles (429/5xx). Throttled and failed requests are retried with exponential
+#backoff and jitter, honouring Retry-After.
+class PowerClient:
+    def __init__(self, url=POWER_URL, workers=5, max_workers=16, rate=5.0, retries=8, backoff=1.0,
+                 max_backoff=120.0, timeout=80):
+        self.url = url
+        self.limit = workers
+        self.max_workers = max(workers, max_workers)
+        self.bucket = TokenBucket(rate, max(1, workers))
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.active = 0
+        self.ok = 0
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.latency = []
+        self.errors = {}
+
+    def session(self):
+        if not hasattr(self.local, 's'):
+            self.local.s = requests.Session()
+        return self.local.s
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, throttled):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.ok = 0
+                logging.info("Server throttling, concurrency reduced to %s", self.limit)
+            else:
+                self.ok += 1
+                if self.ok >= self.limit and self.limit < self.max_workers:
+                    self.limit += 1
+                    self.ok = 0
+            self.cond.notify_all()
+
+    def count_error(self, reason):
+        with self.cond:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    #Sends one request and returns the response text. Raises the last error when the
+    #retries are exhausted, or right away for a client error (4xx other than 429).
+    def get(self, params):
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            self.acquire()
+            t0 = time.monotonic()
+            response = None
+            try:
+                response = self.session().get(self.url, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as err:
+                error = err
+                reason = type(err).__name__
+            finally:
+                throttled = response is None or response.status_code in THROTTLE
+                self.release(throttled)
+                with self.cond:
+                    self.latency.append(time.monotonic() - t0)
+
+            if response is not None:
+                metrics.count('http_responses', source='power', code=response.status_code)
+                if response.ok:
+                    metrics.count('download_bytes', len(response.content), source='power')
+                    metrics.count('download_seconds', time.monotonic() - t0, source='power')
+                    return response.text
+                reason = 'HTTP ' + str(response.status_code)
+                try:
+                    response.raise_for_status()
+                except requests.exceptions.HTTPError as err:
+                    error = err
+                if response.status_code not in THROTTLE:
+                    self.count_error(reason)
+                    raise error
+            self.count_error(reason)
+
+            if attempt < self.retries:
+                metrics.count('http_retries', source='power')
+                wait = retry_after(response) if response is not None else None
+                if wait is None:
+                    wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+                    wait = random.uniform(wait / 2, wait)  # Jitter
+                logging.info("%s, retrying in %.1f s", reason, wait)
+                time.sleep(wait)
+        raise error
+
+    #Runs the (id, params) jobs and calls callback(id, params, text) for every response.
+    #A job failed by a retryable error goes back to the end of the queue of the same pool until
+    #it has been tried attempts times. Returns the jobs that failed for good as (id, params,
+    #attempts, error).
+    def run(self, jobs, callback, attempts=3):
+        failed = []
+
+        def work(job):
+            text = self.get(job[1])
+            callback(job[0], job[1], text)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {pool.submit(work, job): (job, 1) for job in jobs}
+            while pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, n = pending.pop(future)
+                    err = future.exception()
+                    if err is None:
+                        continue
+                    if n < attempts and retryable(err):
+                        logging.info("Error in point %s (%s), attempt %s of %s queued", job[0], err, n + 1, attempts)
+                        pending[pool.submit(work, job)] = (job, n + 1)
+                    else:
+                        logging.info("Error in point %s: %s", job[0], err)
+                        failed.append((job[0], job[1], n, err))
+        return failed
+
+    #Prints the number of requests, their latency and the errors by type.
+    def summary(self):
+        with self.cond:
+            lat = sorted(self.latency)
+            errors = dict(self.errors)
+        if lat:
+            print("NASA POWER requests:", len(lat), "| latency mean", round(sum(lat) / len(lat), 2), "s, p95",
+                  round(lat[int(0.95 * (len(lat) - 1))], 2), "s | final concurrency", self.limit)
+        if errors:
+            print("NASA POWER errors:", ", ".join(k + ": " + str(v) for k, v in sorted(errors.items())))
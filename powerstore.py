@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from nccache import CACHE_DIR
+
+#Local store of the daily NASA POWER records already downloaded, per nasapid (SQLite).
+#A request only asks the API for the dates missing in the store, and the ICASA file of
+#a point is then written back from the stored header and rows. NASA POWER computes TAV and
+#AMP of the header over the period requested, so the header is kept with its period and the
+#values are computed again from the rows when a file is written for another period.
+STORE_FILE = os.environ.get('NASAPCHIRPS_POWER_STORE', CACHE_DIR + '/power.sqlite')
+SETTLE_DAYS = 90  # Days after which a record with missing values is not requested again.
+MAX_RANGES = 5  # Above this number of gaps, the whole span between them is requested at once.
+SRAD_MISSING = ('nan', '-99', '-99.0', '-3596.4')  # Missing SRAD for the quality control (getnasap.py).
+MISSING = SRAD_MISSING + ('-999', '-999.0')
+TIMEOUT = 60  # Seconds waiting for another process writing to the store (sharded runs).
+RETRIES = 5  # Writes tried again after that while the store is locked.
+
+lock = threading.Lock()
+
+def open_store(store_file=None):
+    if store_file is None:
+        store_file = STORE_FILE
+    if not os.path.exists(os.path.dirname(store_file)):
+        os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    con = sqlite3.connect(store_file, timeout=TIMEOUT, check_same_thread=False)
+    con.execute('CREATE TABLE IF NOT EXISTS header (nasapid TEXT PRIMARY KEY, text TEXT, start TEXT, stop TEXT)')
+    if 'start' not in [c[1] for c in con.execute('PRAGMA table_info(header)')]:  # Store of a previous version
+        con.execute('ALTER TABLE header ADD COLUMN start TEXT')
+        con.execute('ALTER TABLE header ADD COLUMN stop TEXT')
+    con.execute('CREATE TABLE IF NOT EXISTS rows (nasapid TEXT, date INTEGER, line TEXT, settled INTEGER, '
+                'PRIMARY KEY (nasapid, date)) WITHOUT ROWID')
+    con.commit()
+    return con
+
+#Date ranges ('YYYYMMDD', 'YYYYMMDD') between startDate and endDate still to be requested.
+def missing_ranges(con, nasapid, startDate, endDate):
+    dt_s = datetime.strptime(startDate, '%Y%m%d')
+    dt_e = datetime.strptime(endDate, '%Y%m%d')
+    n_days = (dt_e - dt_s).days + 1
+    with lock:
+        dates = con.execute('SELECT date FROM rows WHERE nasapid = ? AND date BETWEEN ? AND ? AND settled = 1',
+                            (nasapid, int(dt_s.strftime('%Y%j')), int(dt_e.strftime('%Y%j')))).fetchall()
+    if len(dates) == n_days:
+        return []
+    if not dates:
+        return [(startDate, endDate)]
+
+    dates = set(d[0] for d in dates)
+    ranges = []
+    for n in range(n_days):
+        dt = dt_s + timedelta(days=n)
+        if int(dt.strftime('%Y%j')) not in dates:
+            if ranges and ranges[-1][1] == dt - timedelta(days=1):
+                ranges[-1][1] = dt
+            else:
+                ranges.append([dt, dt])
+
+    if len(ranges) > MAX_RANGES:
+        ranges = [[ranges[0][0], ranges[-1][1]]]
+    return [(r[0].strftime('%Y%m%d'), r[1].strftime('%Y%m%d')) for r in ranges]
+
+#Stores an ICASA response for startDate to endDate: the header (13 first non empty lines) and
+#one row per date. The header stored is the one of the widest period requested.
+def put_text(con, nasapid, text, startDate=None, endDate=None):
+    data = [line.rstrip() for line in text.splitlines() if line.strip()]
+    settle = int((datetime.today() - timedelta(days=SETTLE_DAYS)).strftime('%Y%j'))
+    rows = []
+    for line in data[13:]:
+        r = line.split()
+        date = int(r[0])
+        settled = 1 if date < settle or not any(v in MISSING for v in r[1:]) else 0
+        rows.append((nasapid, date, line, settled))
+
+    #The store may be locked by the processes of other shards for longer than TIMEOUT.
+    for attempt in range(RETRIES + 1):
+        try:
+            with lock:
+                old = con.execute('SELECT start, stop FROM header WHERE nasapid = ?', (nasapid,)).fetchone()
+                if (old is None or old[0] is None or
+                        (startDate is not None and startDate <= old[0] and endDate >= old[1])):
+                    con.execute('INSERT OR REPLACE INTO header VALUES (?, ?, ?, ?)',
+                                (nasapid, '\n'.join(data[:13]), startDate, endDate))
+                con.executemany('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)', rows)
+                con.commit()
+            return
+        except sqlite3.OperationalError as err:
+            with lock:
+                con.rollback()
+            if 'locked' not in str(err) or attempt == RETRIES:
+                raise
+            print('NASA POWER store locked, writing', nasapid, 'again...')
+            time.sleep(1 + attempt)
+
+#Writes the ICASA file of a point for startDate to endDate from the store.
+#Returns False when the point has never been downloaded.
+def write_wth(con, nasapid, startDate, endDate, path):
+    dt_s = datetime.strptime(startDate, '%Y%m%d').strftime('%Y%j')
+    dt_e = datetime.strptime(endDate, '%Y%m%d').strftime('%Y%j')
+    with lock:
+        hdr = con.execute('SELECT text, start, stop FROM header WHERE nasapid = ?', (nasapid,)).fetchone()
+        rows = con.execute('SELECT line FROM rows WHERE nasapid = ? AND date BETWEEN ? AND ? ORDER BY date',
+                           (nasapid, int(dt_s), int(dt_e))).fetchall()
+    if hdr is None:
+        return False
+
+    text = hdr[0]
+    if (hdr[1], hdr[2]) != (startDate, endDate):
+        text = period_header(text, [r[0] for r in rows], startDate, endDate)
+    with open(path, "w", newline='') as f:
+        f.write(text + '\n' + ''.join(r[0] + '\n' for r in rows))
+    return True
+
+#Header of the period startDate to endDate from a header of another period: the dates of the
+#period and its TAV and AMP, computed from the rows. TAV is the mean T2M of the period and AMP
+#the difference between its warmest and coldest monthly mean T2M, as in the DSSAT files.
+def period_header(text, rows, startDate, endDate):
+    t2m = {}
+    for line in rows:
+        r = line.split()
+        if r[1] not in MISSING:
+            t2m.setdefault(datetime.strptime(r[0], '%Y%j').month, []).append(float(r[1]))
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith('Dates'):
+            dates = iter([startDate, endDate])
+            lines[i] = re.sub(r'\d{2}/\d{2}/\d{4}|\d{8}', lambda m: period_date(m.group(0), next(dates, None)), line)
+    if t2m and len(lines) > 11:
+        months = [sum(v) / len(v) for v in t2m.values()]
+        tav = sum(sum(v) for v in t2m.values()) / sum(len(v) for v in t2m.values())
+        lines[11] = set_field(set_field(lines[11], 4, '{:.1f}'.format(tav)), 5, '{:.1f}'.format(max(months) - min(months)))
+    return '\n'.join(lines)
+
+#A date of the header line (MM/DD/YYYY or YYYYMMDD) replaced with day ('YYYYMMDD').
+def period_date(old, day):
+    if day is None:
+        return old
+    if '/' in old:
+        return datetime.strptime(day, '%Y%m%d').strftime('%m/%d/%Y')
+    return day
+
+#Replaces the field n (from 0) of a fixed-width line, keeping the end of the field in place.
+def set_field(line, n, value):
+    spans = [m.span() for m in re.finditer(r'\S+', line)]
+    if n >= len(spans):
+        return line
+    a = spans[n - 1][1] if n else 0
+    b = spans[n][1]
+    return line[:a] + (' ' + value).rjust(b - a) + line[b:]
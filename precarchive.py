@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import shutil
+import numpy
+import pandas as pd
+from datetime import datetime, timedelta
+import metrics
+import precstore
+from precstore import load_meta, save_meta, NODATA
+from chirps import load_gdal, correc_jobs, download_nc, nc_times, read_points, pt_offsets
+
+#Precipitation archive: the corrected CHIRPS data of a region kept point-major, so the long
+#series of a few points are read without opening the monthly NetCDF files. The region (a
+#bounding box on the CHIRPS grid) is split in square tiles of `tile` degrees and the days in
+#chunks of CHUNK_DAYS days; every tile and chunk is a raw float32 matrix (tile pixels x chunk
+#days, <tile_row>_<tile_col>/<chunk>.f32) where the days of a pixel are contiguous. A series of
+#40 years is then a few contiguous reads per point. meta.json has the grid, the first date
+#and the number of days (and the pixel size of the files, from the first ingest); new months
+#are appended with ingest, as in the precipitation store.
+CHUNK_DAYS = 3650  # About 10 years per chunk file.
+RES = 0.05  # CHIRPS p05 grid
+
+def create(archive, bbox, tile=1.0, chunk_days=CHUNK_DAYS):
+    if not os.path.exists(archive):
+        os.makedirs(archive)
+    cols = int(round((bbox[2] - bbox[0]) / RES))
+    rows = int(round((bbox[3] - bbox[1]) / RES))
+    save_meta(archive, {'bbox': list(bbox), 'res': RES, 'rows': rows, 'cols': cols,
+                        'tile_cells': max(1, int(round(tile / RES))), 'chunk_days': chunk_days,
+                        'start': None, 'n_days': 0})
+
+#Geotransformation of the archive grid. The pixel size is the one of the CHIRPS files ingested
+#(float32 coordinates, slightly off 0.05), so the points fall on the pixels they get from the
+#files, also on the edge of a pixel.
+def archive_gt(meta):
+    px_w, px_h = meta.get('pixel', (meta['res'], -meta['res']))
+    return (meta['bbox'][0], px_w, 0.0, meta['bbox'][3], 0.0, px_h)
+
+#Tiles (rows, columns) of the grid.
+def n_tiles(meta):
+    tc = meta['tile_cells']
+    return -(-meta['rows'] // tc), -(-meta['cols'] // tc)
+
+#Opens the matrix of a tile and chunk memory-mapped. With create, a missing file is made
+#full of NODATA; otherwise None is returned for it (no data ingested there).
+def open_chunk(archive, meta, ty, tx, c, create=False):
+    chunk_file = archive + '/' + str(ty) + '_' + str(tx) + '/' + str(c) + '.f32'
+    shape = (meta['tile_cells'] ** 2, meta['chunk_days'])
+    if not os.path.exists(chunk_file):
+        if not create:
+            return None
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+        empty = numpy.full(shape[1], NODATA, dtype=numpy.float32).tobytes()
+        with open(chunk_file + '.tmp', 'wb') as f:
+            for n in range(shape[0]):
+                f.write(empty)
+        os.replace(chunk_file + '.tmp', chunk_file)
+    return numpy.memmap(chunk_file, dtype=numpy.float32, mode='r+' if create else 'r', shape=shape)
+
+#Last date in the archive, None if it is empty.
+def last_date(archive):
+    meta = load_meta(archive)
+    if meta['n_days'] == 0:
+        return None
+    return datetime.strptime(meta['start'], '%Y%j') + timedelta(days=meta['n_days'] - 1)
+
+#Appends the days of a CHIRPS NetCDF file to the archive. Days already in the archive are
+#skipped and missing days in between stay NODATA, as in precstore.append. The file is read
+#once, band by band over the window of the region, and every tile gets the new days of its
+#pixels. Returns the number of days added.
+def ingest_file(archive, nc_file):
+    meta = load_meta(archive)
+    gdal = load_gdal()
+    dsi = gdal.Open(nc_file, gdal.GA_ReadOnly)
+    if dsi is None:
+        print('Could not open NetCDF file')
+        sys.exit(1)
+
+    dates = pd.to_datetime(nc_times(dsi), format='%Y%j')
+    if meta['start'] is None:
+        meta['start'] = dates.min().strftime('%Y%j')
+    off = (dates - datetime.strptime(meta['start'], '%Y%j')).days.to_numpy()
+    keep = numpy.flatnonzero(off >= meta['n_days'])  # Only days after the last one stored
+    if not len(keep):
+        dsi = None
+        return 0
+
+    #Window of the region in the file (the file may be a crop of the global grid).
+    gt = dsi.GetGeoTransform()
+    if abs(gt[1] - meta['res']) > 1e-6 or abs(-gt[5] - meta['res']) > 1e-6:
+        print('The resolution of', os.path.basename(nc_file), 'is not the one of the archive.')
+        sys.exit(1)
+    meta.setdefault('pixel', [gt[1], gt[5]])
+    x0 = int(round((meta['bbox'][0] - gt[0]) / gt[1]))
+    y0 = int(round((meta['bbox'][3] - gt[3]) / gt[5]))
+    fx0, fx1 = max(0, x0), min(dsi.RasterXSize, x0 + meta['cols'])
+    fy0, fy1 = max(0, y0), min(dsi.RasterYSize, y0 + meta['rows'])
+
+    tc = meta['tile_cells']
+    tiles_y, tiles_x = n_tiles(meta)
+    grid = numpy.full((len(keep), tiles_y * tc, tiles_x * tc), NODATA, dtype=numpy.float32)
+    if fx0 < fx1 and fy0 < fy1:
+        for j, i in enumerate(keep):
+            d = dsi.GetRasterBand(int(i) + 1).ReadAsArray(fx0, fy0, fx1 - fx0, fy1 - fy0)
+            if d is not None:
+                grid[j, fy0 - y0:fy1 - y0, fx0 - x0:fx1 - x0] = d
+        metrics.count('gdal_band_reads', len(keep))
+    dsi = None  # Close the file
+
+    #Pixels x days of every tile, written in the chunks of the days.
+    cd = meta['chunk_days']
+    chunk = off[keep] // cd
+    for ty in range(tiles_y):
+        for tx in range(tiles_x):
+            block = grid[:, ty * tc:(ty + 1) * tc, tx * tc:(tx + 1) * tc].reshape(len(keep), tc * tc).T
+            for c in numpy.unique(chunk):
+                sel = numpy.flatnonzero(chunk == c)
+                mm = open_chunk(archive, meta, ty, tx, int(c), create=True)
+                mm[:, off[keep][sel] - c * cd] = block[:, sel]
+                mm.flush()
+                del mm
+
+    added = int(off[keep].max()) + 1 - meta['n_days']
+    meta['n_days'] += added
+    save_meta(archive, meta)
+    return added
+
+#Downloads the corrected CHIRPS months from startDate (or the day after the last one in the
+#archive) to endDate, cropped to the region, and appends them to the archive, a year at a
+#time. A new archive needs bbox (min lon, min lat, max lon, max lat, on whole degrees).
+#The ingest stops at the first month not published yet, so the archive has no gaps.
+def ingest(archive, startDate, endDate, bbox=None, tile=1.0, chunk_days=CHUNK_DAYS):
+    s1 = datetime.now()
+    if not os.path.exists(archive + '/meta.json'):
+        if bbox is None:
+            print('A new archive needs the bounding box of its region (--bbox).')
+            sys.exit(1)
+        create(archive, [float(c) for c in bbox], tile, chunk_days)
+    elif bbox is not None and [float(c) for c in bbox] != load_meta(archive)['bbox']:
+        print('The archive', archive, 'has another region:', load_meta(archive)['bbox'])
+        sys.exit(1)
+    #Metrics of the ingest in the archive directory, once it exists.
+    metrics.start(archive + '/metrics.jsonl', 'ingest')
+    meta = load_meta(archive)
+
+    dt_s = datetime.strptime(str(startDate), '%Y%m%d')
+    dt_e = datetime.strptime(str(endDate), '%Y%m%d')
+    last = last_date(archive)
+    if last is not None:
+        dt_s = max(dt_s, last + timedelta(days=1))
+
+    incoming = archive + '/incoming'
+    added = 0
+    stop = False
+    year = dt_s
+    while year <= dt_e and not stop:
+        year_e = min(dt_e, datetime(year.year, 12, 31))
+        metrics.stage('download')
+        jobs = correc_jobs(year, year_e, incoming)
+        failed = set(name for name, reason in download_nc(jobs, bbox=meta['bbox']))
+        metrics.stage('ingest')
+        for job in sorted(jobs):
+            if job[0] in failed:
+                print(job[0], 'not available, the archive ends before it.')
+                stop = True
+                break
+            added += ingest_file(archive, job[3])
+            print(job[0], 'ingested.')
+        shutil.rmtree(incoming, ignore_errors=True)
+        year = datetime(year.year + 1, 1, 1)
+
+    last = last_date(archive)
+    print(added, 'day(s) added to the archive,', 'empty.' if last is None else 'last day ' + last.strftime('%Y-%m-%d') + '.')
+    metrics.finish()
+    print("Time of execution for the ingest is: ", str(datetime.now() - s1))
+
+#Fills the precipitation store outprec (created here) with the series of the points in in_file
+#from dt_s to dt_e (datetime), or up to the last day of the archive. Reads, for every chunk of
+#days and tile holding points, the rows of their pixels. Returns the last day filled, or None
+#when the archive does not cover the points or the start of the period (the store is not
+#created then, and CHIRPS is read from the NetCDF files as without archive).
+def extract(archive, in_file, outprec, dt_s, dt_e):
+    meta = load_meta(archive)
+    id, lat, lon = read_points(in_file)
+    px, py = pt_offsets(archive_gt(meta), lat, lon)
+    inside = (px >= 0) & (px < meta['cols']) & (py >= 0) & (py < meta['rows'])
+    if meta['start'] is None or not inside.all():
+        print('The archive does not cover all the points.')
+        return None
+    start = datetime.strptime(meta['start'], '%Y%j')
+    if start > dt_s:
+        print('The archive starts after ' + dt_s.strftime('%Y-%m-%d') + '.')
+        return None
+
+    r0 = (dt_s - start).days
+    r1 = min(meta['n_days'], (dt_e - start).days + 1)
+    if r1 <= r0:
+        print('The archive ends before ' + dt_s.strftime('%Y-%m-%d') + '.')
+        return None
+
+    precstore.create(outprec, id)
+    tc = meta['tile_cells']
+    cd = meta['chunk_days']
+    tile = (py // tc) * n_tiles(meta)[1] + px // tc
+    pix = (py % tc) * tc + px % tc
+    for c in range(r0 // cd, (r1 - 1) // cd + 1):
+        a = max(r0, c * cd)
+        b = min(r1, (c + 1) * cd)
+        values = numpy.full((b - a, len(id)), NODATA, dtype=numpy.float32)
+        for t in numpy.unique(tile):
+            sel = numpy.flatnonzero(tile == t)
+            mm = open_chunk(archive, meta, int(t) // n_tiles(meta)[1], int(t) % n_tiles(meta)[1], c)
+            if mm is not None:
+                values[:, sel] = mm[pix[sel], a - c * cd:b - c * cd].T
+                del mm
+        precstore.append(outprec, [(start + timedelta(days=n)).strftime('%Y%j') for n in range(a, b)], values)
+        metrics.count('archive_point_days', values.size)
+
+    last = start + timedelta(days=r1 - 1)
+    print('CHIRPS series of', len(id), 'points taken from the archive up to ' + last.strftime('%Y-%m-%d') + '.')
+    return last
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import json
+import numpy
+import pandas as pd
+from datetime import datetime, timedelta
+
+#Precipitation store: a directory with the CHIRPS values of all points as a raw float32
+#matrix (prec.f32) of one row per day and one column per ID, and meta.json with the IDs,
+#the first date and the number of days. Rows are consecutive days, so new days are appended
+#at the end of the file, and the matrix is opened memory-mapped and sliced by point and date
+#without loading it.
+NODATA = -9999.0
+
+def load_meta(store):
+    with open(store + '/meta.json', 'r') as f:
+        return json.load(f)
+
+#meta.json is written after the data and renamed into place, so an interrupted append is
+#simply overwritten by the next one.
+def save_meta(store, meta):
+    with open(store + '/meta.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(store + '/meta.json.tmp', store + '/meta.json')
+
+def create(store, ids):
+    if not os.path.exists(store):
+        os.makedirs(store)
+    open(store + '/prec.f32', 'wb').close()
+    save_meta(store, {'ids': [int(i) for i in ids], 'start': None, 'n_days': 0})
+
+#Appends the values (dates x IDs) of the dates given in '%Y%j' format. Dates already in the
+#store are skipped and missing days in between are filled with NODATA.
+#Returns the number of days added.
+def append(store, dates, values):
+    meta = load_meta(store)
+    n_ids = len(meta['ids'])
+    if not len(dates):
+        return 0
+    values = numpy.asarray(values, dtype=numpy.float32).reshape(len(dates), n_ids)
+    days = pd.to_datetime(list(dates), format='%Y%j')
+    if meta['start'] is None:
+        meta['start'] = days.min().strftime('%Y%j')
+
+    off = (days - datetime.strptime(meta['start'], '%Y%j')).days.to_numpy()
+    keep = numpy.flatnonzero(off >= meta['n_days'])  # Only days after the last one stored
+    if not len(keep):
+        return 0
+
+    n_days = int(off[keep].max()) + 1
+    block = numpy.full((n_days - meta['n_days'], n_ids), NODATA, dtype=numpy.float32)
+    block[off[keep] - meta['n_days']] = values[keep]
+    with open(store + '/prec.f32', 'r+b') as f:
+        f.seek(meta['n_days'] * n_ids * 4)
+        f.write(block.tobytes())
+        f.truncate()
+
+    added = n_days - meta['n_days']
+    meta['n_days'] = n_days
+    save_meta(store, meta)
+    return added
+
+#Opens the store lazily. Returns the IDs, the first date and the memory-mapped matrix (days x IDs).
+def open_prec(store):
+    meta = load_meta(store)
+    n_ids = len(meta['ids'])
+    if meta['n_days'] == 0:
+        return meta['ids'], None, numpy.empty((0, n_ids), dtype=numpy.float32)
+    prec = numpy.memmap(store + '/prec.f32', dtype=numpy.float32, mode='r', shape=(meta['n_days'], n_ids))
+    return meta['ids'], datetime.strptime(meta['start'], '%Y%j'), prec
+
+#Last date in the store, None if it is empty.
+def last_date(store):
+    meta = load_meta(store)
+    if meta['n_days'] == 0:
+        return None
+    return datetime.strptime(meta['start'], '%Y%j') + timedelta(days=meta['n_days'] - 1)
+
+#Slice of the store as a DataFrame (ID x '%Y%j' dates), as the old prec pickles, for some IDs
+#and a range of dates (datetime). Only the slice is read from disk.
+def read_prec(store, ids=None, dt_s=None, dt_e=None):
+    all_ids, start, prec = open_prec(store)
+    cols = numpy.arange(len(all_ids))
+    if ids is not None:
+        pos = {id: i for i, id in enumerate(all_ids)}
+        ids = [id for id in ids if id in pos]
+        cols = numpy.array([pos[id] for id in ids], dtype=int)
+    else:
+        ids = all_ids
+    if start is None:
+        return pd.DataFrame(index=pd.Index(ids, name='ID'))
+
+    r0 = 0 if dt_s is None else max(0, (dt_s - start).days)
+    r1 = len(prec) if dt_e is None else min(len(prec), (dt_e - start).days + 1)
+    r1 = max(r0, r1)
+    dates = [(start + timedelta(days=n)).strftime('%Y%j') for n in range(r0, r1)]
+    return pd.DataFrame(numpy.asarray(prec[r0:r1][:, cols]).T, index=pd.Index(ids, name='ID'), columns=dates)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import json
+import time
+import shutil
+import socket
+import threading
+import numpy
+import pandas as pd
+from datetime import datetime
+from multiprocessing import Process
+from wthindex import open_index, INDEX_FILE
+
+#Sharded runs for large input files. The points are split in spatial tiles of `tile` degrees,
+#each one with its own directory (shards/<tile>/pts.csv next to the input file), so every
+#shard has its own temp directory and a small CHIRPS window. Shards are claimed with a lock
+#file, so several processes, or several hosts sharing the file system, can run the same
+#command at once: every one takes the shards nobody else has taken. The results of the shards
+#are moved to out_dir when all of them are done, and manifest.json records their status.
+#A running shard touches its lock every HEARTBEAT seconds, so the lock of a process that was
+#killed (or of a host that was lost) is taken over by a later run once it is STALE seconds old,
+#or at once on the same host when its process is gone. A split whose shards were all merged is
+#a finished run: the next run removes it and splits the input file again.
+HEARTBEAT = 60
+STALE = 10 * HEARTBEAT
+
+#Splits in_file into the tiles of work_dir. A previous split of the same file is reused.
+def split_csv(in_file, work_dir, tile):
+    if os.path.exists(work_dir + '/shards.json'):
+        with open(work_dir + '/shards.json', 'r') as f:
+            split = json.load(f)
+        if split['in_file'] == os.path.abspath(in_file) and split['tile'] == tile:
+            return split['shards']
+        print('The directory', work_dir, 'has the shards of another input file or tile size.')
+        sys.exit(1)
+
+    pt = pd.read_csv(in_file)
+    lat0 = (numpy.floor(pt['Latitude'] / tile) * tile).round(4)
+    lon0 = (numpy.floor(pt['Longitude'] / tile) * tile).round(4)
+    shards = {}
+    for (lat, lon), group in pt.groupby([lat0, lon0]):
+        name = 'tile_{:+08.3f}_{:+09.3f}'.format(lat, lon)
+        os.makedirs(work_dir + '/' + name, exist_ok=True)
+        group.to_csv(work_dir + '/' + name + '/pts.csv.tmp', index=False)
+        os.replace(work_dir + '/' + name + '/pts.csv.tmp', work_dir + '/' + name + '/pts.csv')
+        shards[name] = len(group)
+
+    #Written last and renamed, so other hosts only see a complete split.
+    with open(work_dir + '/shards.json.tmp', 'w') as f:
+        json.dump({'in_file': os.path.abspath(in_file), 'tile': tile, 'shards': shards}, f, indent=1)
+    os.replace(work_dir + '/shards.json.tmp', work_dir + '/shards.json')
+    print(len(pt), 'points split in', len(shards), 'shards of', tile, 'degrees.')
+    return shards
+
+#True when the lock of a shard belongs to a process that is not running it anymore.
+def stale_lock(lock_file):
+    try:
+        with open(lock_file, 'r') as f:
+            host, pid = f.read().rsplit(':', 1)
+        age = time.time() - os.path.getmtime(lock_file)
+    except (OSError, ValueError):
+        return False
+    if age > STALE:
+        return True
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+    return False
+
+#Takes a shard for this process. False if it is done or another process has it. A stale lock
+#is removed first, by one process at a time (reclaim file) and only if it is still stale then,
+#as another process may have taken the shard over meanwhile.
+def claim(shard_dir):
+    if os.path.exists(shard_dir + '/done.json'):
+        return False
+    if stale_lock(shard_dir + '/lock'):
+        try:
+            os.close(os.open(shard_dir + '/reclaim', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        try:
+            if stale_lock(shard_dir + '/lock'):
+                os.remove(shard_dir + '/lock')
+                print('Taking over the stale lock of', os.path.basename(shard_dir))
+        finally:
+            os.remove(shard_dir + '/reclaim')
+    try:
+        fd = os.open(shard_dir + '/lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(socket.gethostname() + ':' + str(os.getpid()))
+    return True
+
+#Touches the lock of a running shard every HEARTBEAT seconds until stop is set.
+def heartbeat(lock_file, stop):
+    while not stop.wait(HEARTBEAT):
+        try:
+            os.utime(lock_file)
+        except OSError:
+            return
+
+#Runs run(in_file=shard_csv, out_dir=shard_out) for every shard it can claim. A failed shard
+#is released with its error in failed.json, so a later run tries it again.
+def shard_worker(work_dir, shards, run):
+    for name in sorted(shards):
+        shard_dir = work_dir + '/' + name
+        if not claim(shard_dir):
+            continue
+        s1 = datetime.now()
+        print('Running shard', name, '(', shards[name], 'points )')
+        status = {'host': socket.gethostname(), 'pid': os.getpid(), 'start': s1.isoformat()}
+        stop = threading.Event()
+        threading.Thread(target=heartbeat, args=(shard_dir + '/lock', stop), daemon=True).start()
+        try:
+            run(in_file=shard_dir + '/pts.csv', out_dir=shard_dir + '/out')
+        except (Exception, SystemExit) as err:
+            stop.set()
+            status.update({'status': 'failed', 'error': repr(err), 'seconds': (datetime.now() - s1).total_seconds()})
+            with open(shard_dir + '/failed.json', 'w') as f:
+                json.dump(status, f, indent=1)
+            os.remove(shard_dir + '/lock')
+            print('Shard', name, 'failed:', repr(err))
+            continue
+        stop.set()
+        status.update({'status': 'done', 'seconds': (datetime.now() - s1).total_seconds()})
+        if os.path.exists(shard_dir + '/failed.json'):
+            os.remove(shard_dir + '/failed.json')
+        with open(shard_dir + '/done.json', 'w') as f:
+            json.dump(status, f, indent=1)
+
+#Status of every shard: done, failed, running (locked) or pending.
+def shard_status(work_dir, shards):
+    status = {}
+    for name in shards:
+        shard_dir = work_dir + '/' + name
+        entry = {'points': shards[name], 'status': 'pending'}
+        for file in ('done.json', 'failed.json'):
+            if os.path.exists(shard_dir + '/' + file):
+                with open(shard_dir + '/' + file, 'r') as f:
+                    entry.update(json.load(f))
+                break
+        else:
+            if os.path.exists(shard_dir + '/lock'):
+                entry['status'] = 'stale' if stale_lock(shard_dir + '/lock') else 'running'
+        entry['merged'] = os.path.exists(shard_dir + '/merged')
+        status[name] = entry
+    return status
+
+#Moves the WTH files of the done shards into out_dir and adds their index entries to the
+#index of out_dir. Only one process merges at a time.
+def merge_shards(work_dir, shards, out_dir):
+    try:
+        fd = os.open(work_dir + '/merge.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        print('Another process is merging the shards.')
+        return
+    os.close(fd)
+    try:
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        con = open_index(out_dir)
+        for name in sorted(shards):
+            shard_dir = work_dir + '/' + name
+            if not os.path.exists(shard_dir + '/done.json') or os.path.exists(shard_dir + '/merged'):
+                continue
+            shard_out = shard_dir + '/out'
+            n = 0
+            if os.path.exists(shard_out):
+                for wth_file in os.listdir(shard_out):
+                    if wth_file.endswith('.WTH'):
+                        os.replace(shard_out + '/' + wth_file, out_dir + '/' + wth_file)
+                        n += 1
+                if os.path.exists(shard_out + '/' + INDEX_FILE):
+                    con.execute('ATTACH DATABASE ? AS shard', (shard_out + '/' + INDEX_FILE,))
+                    con.execute('INSERT OR REPLACE INTO files SELECT * FROM shard.files')
+                    con.commit()
+                    con.execute('DETACH DATABASE shard')
+            open(shard_dir + '/merged', 'w').close()
+            print('Shard', name, 'merged:', n, 'WTH files.')
+        con.close()
+    finally:
+        os.remove(work_dir + '/merge.lock')
+
+#Removes the split of work_dir when all its shards were merged (a finished run), so this run
+#starts a new one. The directory is renamed first, so only one process removes it.
+def finished(work_dir):
+    if not os.path.exists(work_dir + '/shards.json'):
+        return
+    with open(work_dir + '/shards.json', 'r') as f:
+        shards = json.load(f)['shards']
+    if not all(os.path.exists(work_dir + '/' + name + '/merged') for name in shards):
+        return
+    old_dir = work_dir + '.done.' + str(os.getpid())
+    try:
+        os.rename(work_dir, old_dir)
+    except OSError:
+        return
+    if os.path.exists(old_dir + '/manifest.json'):
+        shutil.copy(old_dir + '/manifest.json', work_dir + '_last_manifest.json')
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print('The previous sharded run was complete; splitting', os.path.dirname(work_dir), 'again.')
+
+#Splits in_file, runs run(in_file=shard_csv, out_dir=shard_out) on the shards with `processes`
+#local processes, merges the shards into out_dir when all are done and writes manifest.json.
+def run_sharded(in_file, out_dir, tile, run, processes=1):
+    s1 = datetime.now()
+    work_dir = os.path.dirname(os.path.abspath(in_file)) + '/shards'
+    finished(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    shards = split_csv(in_file, work_dir, tile)
+
+    if processes > 1:
+        procs = [Process(target=shard_worker, args=(work_dir, shards, run)) for n in range(processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+    else:
+        shard_worker(work_dir, shards, run)
+
+    status = shard_status(work_dir, shards)
+    if all(s['status'] == 'done' for s in status.values()):
+        merge_shards(work_dir, shards, out_dir)
+        status = shard_status(work_dir, shards)
+
+    #Completion manifest of the run.
+    count = {}
+    for s in status.values():
+        count[s['status']] = count.get(s['status'], 0) + 1
+    manifest = {'in_file': os.path.abspath(in_file), 'out_dir': os.path.abspath(out_dir), 'tile': tile,
+                'complete': all(s['merged'] for s in status.values()), 'count': count, 'shards': status}
+    with open(work_dir + '/manifest.json.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(work_dir + '/manifest.json.tmp', work_dir + '/manifest.json')
+
+    print('Shards:', ', '.join(k + ': ' + str(v) for k, v in sorted(count.items())), '| see', work_dir + '/manifest.json')
+    print("Time of execution for the shards is: ", str(datetime.now() - s1))
+    if count.get('failed'):
+        sys.exit(1)
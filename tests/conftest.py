@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import random
+import pytest
+import numpy
+import pandas as pd
+from datetime import datetime, timedelta
+
+#The scripts of the repository are imported from its root.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import precstore
+
+#NASA POWER series with SRAD gaps for the WTH writer: positions of the missing values (negative
+#from the end) and the number of days of every case.
+SRAD_GAPS = {
+    'no_gaps': ([], 30),
+    'one': ([10], 30),
+    'two': ([10, 11], 30),
+    'three': ([10, 11, 12], 30),
+    'one_at_start': ([0], 30),
+    'two_at_start': ([0, 1], 30),
+    'three_at_start': ([0, 1, 2], 30),
+    'one_at_end': ([-1], 30),
+    'two_at_end': ([-2, -1], 30),
+    'three_at_end': ([-3, -2, -1], 30),
+    'two_before_end': ([-3, -2], 30),
+    'several': ([1, 5, 6, 12, 20, 21, 22, 27], 30),
+    'single_row': ([], 1),
+    'single_row_missing': ([0], 1),
+}
+MISSING_TOKENS = ['nan', '-99', '-99.0', '-3596.4']
+START = datetime(2020, 1, 1)
+
+#ICASA text of NASA POWER for n days from START with SRAD missing at gaps.
+def icasa_text(gaps, n, seed=0):
+    rnd = random.Random(seed)
+    gaps = set(g % n for g in gaps)
+    lines = ['-BEGIN HEADER-', 'NASA/POWER CERES/MERRA2 Native Resolution Daily Data',
+             'Dates (month/day/year): 01/01/2020 through ' + (START + timedelta(days=n - 1)).strftime('%m/%d/%Y'),
+             'Location: Latitude  -4.75   Longitude -70.75', 'Elevation from MERRA-2: 243.3 meters',
+             'Value for missing model data cannot be computed or out of model availability range: -99',
+             'Parameter(s):', 'ALLSKY_SFC_SW_DWN  MERRA-2 All Sky Surface Shortwave Downward Irradiance (MJ/m^2/day)',
+             '-END HEADER-', '$WEATHER DATA : NASA POWER', '',
+             '@ INSI   WTHLAT  WTHLONG  WELEV   TAV   AMP  REFHT  WNDHT',
+             '  NASA   -4.750  -70.750  243.3  24.1   2.8    2.0   10.0', '',
+             '@  DATE   T2M  TMIN  TMAX  TDEW  RH2M  PREC  WIND  SRAD']
+    for i in range(n):
+        t2m = rnd.uniform(18, 30)
+        srad = rnd.choice(MISSING_TOKENS) if i in gaps else '{:.1f}'.format(rnd.uniform(5, 28))
+        lines.append('{:>7} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:5.1f} {:>5}'.format(
+            (START + timedelta(days=i)).strftime('%Y%j'), t2m, t2m - 5, t2m + 6, t2m - 4, rnd.uniform(60, 95),
+            rnd.expovariate(0.3), rnd.uniform(0.5, 5), srad))
+    return '\n'.join(lines) + '\n'
+
+#WTH file written by the original nasachirps (row by row) for an ID, kept here as the reference
+#of the vectorized writer. df_prec is the CHIRPS series as the old prec pickles (ID x dates).
+def baseline_wth(text, id, lat, lon, df_prec):
+    d = df_prec.columns.values.tolist()
+    ids_ch = df_prec.index.values.tolist()
+    s1 = '{:>6} {:>9} {:>9} {:>7} {:>5} {:>5} {:>5} {:>5}'
+    hdr1 = s1.format("@ INSI", "LAT", "LONG", "ELEV", "TAV", "AMP", "REFHT", "WNDHT" + "\n")
+    s2 = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} {:>6}'
+    hdr3 = s2.format("@  DATE", "T2M", "TMIN", "TMAX", "TDEW", "RHUM", "RAIN2", "WIND", "SRAD", "RAIN")
+
+    data = [line + '\n' for line in text.splitlines() if line.strip()]
+    hdr2 = data[11].split()
+    solar = [sr.split()[8] for sr in data[13:]]
+    i_srad = [i for i, e in enumerate(solar) if e == 'nan' or e == '-99' or e == '-99.0' or e == '-3596.4']
+    out = data[0] + '\n\n' + hdr1 + s1.format(hdr2[0], lat, lon, hdr2[3], hdr2[4], hdr2[5], hdr2[6], hdr2[7]) + \
+        '\n\n' + hdr3 + '\n'
+    for index2, row in enumerate(data[13:]):
+        c = 0
+        r = row.split()
+        if index2 in i_srad:
+            if (index2 + 1 in i_srad) and (index2 + 2 in i_srad) and index2 == 0:
+                break
+            if (index2 + 1 in i_srad) and index2 == 0:
+                break
+            if len(data[13:]) == 1:
+                break
+            if (index2 + 1 in i_srad) and (index2 + 2 in i_srad):
+                SRAD2 = solar[index2 - 1]
+                c = 1
+            elif (index2 + 1) in i_srad and (index2 + 2) == len(data[13:]):
+                SRAD2 = solar[index2 - 1]
+                c = 1
+            elif (index2 + 1) in i_srad:
+                SRAD2 = round(float(solar[index2 - 1]) + (float(solar[index2 + 2]) - float(solar[index2 - 1])) / 3, 1)
+            elif (index2 - 1) in i_srad:
+                SRAD2 = round(float(solar[index2 - 2]) + 2 * (float(solar[index2 + 1]) - float(solar[index2 - 2])) / 3, 1)
+            elif (index2 + 1) == len(data[13:]):
+                SRAD2 = solar[index2 - 1]
+            elif index2 == 0:
+                SRAD2 = solar[index2 + 1]
+            else:
+                SRAD2 = round((float(solar[index2 - 1]) + float(solar[index2 + 1])) / 2, 1)
+        else:
+            SRAD2 = r[8]
+
+        if (r[0] in d) and (id in ids_ch):
+            RAIN_CHIRPS = df_prec.loc[id, r[0]]
+            if RAIN_CHIRPS == -9999.0:
+                RAIN = r[6]
+            else:
+                RAIN = round(float(RAIN_CHIRPS), 1)
+        else:
+            RAIN = r[6]
+
+        out += s2.format(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], SRAD2, RAIN) + '\n'
+        if c == 1:
+            break
+    return out
+
+#A NASA POWER cell of every SRAD case, written as nasachirps reads it: the points (three IDs
+#in the cell, the last one without CHIRPS), the NASA POWER file and a CHIRPS store that starts
+#after the first day and has some NODATA values. Gives the paths and the expected WTH texts.
+@pytest.fixture(params=sorted(SRAD_GAPS))
+def power_cell(request, tmp_path):
+    gaps, n = SRAD_GAPS[request.param]
+    nasa_id = '170218'
+    text = icasa_text(gaps, n, seed=sorted(SRAD_GAPS).index(request.param))
+    nasa_dir = tmp_path / 'nasap'
+    nasa_dir.mkdir()
+    (nasa_dir / (nasa_id + '.WTH')).write_text(text)
+
+    pt = pd.DataFrame({'ID': [11, 12, 13], 'Latitude': [-4.71234, -4.8, -4.99999],
+                       'Longitude': [-70.6, -70.75432, -70.9], 'nasapid': int(nasa_id),
+                       'LatNP': -4.75, 'LonNP': -70.75})
+    pt.to_csv(tmp_path / 'pts.csv', index=False)
+
+    rnd = numpy.random.default_rng(n + len(gaps))
+    days = [(START + timedelta(days=i)).strftime('%Y%j') for i in range(1, n + 5)]
+    values = numpy.where(rnd.random((len(days), 2)) < 0.4, rnd.gamma(0.8, 9.0, (len(days), 2)), 0).round(2)
+    values[rnd.random((len(days), 2)) < 0.1] = precstore.NODATA
+    store = str(tmp_path / 'prec')
+    precstore.create(store, [11, 12])
+    precstore.append(store, days, values)
+
+    df_prec = precstore.read_prec(store)
+    expected = {id: baseline_wth(text, id, round(lat, 5), round(lon, 5), df_prec)
+                for id, lat, lon in zip(pt['ID'], pt['Latitude'], pt['Longitude'])}
+    return {'in_file': str(tmp_path / 'pts.csv'), 'nasa_dir': str(nasa_dir), 'nasa_id': nasa_id, 'prec': store,
+            'out_dir': str(tmp_path / 'out'), 'expected': expected}
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import pytest
+from datetime import datetime
+import chirps
+from chirps import correc_jobs, download_holes, check_download
+
+JOBS = correc_jobs(datetime(2020, 1, 1), datetime(2020, 6, 30), 'nc')
+
+#404s after the last month downloaded are months not published yet; any other failure, or a
+#404 before it, leaves a hole in the series.
+@pytest.mark.parametrize('failed, holes', [
+    ([], []),
+    ([('corr_chirps_202005.nc', 'HTTP 404'), ('corr_chirps_202006.nc', 'HTTP 404')], []),
+    ([(job[0], 'HTTP 404') for job in JOBS], []),
+    ([('corr_chirps_202003.nc', 'HTTP 404')], [('corr_chirps_202003.nc', 'HTTP 404')]),
+    ([('corr_chirps_202006.nc', 'HTTP 500')], [('corr_chirps_202006.nc', 'HTTP 500')]),
+    ([('corr_chirps_202006.nc', 'ConnectionError'), ('corr_chirps_202005.nc', 'HTTP 404')],
+     [('corr_chirps_202006.nc', 'ConnectionError')]),
+])
+def test_download_holes(failed, holes):
+    assert download_holes(JOBS, failed) == holes
+
+def test_check_download_stops_on_hole():
+    check_download(JOBS, [('corr_chirps_202006.nc', 'HTTP 404')])
+    with pytest.raises(SystemExit):
+        check_download(JOBS, [('corr_chirps_202002.nc', 'ReadTimeout')])
+
+#The files downloaded are reported with done, so a run stopped by a hole only tries the failed
+#files again when resumed.
+def test_get_nc_retries_failed(monkeypatch):
+    sent = []
+    def download_nc(jobs, workers=None, bbox=None, done=None):
+        sent.append([job[0] for job in jobs])
+        failed = [(job[0], 'ReadTimeout') for job in jobs if job[0] == 'corr_chirps_202003.nc' and len(sent) == 1]
+        for job in jobs:
+            done(job, job[0] not in dict(failed))
+        return failed
+    monkeypatch.setattr(chirps, 'download_nc', download_nc)
+
+    got = []
+    with pytest.raises(SystemExit):
+        chirps.get_nc(JOBS, skip=got, done=got.append)
+    assert 'corr_chirps_202003.nc' not in got and len(got) == 5
+    chirps.get_nc(JOBS, skip=set(got), done=got.append)
+    assert sent[1] == ['corr_chirps_202003.nc']
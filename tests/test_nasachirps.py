@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import numpy
+from datetime import datetime
+from precstore import open_prec, NODATA
+from getnasap import nasachirps, read_power, rows_text, rain_text, s2
+
+#The vectorized SRAD quality control and CHIRPS join give the bytes of the original writer.
+def test_nasachirps_matches_baseline(power_cell):
+    nasachirps(power_cell['in_file'], power_cell['nasa_dir'], power_cell['prec'], power_cell['out_dir'], workers=1)
+    for id, text in power_cell['expected'].items():
+        with open(power_cell['out_dir'] + '/' + str(id) + '.WTH', 'rb') as f:
+            assert f.read() == text.encode()
+
+def test_read_power_truncates_like_baseline(power_cell):
+    title, hdr2, rows, srad = read_power(power_cell['nasa_dir'], power_cell['nasa_id'])
+    n_rows = len(power_cell['expected'][11].splitlines()) - 7  # Header lines of a WTH file, blank ones included
+    assert len(rows) == len(srad) == n_rows
+
+#The rows formatted once per NASA POWER cell (rows_text) with the RAIN column of every ID
+#(rain_text) are the rows of the s2 layout, formatted one by one.
+def test_cell_rows_match_s2(power_cell):
+    title, hdr2, rows, srad = read_power(power_cell['nasa_dir'], power_cell['nasa_id'])
+    ids, start, prec = open_prec(power_cell['prec'])
+    text = rows_text(rows, srad)
+    rain2 = numpy.array(['{:>6}'.format(r[6]) + '\n' for r in rows], dtype=object)
+    for col, id in enumerate(ids):
+        pos = numpy.array([(datetime.strptime(r[0], '%Y%j') - start).days for r in rows], dtype=int)
+        val = prec[numpy.clip(pos, 0, len(prec) - 1), col]
+        ok = (pos >= 0) & (pos < len(prec)) & (val != NODATA)
+        rain = [round(float(v), 1) if k else r[6] for r, v, k in zip(rows, val, ok)]
+        expected = ''.join(s2.format(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], SRAD2, RAIN) + '\n'
+                           for r, SRAD2, RAIN in zip(rows, srad, rain))
+        assert ''.join(text + rain_text(rain2, val, numpy.flatnonzero(ok))) == expected
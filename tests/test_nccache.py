@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import json
+import threading
+import http.server
+import pytest
+import requests
+import nccache
+from nccache import cache_get, load_index
+
+#Local file server with ETags, Range/If-Range and If-None-Match. files has the body and ETag
+#of every path; the next `cut` responses send only half of their body and close the connection.
+#The headers of every request are kept in requests.
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.files = {}
+        self.cut = 0
+        self.requests = []
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        body, etag = self.server.files[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        status, start = 200, 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][6:-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(len(body)))
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(len(body) - 1) + '/' + str(len(body)))
+        self.end_headers()
+        if self.server.cut:
+            self.server.cut -= 1
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+@pytest.fixture
+def server():
+    server = Server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:' + str(server.server_port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def body(n, seed=0):
+    return (bytes(range(seed, 251)) + bytes(range(seed))) * (n // 251) + bytes(range(n % 251))
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+#A download cut halfway is resumed with a Range request conditional on the ETag (If-Range),
+#from the chunks written (1 MB).
+def test_resume_with_range(server, tmp_path):
+    server.files['/a.nc'] = (body(3 * 2**20), '"a1"')
+    server.cut = 1
+    assert cache_get(requests.Session(), server.url + '/a.nc', 'corrected/a', str(tmp_path / 'out/a.nc'),
+                     cache_dir=str(tmp_path / 'cache'))
+    assert read(str(tmp_path / 'out/a.nc')) == body(3 * 2**20)
+    assert server.requests[1]['Range'] == 'bytes=' + str(2**20) + '-' and server.requests[1]['If-Range'] == '"a1"'
+    assert os.listdir(str(tmp_path / 'cache/partial')) == ['corrected_a.part.lock']
+
+#If the file changed since the partial download, the server sends it whole (If-Range fails).
+def test_resume_of_changed_file(server, tmp_path):
+    server.files['/a.nc'] = (body(3 * 2**20), '"a1"')
+    server.cut = 4  # More cuts than retries: the partial file is left.
+    with pytest.raises(requests.exceptions.RequestException):
+        cache_get(requests.Session(), server.url + '/a.nc', 'prelim/a', str(tmp_path / 'out/a.nc'),
+                  cache_dir=str(tmp_path / 'cache'))
+    assert load_index(str(tmp_path / 'cache')) == {}
+
+    server.files['/a.nc'] = (body(3 * 2**20 + 1000, 1), '"a2"')
+    assert cache_get(requests.Session(), server.url + '/a.nc', 'prelim/a', str(tmp_path / 'out/a.nc'),
+                     cache_dir=str(tmp_path / 'cache'))
+    assert read(str(tmp_path / 'out/a.nc')) == body(3 * 2**20 + 1000, 1)
+    assert server.requests[-1]['If-Range'] == '"a1"'
+
+#A cached file to revalidate is not downloaded again when the server answers 304, and is when
+#it changed.
+def test_revalidate(server, tmp_path):
+    server.files['/p.nc'] = (body(1000), '"p1"')
+    args = (server.url + '/p.nc', 'prelim/2021', str(tmp_path / 'out/p.nc'), True, str(tmp_path / 'cache'))
+    assert cache_get(requests.Session(), *args)
+    assert not cache_get(requests.Session(), *args)
+    assert server.requests[-1]['If-None-Match'] == '"p1"'
+    assert read(str(tmp_path / 'out/p.nc')) == body(1000)
+
+    server.files['/p.nc'] = (body(1200), '"p2"')
+    assert cache_get(requests.Session(), *args)
+    assert read(str(tmp_path / 'out/p.nc')) == body(1200)
+    assert load_index(str(tmp_path / 'cache'))['prelim/2021']['etag'] == '"p2"'
+    assert len(os.listdir(str(tmp_path / 'cache/objects'))) == 2
+
+#A partial file as long as the file (416 to its Range) is dropped and the file downloaded again.
+def test_range_not_satisfiable(server, tmp_path):
+    server.files['/a.nc'] = (body(5000), '"a1"')
+    part = str(tmp_path / 'cache/partial/corrected_a.part')
+    os.makedirs(os.path.dirname(part))
+    with open(part, 'wb') as f:
+        f.write(b'x' * 6000)
+    with open(part + '.json', 'w') as f:
+        json.dump({'url': server.url + '/a.nc', 'validator': '"a1"'}, f)
+
+    assert cache_get(requests.Session(), server.url + '/a.nc', 'corrected/a', str(tmp_path / 'out/a.nc'),
+                     cache_dir=str(tmp_path / 'cache'))
+    assert read(str(tmp_path / 'out/a.nc')) == body(5000)
+    assert 'Range' in server.requests[0] and 'Range' not in server.requests[1]
+
+#A file shorter than its Content-Length is never stored in the cache.
+def test_content_length(server, tmp_path, monkeypatch):
+    server.files['/a.nc'] = (body(5000), '"a1"')
+    #Chunks lost on the way without an error of the connection.
+    iter_content = requests.Response.iter_content
+    monkeypatch.setattr(requests.Response, 'iter_content',
+                        lambda self, chunk_size=1: (c[:-10] for c in iter_content(self, chunk_size)))
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        cache_get(requests.Session(), server.url + '/a.nc', 'corrected/a', str(tmp_path / 'out/a.nc'),
+                  cache_dir=str(tmp_path / 'cache'))
+    assert load_index(str(tmp_path / 'cache')) == {}
+    assert os.listdir(str(tmp_path / 'cache/objects')) == []
+    assert not os.path.exists(str(tmp_path / 'out/a.nc'))
+
+#Above the maximum size the least recently used files are evicted, but never the file just
+#stored, and a file used again moves to the end of the order.
+def test_eviction(server, tmp_path, monkeypatch):
+    cache = str(tmp_path / 'cache')
+    for n in range(4):
+        server.files['/' + str(n) + '.nc'] = (body(1000, n), '"' + str(n) + '"')
+    def get(n):
+        return cache_get(requests.Session(), server.url + '/' + str(n) + '.nc', 'corrected/' + str(n),
+                         str(tmp_path / 'out' / (str(n) + '.nc')), cache_dir=cache, max_size=2500)
+    assert get(0) and get(1)
+    assert not get(0)  # 0 used after 1
+    assert get(2)
+    assert sorted(load_index(cache)) == ['corrected/0', 'corrected/2']
+    assert len(os.listdir(cache + '/objects')) == 2
+
+    monkeypatch.setattr(nccache, 'CACHE_MAX', 500)  # Smaller than any file: only the new one is kept.
+    assert cache_get(requests.Session(), server.url + '/3.nc', 'corrected/3', str(tmp_path / 'out/3.nc'), cache_dir=cache)
+    assert sorted(load_index(cache)) == ['corrected/3']
+    assert read(str(tmp_path / 'out/3.nc')) == body(1000, 3)
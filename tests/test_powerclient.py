@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import json
+import time
+import threading
+import functools
+import http.server
+import urllib.parse
+import pytest
+import requests
+import pandas as pd
+import bench
+import getnasap
+import powerstore
+from powerclient import PowerClient
+
+#Local stand-in of the NASA POWER point API. reply(server, query) gives the status, headers
+#and body of every request; the requests are counted by point.
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, reply):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.reply = reply
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.times = []
+        self.active = 0
+        self.max_active = 0
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        q = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        with self.server.lock:
+            self.server.requests[q['latitude']] = self.server.requests.get(q['latitude'], 0) + 1
+            self.server.times.append(time.monotonic())
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+            n = len(self.server.times)
+        status, headers, body = self.server.reply(self.server, q, n)
+        with self.server.lock:
+            self.server.active -= 1
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def power():
+    servers = []
+    def start(reply):
+        server = Server(reply)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, 'http://127.0.0.1:' + str(server.server_port) + '/point'
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def jobs(n, first=0):
+    return [(i, {'latitude': str(i), 'longitude': '0', 'start': '20200101', 'end': '20200101'})
+            for i in range(first, first + n)]
+
+#A client error other than 429 fails for good at once: it is neither retried by get nor queued
+#again by run.
+def test_client_error_not_retried(power):
+    server, url = power(lambda server, q, n: (400, [], b'{"messages": "out of range"}'))
+    client = PowerClient(url, workers=2, rate=1000.0, backoff=0.01)
+    failed = client.run(jobs(3), lambda id, params, text: None, attempts=3)
+    assert sorted(f[0] for f in failed) == [0, 1, 2]
+    assert all(f[2] == 1 and isinstance(f[3], requests.exceptions.HTTPError) for f in failed)
+    assert server.requests == {'0': 1, '1': 1, '2': 1}
+
+#Throttling (503) is retried by get and the job queued again by run until attempts.
+def test_throttled_queued_again(power):
+    server, url = power(lambda server, q, n: (503, [('Retry-After', '0')], b''))
+    client = PowerClient(url, workers=1, rate=1000.0, retries=1, backoff=0.01)
+    failed = client.run(jobs(1), lambda id, params, text: None, attempts=2)
+    assert failed[0][2] == 2 and failed[0][3].response.status_code == 503
+    assert server.requests == {'0': 4}
+
+def ok(q):
+    return 200, [], bench.icasa(float(q['latitude']), float(q['longitude']), q['start'], q['end'], 0).encode()
+
+#A 429 waits the seconds of its Retry-After (not the backoff) and halves the concurrency.
+def test_retry_after(power):
+    server, url = power(lambda server, q, n: (429, [('Retry-After', '1')], b'') if n == 1 else ok(q))
+    client = PowerClient(url, workers=4, rate=1000.0, backoff=0.01)
+    text = client.get({'latitude': '1', 'longitude': '0', 'start': '20200101', 'end': '20200105'})
+    assert '2020005' in text
+    assert server.times[1] - server.times[0] >= 0.9
+    assert client.limit == 2
+
+#The concurrency is halved by throttling and grows by one after as many successes in a row.
+def test_concurrency_halved_and_grown(power):
+    def reply(server, q, n):
+        time.sleep(0.05)
+        return (503, [('Retry-After', '0')], b'') if n == 1 else ok(q)
+    server, url = power(reply)
+    client = PowerClient(url, workers=4, max_workers=8, rate=1000.0, backoff=0.01)
+    assert client.run(jobs(1), lambda id, params, text: None) == []
+    assert client.limit == 2 and client.ok == 1
+
+    #2 -> 3 after 2 successes (1 before), 3 -> 4 after 3, 4 -> 5 after 4: 5 after 8 more.
+    server.max_active = 0
+    assert client.run(jobs(8, 1), lambda id, params, text: None) == []
+    assert client.limit == 5
+    assert 1 < server.max_active <= 4
+
+#get_data tries every request up to its attempts (a client error only once) and reports the
+#points that failed with their period, attempts, status and error, as in the manifest.
+def test_get_data_failed(power, tmp_path, monkeypatch):
+    def reply(server, q, n):
+        if q['latitude'] == '2.25':
+            return 503, [('Retry-After', '0')], b''
+        if q['latitude'] == '3.25':
+            return 400, [], b'{"messages": "out of range"}'
+        return ok(q)
+    server, url = power(reply)
+    monkeypatch.setattr(getnasap, 'PowerClient', functools.partial(PowerClient, url, retries=1, backoff=0.01))
+    monkeypatch.setattr(powerstore, 'STORE_FILE', str(tmp_path / 'power.sqlite'))
+    in_file = str(tmp_path / 'pts.csv')
+    pd.DataFrame({'ID': [1, 2, 3], 'Latitude': [1.3, 2.3, 3.3], 'Longitude': [0.1, 0.1, 0.1],
+                  'nasapid': [11, 12, 13], 'LatNP': [1.25, 2.25, 3.25], 'LonNP': [0.25, 0.25, 0.25]}).to_csv(
+        in_file, index=False)
+
+    failed = getnasap.get_data(in_file, '20200101', '20200110', str(tmp_path / 'nasap'), rate=1000.0, attempts=2)
+    failed = {f['nasapid']: f for f in failed}
+    assert sorted(failed) == ['12', '13']
+    assert {k: v for k, v in failed['12'].items() if k != 'error'} == \
+        {'nasapid': '12', 'start': '20200101', 'end': '20200110', 'attempts': 2, 'status': 503}
+    assert {k: v for k, v in failed['13'].items() if k != 'error'} == \
+        {'nasapid': '13', 'start': '20200101', 'end': '20200110', 'attempts': 1, 'status': 400}
+    assert '503' in failed['12']['error'] and '400' in failed['13']['error']
+    assert server.requests == {'1.25': 1, '2.25': 4, '3.25': 1}
+    assert os.listdir(str(tmp_path / 'nasap')) == ['11.WTH']
+
+    getnasap.write_failed(in_file, '20200101', '20200110', list(failed.values()))
+    with open(str(tmp_path / 'failed_pt.json'), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['startDate'] == '20200101' and manifest['failed'] == list(failed.values())
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import numpy
+from chirps import pt_offsets
+from precarchive import archive_gt, RES
+
+#The CHIRPS files give the pixel size in float32 (0.05000000074505806). With the pixel size of
+#the files kept in meta.json, the archive finds the pixels of a crop of the files, also for
+#points on the edge of a pixel.
+def test_archive_pixels_match_files():
+    res = float(numpy.float32(RES))
+    lat = numpy.array([-4.0, -4.05, -3.35, 0.0, -2.123])
+    lon = numpy.array([10.0, 10.05, 33.35, 20.0, 25.678])
+    meta = {'bbox': [10.0, -5.0, 34.0, 1.0], 'res': RES, 'pixel': [res, -res]}
+    file_gt = (8.0, res, 0.0, 3.0, 0.0, -res)  # A crop with a margin of 2 degrees.
+    px_f, py_f = pt_offsets(file_gt, lat, lon)
+    px_a, py_a = pt_offsets(archive_gt(meta), lat, lon)
+    assert (px_a == px_f - 40).all() and (py_a == py_f - 40).all()
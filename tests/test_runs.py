@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import json
+import shutil
+import sqlite3
+import filecmp
+import subprocess
+import pytest
+from conftest import ROOT
+
+#Whole runs of the command line against the local CHIRPS and NASA POWER server of bench.py,
+#with the crashes and resumes, the streaming mode and the shards compared with plain runs.
+pytest.importorskip('osgeo')  # The runs read and write NetCDF files.
+import bench
+from wthindex import scan_wth
+
+CORRECTED_LAST = '2021.01'  # Last corrected month published by the server (YYYY.MM).
+
+#The server of bench.py, with no corrected months after server.corrected_last (404), so the
+#last days come from the preliminary file.
+class Handler(bench.Handler):
+    def do_GET(self):
+        name = os.path.basename(self.path)
+        part = name.split('.')
+        if len(part) == 6 and part[2] + '.' + part[3] > self.server.corrected_last:
+            self.send_error(404)
+            return
+        super().do_GET()
+
+class Server(bench.Server):
+    def __init__(self, fixtures, gaps):
+        super().__init__(fixtures, gaps)
+        self.RequestHandlerClass = Handler
+        self.corrected_last = CORRECTED_LAST
+
+@pytest.fixture(scope='module')
+def fixtures(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('fixtures'))
+
+@pytest.fixture
+def server(fixtures, tmp_path, monkeypatch):
+    server = Server(fixtures, 0.0)
+    bench.threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:' + str(server.server_port)
+    monkeypatch.setenv('NASAPCHIRPS_CHIRPS_URL', url + '/chirps')
+    monkeypatch.setenv('NASAPCHIRPS_POWER_URL', url + '/power')
+    monkeypatch.setenv('NASAPCHIRPS_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setenv('NASAPCHIRPS_POWER_STORE', str(tmp_path / 'cache' / 'power.sqlite'))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+#Runs the command line in a new process. today is the date update takes as today (YYYYMMDD),
+#and crash (module, function, n) stops the run with KeyboardInterrupt at the n-th call of the
+#function. Returns the exit code and the output.
+RUN = '''
+import sys, json, runpy, importlib, datetime as dtm
+root, args, today, crash = json.loads(sys.argv[1])
+sys.path.insert(0, root)
+if today is not None:
+    import update_wth
+    class Today(dtm.datetime):
+        @classmethod
+        def today(cls):
+            return dtm.datetime.strptime(today, '%Y%m%d')
+    update_wth.datetime = Today
+if crash is not None:
+    module = importlib.import_module(crash[0])
+    func = getattr(module, crash[1])
+    calls = []
+    def broken(*a, **k):
+        calls.append(1)
+        if len(calls) == crash[2]:
+            print('Crash of the test.', flush=True)
+            raise KeyboardInterrupt
+        return func(*a, **k)
+    setattr(module, crash[1], broken)
+sys.argv = [root] + args
+runpy.run_path(root, run_name='__main__')
+'''
+
+def run(*args, today=None, crash=None):
+    r = subprocess.run([sys.executable, '-c', RUN, json.dumps([ROOT, [str(a) for a in args], today, crash])],
+                       capture_output=True, text=True)
+    return r.returncode, r.stdout + r.stderr
+
+#The run stopped by the crash asked for.
+def crashed(result):
+    return result[0] != 0 and 'Crash of the test.' in result[1]
+
+def get(work, out, *args, **kw):
+    code, output = run('get', work + '/pts.csv', 20210101, 20210310, out, '--workers', 1, *args, **kw)
+    return code, output
+
+def wth_names(wth_dir):
+    return sorted(f for f in os.listdir(wth_dir) if f.endswith('.WTH'))
+
+def same_files(dir1, dir2):
+    names = wth_names(dir1)
+    return names == wth_names(dir2) and all(filecmp.cmp(dir1 + '/' + f, dir2 + '/' + f, shallow=False) for f in names)
+
+#Index rows without the times and checksums, which depend on how the files were written.
+def index_rows(wth_dir):
+    con = sqlite3.connect(wth_dir + '/wth_index.sqlite')
+    rows = con.execute('SELECT name, first_date, last_date, rows, corr_last, prelim_first, prelim_last FROM files '
+                       'ORDER BY name').fetchall()
+    con.close()
+    return rows
+
+@pytest.fixture
+def work(tmp_path, server):
+    work = str(tmp_path / 'work')
+    os.mkdir(work)
+    bench.make_points(work + '/pts.csv', 30)
+    return work
+
+#The streaming mode gives the same files and index as the steps one after another.
+def test_stream_matches_steps(work):
+    assert get(work, work + '/steps')[0] == 0
+    assert get(work, work + '/stream', '--stream')[0] == 0
+    assert len(wth_names(work + '/steps')) == 30
+    assert same_files(work + '/steps', work + '/stream')
+    assert index_rows(work + '/steps') == index_rows(work + '/stream')
+
+#A sharded get gives the same files and index as a single run, and logs its metrics.
+def test_shards_match_single_run(work):
+    assert get(work, work + '/single', '--metrics', work + '/single.prom')[0] == 0
+    assert get(work, work + '/sharded', '--tile', 3, '--processes', 2)[0] == 0
+    assert same_files(work + '/single', work + '/sharded')
+    assert index_rows(work + '/single') == index_rows(work + '/sharded')
+
+    with open(work + '/metrics.jsonl', 'r') as f:
+        events = [json.loads(line) for line in f]
+    run_event = [e for e in events if e['event'] == 'run'][0]
+    assert run_event['status'] == 'done' and run_event['command'] == 'get'
+    assert {'nasa', 'corrected_nc', 'corrected', 'prelim_nc', 'prelim', 'nasachirps', 'index'} <= \
+        set(e['stage'] for e in events if e['event'] == 'stage' and e['run'] == run_event['run'])
+    with open(work + '/single.prom', 'r') as f:
+        prom = f.read()
+    assert 'nasapchirps_runs_total{command="get",status="done"} 1.0' in prom
+
+#A get stopped during the extraction and then during the writing gives, once resumed, the same
+#files and index as a clean run.
+def test_get_resumed_after_crashes(work):
+    assert get(work, work + '/clean')[0] == 0
+    assert crashed(get(work, work + '/res', crash=('chirps', 'extract_file', 2)))
+    assert crashed(get(work, work + '/res', '--resume', crash=('getnasap', 'write_group', 3)))
+    code, output = get(work, work + '/res', '--resume')
+    assert code == 0 and 'Resuming the run' in output
+    assert same_files(work + '/clean', work + '/res')
+    assert index_rows(work + '/clean') == index_rows(work + '/res')
+
+#An update in place of the output of get, stopped during the merge and resumed, gives the same
+#files and index as a clean update. The index entries match a scan of the files, and only the
+#days after the corrected data published are preliminary.
+def test_update_resumed_after_crash(work, server):
+    assert get(work, work + '/hist')[0] == 0
+    assert [r for r in index_rows(work + '/hist') if r[0] == '1.WTH'][0][4:] == (2021031, 2021032, 2021069)
+    shutil.copytree(work + '/hist', work + '/res')
+
+    server.corrected_last = '2021.02'
+    args = ('update', work + '/pts.csv', work + '/hist', work + '/hist', '--workers', 1)
+    assert run(*args, today='20210414')[0] == 0
+    args = ('update', work + '/pts.csv', work + '/res', work + '/res', '--workers', 1)
+    assert crashed(run(*args, today='20210414', crash=('update_wth', 'append_wth', 5)))
+    code, output = run(*(args + ('--resume',)), today='20210414')
+    assert code == 0 and 'Resuming the run' in output
+
+    assert same_files(work + '/hist', work + '/res')
+    assert index_rows(work + '/hist') == index_rows(work + '/res')
+    for name, first, last, rows, corr_last, prelim_first, prelim_last in index_rows(work + '/hist'):
+        e = scan_wth(work + '/hist/' + name)
+        assert (first, last, rows) == (e['first_date'], e['last_date'], e['rows'])
+        assert (corr_last, prelim_first, prelim_last) == (2021059, 2021060, 2021100)
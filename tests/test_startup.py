@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os, sys
+import time
+import subprocess
+from conftest import ROOT
+
+HEAVY = ['osgeo', 'pandas', 'requests', 'numpy']  # Only imported by the commands that use them.
+BUDGET = 1.0  # Seconds for --help, interpreter start included.
+
+#--help does not import GDAL, pandas, requests or numpy (python -X importtime), and stays in
+#the startup budget.
+def test_help_startup():
+    t0 = time.monotonic()
+    r = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(ROOT, '__main__.py'), '--help'],
+                       capture_output=True, text=True, timeout=60)
+    seconds = time.monotonic() - t0
+    assert r.returncode == 0, r.stderr
+    imported = set(line.split('|')[-1].strip().split('.')[0] for line in r.stderr.splitlines()
+                   if line.startswith('import time:'))
+    assert not imported & set(HEAVY)
+    assert seconds < BUDGET
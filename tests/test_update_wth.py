@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+from datetime import datetime, timedelta
+import numpy
+import pandas as pd
+import precstore
+from update_wth import append_wth, recover_wth, tail_date, cohorts, patch_rain, repatch_prelim
+from wthindex import open_index, lookup, record, clear_prelim, scan_wth
+
+HEADER = '*WEATHER DATA : NASA POWER\n\n@ INSI  LAT  LONG\n  NASA -4.7 -70.7\n\n@  DATE  SRAD  RAIN\n'
+
+def rows(first, last):
+    day = datetime(2020, 1, first)
+    return ''.join('{:>7} {:>5} {:>6}\n'.format((day + timedelta(days=n)).strftime('%Y%j'), 5.0 + first + n, 1.5)
+                   for n in range(last - first + 1))
+
+#An append to the archive interrupted after some rows (the last one half written) is undone
+#before the last date is read, so the next append adds all the days after the original end.
+def test_append_after_interrupted_append(tmp_path):
+    hist = str(tmp_path / '1.WTH')
+    new = str(tmp_path / 'new.WTH')
+    with open(hist, 'w') as f:
+        f.write(HEADER + rows(1, 10))
+    with open(new, 'w') as f:
+        f.write(HEADER + rows(5, 20))
+
+    #Crash of an append of days 11 to 16: journal written, rows partly on disk.
+    with open(hist + '.journal', 'w') as j:
+        j.write(str(os.path.getsize(hist)))
+    with open(hist, 'a') as f:
+        f.write(rows(11, 16)[:-9])
+
+    assert append_wth(hist, new, hist) == 10
+    with open(hist, 'r') as f:
+        assert f.read() == HEADER + rows(1, 20)
+    assert not os.path.exists(hist + '.journal')
+
+#The last date of a file is the one of its complete rows once recovered.
+def test_recover_before_tail_date(tmp_path):
+    hist = str(tmp_path / '1.WTH')
+    with open(hist, 'w') as f:
+        f.write(HEADER + rows(1, 10))
+    with open(hist + '.journal', 'w') as j:
+        j.write(str(os.path.getsize(hist)))
+    with open(hist, 'a') as f:
+        f.write(rows(11, 16))
+    recover_wth(hist)
+    assert tail_date(hist) == '2020010'
+
+#A file with no records (only its header) has no last date: it is left out of the cohorts, with
+#the index entry (last date None) or without it, and the other files are still updated.
+def test_file_without_records(tmp_path):
+    for name, text in [('1.WTH', HEADER + rows(1, 10)), ('2.WTH', HEADER)]:
+        with open(str(tmp_path / name), 'w') as f:
+            f.write(text)
+    pd.DataFrame({'ID': [1, 2], 'Latitude': [-4.7, -4.7], 'Longitude': [-70.7, -70.6]}).to_csv(
+        str(tmp_path / 'pts.csv'), index=False)
+    assert tail_date(str(tmp_path / '2.WTH')) is None
+
+    entries = {'1.WTH': {'last_date': 2020010}, '2.WTH': {'last_date': None}}
+    groups = cohorts(str(tmp_path / 'pts.csv'), entries, datetime(2020, 1, 20), str(tmp_path))
+    assert groups == [(datetime(2020, 1, 11), str(tmp_path / 'cohort_2020010.csv'))]
+    assert pd.read_csv(str(tmp_path / 'update_pt.csv'))['ID'].tolist() == [1]
+
+    #Appending to it adds all the rows of the update file.
+    with open(str(tmp_path / 'new.WTH'), 'w') as f:
+        f.write(HEADER + rows(1, 5))
+    assert append_wth(str(tmp_path / '2.WTH'), str(tmp_path / 'new.WTH'), str(tmp_path / '2.WTH')) == 5
+
+#Rows of n days from day (datetime) with the same RAIN, across years if needed.
+def year_rows(day, n, rain, nl='\n'):
+    return ''.join('{:>7} {:>5} {:>6}'.format((day + timedelta(days=k)).strftime('%Y%j'), 10.0, rain) + nl
+                   for k in range(n))
+
+def rain_of(wth_file):
+    with open(wth_file, 'r', newline='') as f:
+        return {int(line.split()[0]): line.split()[-1] for line in f.read().splitlines()[6:]}
+
+#The preliminary days of a file ending in January are patched across the year boundary, and the
+#index keeps the days after the corrected data as preliminary.
+def test_repatch_across_years(tmp_path):
+    wth_dir = str(tmp_path / 'wth')
+    os.mkdir(wth_dir)
+    wth_file = wth_dir + '/1.WTH'
+    with open(wth_file, 'w') as f:
+        f.write(HEADER + year_rows(datetime(2020, 12, 1), 27, 0.5) + year_rows(datetime(2020, 12, 28), 9, 9.9))
+    con = open_index(wth_dir)
+    record(con, wth_dir, ['1.WTH'], 2020362)
+    e = lookup(con, wth_dir, ['1.WTH'])['1.WTH']
+    assert (e['corr_last'], e['prelim_first'], e['prelim_last']) == (2020362, 2020363, 2021005)
+
+    #Corrected data up to 2021-01-03 in the store.
+    store = str(tmp_path / 'prec')
+    precstore.create(store, [1])
+    dates = [(datetime(2020, 12, 20) + timedelta(days=k)).strftime('%Y%j') for k in range(15)]
+    precstore.append(store, dates, numpy.arange(15, dtype=numpy.float32).reshape(15, 1) + 0.25)
+    assert repatch_prelim(wth_dir, {'1.WTH': e}, store, datetime(2021, 1, 3)) == ['1.WTH']
+    rain = rain_of(wth_file)
+    assert [rain[d] for d in (2020362, 2020363, 2020366, 2021001, 2021003, 2021004, 2021005)] == \
+        ['0.5', '8.2', '11.2', '12.2', '14.2', '9.9', '9.9']
+
+    #Only the days after the corrected data stay preliminary.
+    clear_prelim(con, wth_dir, ['1.WTH'], 2021003)
+    e = lookup(con, wth_dir, ['1.WTH'])['1.WTH']
+    assert (e['corr_last'], e['prelim_first'], e['prelim_last']) == (2021003, 2021004, 2021005)
+    assert e['last_date'] == scan_wth(wth_file)['last_date'] and e['rows'] == scan_wth(wth_file)['rows']
+    con.close()
+
+#A value wider than the 6 characters of RAIN is left as it is, the others are written.
+def test_patch_rain_too_wide(tmp_path):
+    wth_file = str(tmp_path / '1.WTH')
+    with open(wth_file, 'w') as f:
+        f.write(HEADER + rows(1, 5))
+    assert patch_rain(wth_file, {2020003: 1234567.5, 2020004: 1234.5}) == 1
+    rain = rain_of(wth_file)
+    assert (rain[2020003], rain[2020004], rain[2020005]) == ('1.5', '1234.5', '1.5')
+
+#Rows ending in CRLF are patched without moving the line ends.
+def test_patch_rain_crlf(tmp_path):
+    wth_file = str(tmp_path / '1.WTH')
+    text = (HEADER + rows(1, 5)).replace('\n', '\r\n')
+    with open(wth_file, 'w', newline='') as f:
+        f.write(text)
+    assert patch_rain(wth_file, {2020004: 22.5, 2020005: 3.0}) == 2
+    with open(wth_file, 'r', newline='') as f:
+        new = f.read()
+    assert len(new) == len(text) and new.count('\r\n') == text.count('\r\n')
+    rain = rain_of(wth_file)
+    assert (rain[2020003], rain[2020004], rain[2020005]) == ('1.5', '22.5', '3.0')
+
+#A file with no records is not indexed, so update finds it by its tail and leaves it out.
+def test_record_without_records(tmp_path):
+    wth_dir = str(tmp_path)
+    for name, text in [('1.WTH', HEADER + rows(1, 10)), ('2.WTH', HEADER)]:
+        with open(wth_dir + '/' + name, 'w') as f:
+            f.write(text)
+    con = open_index(wth_dir)
+    record(con, wth_dir, ['1.WTH', '2.WTH'], 2020010)
+    assert list(lookup(con, wth_dir, ['1.WTH', '2.WTH'])) == ['1.WTH']
+
+    #A file emptied after it was indexed is left out as well.
+    with open(wth_dir + '/1.WTH', 'w') as f:
+        f.write(HEADER)
+    assert lookup(con, wth_dir, ['1.WTH']) == {}
+    con.close()
@@ -6,123 +6,350 @@
 #Contact email: ocastilloromero@ufl.edu
 #######################################
 
-import os, sys
-import argparse
+import os
 import shutil
 import pandas as pd
-from datetime import datetime, date, timedelta
+import metrics
+from datetime import datetime, timedelta
 from chirps import *
-import joblib
+from precstore import last_date
+from wthindex import open_index, lookup, record, clear_prelim, indexed_names
+from checkpoint import start_run, is_done, mark_done, done_items, add_done, resumed_since
+from precstore import open_prec, NODATA
 from getnasap import nasa, nasachirps
 
-#Select requested (.WTH) files from historical repository and copy them to a new folder.
-def sel_wthfiles(in_file, in_dir, outdir_hist):
+#Select requested (.WTH) files from historical repository. Returns the names of the files found.
+#The files are looked up in the index of the repository (wthindex.py), and only the ones not
+#indexed are looked for on disk, one by one, so the whole repository is never listed.
+def sel_wthfiles(in_file, in_dir, con):
     pt = pd.read_csv(in_file)
     Id = pt.loc[:, "ID"]
     sel_files = [str(x) + ".WTH" for x in Id.to_list()] #Convert the array into a list of string elements.
-    all_files = [file for file in os.listdir(in_dir)] #To get the filenames (without extension) from the "in_dir" folder
+    indexed = indexed_names(con, sel_files)
 
-    # Create target Directory if it doesn't exist
-    if not os.path.exists(outdir_hist):
-        os.mkdir(outdir_hist)
-
-    ##Look for filenames in a list and then copy them to a different folder.
+    ##Look for filenames in the index or the folder.
+    found = []
     for index, wth_file in enumerate(sel_files):
-        if wth_file in all_files:
-            shutil.copy2(in_dir + "/" + wth_file, outdir_hist + "/" + wth_file) #To copy the corresponding file into the local directory.
+        if wth_file in indexed or os.path.exists(in_dir + "/" + wth_file):
+            found.append(wth_file)
         else:
             print(wth_file, " NO FOUND")
+    return found
+
+#Date ('%Y%j') of the last record of a WTH file, reading only the end of the file. None if the
+#file has no records (only its header).
+def tail_date(wth_file, block=1024):
+    with open(wth_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        n = min(size, block)
+        while True:
+            f.seek(size - n)
+            lines = [line for line in f.read(n).splitlines() if line.strip()]
+            if len(lines) > 1 or n == size:
+                break
+            n = min(size, n * 2)
+    if not lines or not lines[-1].split()[0].isdigit():
+        return None
+    return lines[-1].split()[0].decode()
+
+#Undoes an append to a WTH file that was interrupted, using its journal (original size).
+def recover_wth(wth_file):
+    if os.path.exists(wth_file + ".journal"):
+        with open(wth_file + ".journal", "r") as j:
+            size = int(j.read())
+        with open(wth_file, "r+b") as f:
+            f.truncate(size)
+        os.remove(wth_file + ".journal")
+
+#Appends the rows of an update WTH file that are after the last date of a historical file.
+#In place (hist_file == out_file) the original size is kept in a journal until the rows are
+#on disk, so an interrupted append is undone by recover_wth. Otherwise the historical file is
+#copied to a temporary file, appended and renamed to out_file. An interrupted append is undone
+#before the last date is read, as the rows it left are not in the file anymore after it.
+def append_wth(hist_file, new_file, out_file):
+    recover_wth(hist_file)
+    with open(new_file, "r") as wth2:
+        data2 = [line for line in wth2.readlines() if line.strip()][4:]
+    last_day = tail_date(hist_file)
+    if last_day is not None:
+        data2 = [line for line in data2 if int(line.split()[0]) > int(last_day)]  # Only the new dates
+
+    if os.path.exists(out_file) and os.path.samefile(hist_file, out_file):
+        with open(out_file + ".journal", "w") as j:
+            j.write(str(os.path.getsize(out_file)))
+            j.flush()
+            os.fsync(j.fileno())
+        with open(out_file, "a") as wth1:
+            wth1.writelines(data2)
+            wth1.flush()
+            os.fsync(wth1.fileno())
+        os.remove(out_file + ".journal")
+    else:
+        shutil.copyfile(hist_file, out_file + ".tmp")
+        with open(out_file + ".tmp", "a") as wth1:
+            wth1.writelines(data2)
+        os.replace(out_file + ".tmp", out_file)
+    return len(data2)
 
-#Merge data
-def mergeWTH(in_dir1, in_dir2, out_dir):
+#Merge data. The new rows of the files in in_dir2 are appended to the historical files of
+#in_dir1 (only `files` if given); out_dir may be in_dir1 to update the archive in place.
+def mergeWTH(in_dir1, in_dir2, out_dir, files=None):
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
-    wth_dir2 = os.listdir(in_dir2)
+    wth_dir2 = set(os.listdir(in_dir2))
+    if files is None:
+        files = os.listdir(in_dir1)
 
-    for wth_file1 in os.listdir(in_dir1):
+    for wth_file1 in files:
         if wth_file1.endswith(".WTH"):
             if wth_file1 in wth_dir2:
-                #To make a copy of the first file
-                shutil.copy(in_dir1 + "/" + wth_file1, out_dir + "/" + wth_file1)
-                #To open a second file
-                with open(in_dir2 + "/" + wth_file1, "r") as wth2:
-                    data2 = [line for line in wth2.readlines() if line.strip()][4:]
-
-                #To open the copied file and append the second file
-                with open(out_dir + "/" + wth_file1, "r+") as wth1:
-                    data1 = [line for line in wth1.readlines() if line.strip()]
-                    wth1.writelines(data2)
+                metrics.count('wth_rows_appended', append_wth(in_dir1 + "/" + wth_file1, in_dir2 + "/" + wth_file1,
+                                                              out_dir + "/" + wth_file1))
             else:
                 print("The file ", wth_file1, " will not be updated.")
 
-def update_wth(in_file, in_dir, out_dir):
+#Groups the points in cohorts of files ending on the same date, as each cohort needs its own
+#update window. entries has the last date of every file (by name). Writes a CSV file of the
+#points of every cohort (and update_pt.csv with all the points to update, plus the points of
+#the files in patch) in tempdir. Returns the start date and CSV file of the cohorts with days
+#to update up to dt_e. Files with no records have no last date to update from and are left out.
+def cohorts(in_file, entries, dt_e, tempdir, patch=()):
+    for wth_file, e in entries.items():
+        if e['last_date'] is None:
+            print(wth_file, 'has no records, it will not be updated.')
+    last_days = {wth_file[:-4]: str(e['last_date']) for wth_file, e in entries.items() if e['last_date'] is not None}
+    pt = pd.read_csv(in_file)
+    last = pt['ID'].astype(str).map(last_days)
+    pt = pt[last.notna()]
+    last = last[last.notna()]
+
+    groups = []
+    update = []
+    for last_day, index in last.groupby(last).groups.items():
+        dt_s = datetime.strptime(last_day, '%Y%j') + timedelta(days=1) #Add one day to the latest date.
+        if dt_s > dt_e:
+            continue
+        cohort_file = tempdir + '/cohort_' + last_day + '.csv'
+        pt.loc[index].to_csv(cohort_file, index=False)
+        groups.append((dt_s, cohort_file))
+        update.append(pt.loc[index])
+        print(len(index), 'point(s) to update from', dt_s.strftime('%Y-%m-%d'))
+
+    print(len(pt) - sum(len(u) for u in update), 'point(s) already up to date.')
+    update.append(pt[pt['ID'].astype(str).isin([wth_file[:-4] for wth_file in patch])])
+    pd.concat(update).drop_duplicates(subset=['ID']).to_csv(tempdir + '/update_pt.csv', index=False)
+    return groups
+
+#Rewrites in place the RAIN of some dates of a WTH file. RAIN is the last column, 6 characters
+#wide, so only those characters of the rows are written. values has the new RAIN by date
+#('%Y%j' integer). The rows are looked for from the end of the file, where the preliminary
+#days are. Returns the number of rows changed.
+def patch_rain(wth_file, values):
+    if not values:
+        return 0
+    first = min(values)
+    with open(wth_file, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        n = min(size, (len(values) + 2) * 80)
+        while True:
+            f.seek(size - n)
+            lines = f.read(n).split(b"\n")
+            offset = size - n
+            if n < size:  # The first line is not complete.
+                offset += len(lines[0]) + 1
+                lines = lines[1:]
+            dates = [line.split()[0] for line in lines if line.strip()]
+            if n == size or (dates and dates[0].isdigit() and int(dates[0]) < first):
+                break
+            n = min(size, n * 2)
+
+        changed = 0
+        for line in lines:
+            row = line.rstrip(b"\r").split()
+            end = offset + len(line.rstrip(b"\r"))
+            offset += len(line) + 1
+            if not row or not row[0].isdigit() or int(row[0]) not in values:
+                continue
+            new = '{:>6}'.format(values[int(row[0])]).encode()
+            old = line.rstrip(b"\r")[-7:]
+            if len(new) == 6 and len(old) == 7 and old[:1] == b" " and old[1:] != new:
+                f.seek(end - 6)
+                f.write(new)
+                changed += 1
+    return changed
+
+#Replaces the preliminary CHIRPS rainfall of the WTH files in wth_dir with the corrected one of
+#the store, for their preliminary days up to corr_last (datetime). entries has the index entry
+#of the files (by name). Returns the names of the files patched.
+def repatch_prelim(wth_dir, entries, prec_store, corr_last):
+    ids, start, prec = open_prec(prec_store)
+    if start is None or corr_last is None:
+        return []
+    ids_ch = {str(id): i for i, id in enumerate(ids)}
+    patched = []
+    n_rows = 0
+    for wth_file, e in entries.items():
+        if e['prelim_first'] is None or wth_file[:-4] not in ids_ch or not os.path.exists(wth_dir + "/" + wth_file):
+            continue
+        dt_s = max(datetime.strptime(str(e['prelim_first']), '%Y%j'), start)
+        dt_e = min(datetime.strptime(str(e['prelim_last']), '%Y%j'), corr_last)
+        values = {}
+        for n in range(max(0, (dt_s - start).days), (dt_e - start).days + 1):
+            val = prec[n, ids_ch[wth_file[:-4]]]
+            if val != NODATA:
+                values[int((start + timedelta(days=n)).strftime('%Y%j'))] = round(float(val), 1)
+        n_rows += patch_rain(wth_dir + "/" + wth_file, values)
+        patched.append(wth_file)
+    metrics.count('wth_rows_patched', n_rows)
+    print(n_rows, 'preliminary CHIRPS value(s) replaced with corrected ones in', len(patched), 'file(s).')
+    return patched
+
+def update_wth(in_file, in_dir, out_dir, subset_margin=None, workers=None, resume=False):
     s1 = datetime.now()
+    #Metrics of every stage, in metrics.jsonl next to in_file (metrics.py).
+    metrics.start(os.path.dirname(os.path.abspath(in_file)) + '/metrics.jsonl', 'update')
+    metrics.stage('plan')
 
     os.chdir(in_dir)
     tempdir = os.path.dirname(in_file) + '/temp'
-    if os.path.exists(tempdir):
-        shutil.rmtree(tempdir)
-        os.mkdir(tempdir)
-    else:
-        os.mkdir(tempdir)
+    #Checkpoints of the run (checkpoint.py); a resumed run skips the steps already done.
+    state = start_run(tempdir, {'command': 'update', 'in_file': os.path.abspath(in_file),
+                                'in_dir': os.path.abspath(in_dir), 'out_dir': os.path.abspath(out_dir),
+                                'subset_margin': subset_margin}, resume)
+
+    if not is_done(state, 'plan'):
+        #Select files from historical dataset
+        print('Selecting WTH files from repository...')
+        con = open_index(in_dir)
+        sel_files = sel_wthfiles(in_file, in_dir, con)
+
+        #Appends interrupted by a previous run are undone first, so the last dates are the ones
+        #of the complete rows.
+        for wth_file in sel_files:
+            recover_wth(in_dir + "/" + wth_file)
+
+        #Last date and sources of the files from the index of the repository (wthindex.py), or from
+        #the file tail for the files not indexed yet.
+        old = lookup(con, in_dir, sel_files)
+        con.close()
+        for wth_file in sel_files:
+            if wth_file not in old and os.path.exists(in_dir + "/" + wth_file):  # Indexed files may be gone.
+                last_day = tail_date(in_dir + "/" + wth_file)
+                old[wth_file] = {'last_date': None if last_day is None else int(last_day), 'corr_last': None,
+                                 'prelim_first': None, 'prelim_last': None}
+
+        dt_e = datetime.today() - timedelta(days=4) #Four days before today because of SRAD latency.
 
-    outdir_hist = tempdir + '/historical'
-    #Select files from historical dataset
-    print('Selecting WTH files from repository...')
-    sel_wthfiles(in_file, in_dir, outdir_hist)
+        #Points grouped by the last date of their files.
+        groups = cohorts(in_file, old, dt_e, tempdir, [f for f, e in old.items() if e['prelim_first'] is not None])
 
-    #get one file from the folder and get the latest date available.
-    with open(os.listdir(outdir_hist)[1], "r") as f1:  # Reading wth files
-        data = [line.split() for line in f1.readlines() if line.strip()]
+        #The plan is kept, as a resumed run sees some files already updated.
+        mark_done(state, 'plan', {'old': old, 'end': dt_e.strftime('%Y%m%d'),
+                                  'groups': [(dt_st.strftime('%Y%m%d'), cohort_file) for dt_st, cohort_file in groups]})
 
-    last_date = data[-1][0] #Get the latest date in file.
-    dt_s = datetime.strptime(last_date, '%Y%j') + timedelta(days=1) #Add one day to the latest date.
-    dt_st = dt_s.strftime('%Y%m%d') #The start date for the update.
+    plan = state['done']['plan']
+    old = plan['old']
+    dt_e = datetime.strptime(plan['end'], '%Y%m%d')
+    dt_ed = plan['end'] #The end date in format for the update.
+    groups = [(datetime.strptime(dt_st, '%Y%m%d'), cohort_file) for dt_st, cohort_file in plan['groups']]
 
-    dt_e = datetime.today() - timedelta(days=4) #Four days before today because of SRAD latency.
-    dt_ed = dt_e.strftime('%Y%m%d') #The end date in format for the update.
+    #Files with preliminary CHIRPS days, to patch with the corrected data published since.
+    prelim = {wth_file: e for wth_file, e in old.items() if e['prelim_first'] is not None}
+    if not groups and not prelim:
+        print('All the WTH files are up to date.')
+        metrics.finish()
+        return
+    #The CHIRPS data are extracted from the earliest start or preliminary day.
+    dt_s = min([g[0] for g in groups] + [datetime.strptime(str(e['prelim_first']), '%Y%j') for e in prelim.values()])
+    in_file = tempdir + '/update_pt.csv' #Only the points to update from here on.
+
+    #Bounding box to crop the CHIRPS files to, if requested.
+    bbox = None if subset_margin is None else pt_bbox(in_file, subset_margin)
 
     #Getting corrected data
+    #The files downloaded are kept in the checkpoints, so a resumed run only tries the failed ones again.
     out_cor_nc = tempdir + '/in_nc_cor'
     print('Getting corrected data from CHIRPS server...')
-    get_correc_nc(dt_s, dt_e, out_cor_nc)
+    metrics.stage('corrected_nc')
+    if not is_done(state, 'corrected_nc'):
+        os.makedirs(out_cor_nc, exist_ok=True)  # No corrected month of the window may be out yet.
+        get_nc(correc_jobs(dt_s, dt_e, out_cor_nc), bbox, done_items(state, 'corrected_nc_files'),
+               lambda name: add_done(state, 'corrected_nc_files', name))
+        mark_done(state, 'corrected_nc')
 
     #Run chirps for corrected data
-    outdir_prec = tempdir + '/prec_pkl'
+    outdir_prec = tempdir + '/prec'
     print('Processing CHIRPS data...')
-    chirps2(in_file, out_cor_nc, outdir_prec + '/prec_corr.pkl')
-
-    #Getting the latest day available in prec corrected data.
-    df = joblib.load(outdir_prec + '/prec_corr.pkl')
-    lastday_corr = df.columns[-1]
-    dt_s_p = datetime.strptime(lastday_corr, '%Y%j') + timedelta(days=1)
-
-    #Getting preliminary data
-    out_pre_nc = tempdir + '/in_nc_pre'
-    print('Getting preliminary data from CHIRPS server...')
-    get_prelim_nc(dt_s_p, dt_e, out_pre_nc)
-    print('CHIRPS netCDF files in disk.')
+    metrics.stage('corrected')
+    if not is_done(state, 'corrected'):
+        chirps_auto(in_file, out_cor_nc, outdir_prec, done_items(state, 'corrected_files'),
+                    lambda nc_file: add_done(state, 'corrected_files', nc_file))
+        lastday_corr = last_date(outdir_prec)
+        mark_done(state, 'corrected', None if lastday_corr is None else lastday_corr.strftime('%Y%j'))
 
-    #Run chirps for preliminary data
-    chirps2(in_file, out_pre_nc, outdir_prec + '/prec_prelim.pkl')
+    #Getting the latest day available in prec corrected data (kept in the checkpoints, as the
+    #store may have preliminary days of a previous run too).
+    lastday_corr = state['done']['corrected']
+    lastday_corr = None if lastday_corr is None else datetime.strptime(lastday_corr, '%Y%j')
+    dt_s_p = dt_s if lastday_corr is None else lastday_corr + timedelta(days=1)
 
-    #Merging corrected and preliminary precipitation data.
-    precpkl(outdir_prec)
-    print('CHIRPS processing data are complete.')
+    if groups:
+        #Getting preliminary data
+        out_pre_nc = tempdir + '/in_nc_pre'
+        print('Getting preliminary data from CHIRPS server...')
+        metrics.stage('prelim_nc')
+        if not is_done(state, 'prelim_nc'):
+            os.makedirs(out_pre_nc, exist_ok=True)
+            get_nc(prelim_jobs(dt_s_p, dt_e, out_pre_nc), bbox, done_items(state, 'prelim_nc_files'),
+                   lambda name: add_done(state, 'prelim_nc_files', name))
+            mark_done(state, 'prelim_nc')
+        print('CHIRPS netCDF files in disk.')
 
-    # Getting NASA POWER data for the update period
-    nasa_outdir = tempdir + '/nasap'
-    print('Getting NASA POWER data...')
-    nasa(in_file, dt_st, dt_ed, nasa_outdir)
+        #Run chirps for preliminary data. Only the days after the corrected data are appended.
+        metrics.stage('prelim')
+        chirps_auto(in_file, out_pre_nc, outdir_prec, done_items(state, 'prelim_files'),
+                    lambda nc_file: add_done(state, 'prelim_files', nc_file))
+        print('CHIRPS processing data are complete.')
 
-    #Fusing NASA POWER and CHIRPS with QC on SRAD.
+    #Getting NASA POWER data and fusing it with CHIRPS (QC on SRAD), cohort by cohort.
     update_dir = tempdir + '/update'
-    print('Building the WTH files...')
-    nasachirps(in_file, nasa_outdir, outdir_prec + '/prec.pkl', update_dir)
+    for dt_st, cohort_file in groups:
+        nasa_outdir = cohort_file[:-4] + '_nasap'
+        metrics.stage('nasa')
+        if not is_done(state, 'nasa_' + os.path.basename(cohort_file)):
+            print('Getting NASA POWER data from', dt_st.strftime('%Y-%m-%d'), 'for', os.path.basename(cohort_file), '...')
+            nasa(cohort_file, dt_st.strftime('%Y%m%d'), dt_ed, nasa_outdir, os.path.dirname(tempdir) + "/failed_pt.json")
+            mark_done(state, 'nasa_' + os.path.basename(cohort_file))
+        print('Building the WTH files...')
+        metrics.stage('nasachirps')
+        nasachirps(cohort_file, nasa_outdir, outdir_prec, update_dir, workers, resumed_since(state))
 
     #Merging historical with latest data.
-    mergeWTH(outdir_hist, update_dir, out_dir)
+    update_files = [str(x) + ".WTH" for dt_st, cohort_file in groups for x in pd.read_csv(cohort_file)['ID']]
+    metrics.stage('merge')
+    mergeWTH(in_dir, update_dir, out_dir, update_files)
+
+    #Files only to patch are copied to a new output directory first.
+    for wth_file in prelim:
+        if wth_file not in update_files and not os.path.exists(out_dir + "/" + wth_file):
+            shutil.copy2(in_dir + "/" + wth_file, out_dir + "/" + wth_file)
+
+    #Index of the updated files, with the dates of corrected and preliminary CHIRPS.
+    corr_last = None if lastday_corr is None else int(lastday_corr.strftime('%Y%j'))
+    metrics.stage('index')
+    con = open_index(out_dir)
+    record(con, out_dir, list(dict.fromkeys(update_files + list(prelim))), corr_last, old, update_dir)
+
+    #Replacing the preliminary CHIRPS days that are corrected now.
+    metrics.stage('repatch')
+    entries = lookup(con, out_dir, prelim)
+    patched = repatch_prelim(out_dir, entries, outdir_prec, lastday_corr)
+    clear_prelim(con, out_dir, patched, corr_last)
+    con.close()
 
+    metrics.finish()
     e1 = datetime.now()
     print("Time of execution for the update is: ", str(e1-s1))
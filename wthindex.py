@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#######################################
+#Script developed by Oscar Castillo
+#University of Florida
+#2022
+#Contact email: ocastilloromero@ufl.edu
+#######################################
+
+import os
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta
+
+#Index of a directory of WTH files (wth_index.sqlite in the directory), kept by get and update.
+#Every file has its first and last date, number of rows, checksum and where its rain came from:
+#corr_last is the last date built with corrected CHIRPS, and prelim_first to prelim_last the
+#dates that may still hold preliminary CHIRPS values. Size and mtime tell if a file was changed
+#outside of the index, so looking a file up only needs a stat instead of reading it. Files
+#appended to or patched by update are not read again: their entries are updated from the new
+#rows and a stat, and their checksum is left empty until the file is scanned again. Files with
+#no records (only a header) are not indexed, as they have no dates to update from.
+INDEX_FILE = 'wth_index.sqlite'
+HEADER_LINES = 4  # Non empty lines before the first record of a WTH file.
+
+def open_index(wth_dir):
+    con = sqlite3.connect(wth_dir + '/' + INDEX_FILE)
+    con.row_factory = sqlite3.Row
+    con.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, first_date INTEGER, last_date INTEGER, '
+                'rows INTEGER, sha256 TEXT, size INTEGER, mtime REAL, corr_last INTEGER, prelim_first INTEGER, '
+                'prelim_last INTEGER, updated TEXT)')
+    con.commit()
+    return con
+
+#Day after a '%Y%j' date (as integer).
+def next_day(day):
+    return int((datetime.strptime(str(day), '%Y%j') + timedelta(days=1)).strftime('%Y%j'))
+
+#Reads a WTH file and returns its first and last date, number of rows, checksum, size and mtime.
+def scan_wth(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    dates = [int(line.split()[0]) for line in [line for line in data.splitlines() if line.strip()][HEADER_LINES:]]
+    st = os.stat(path)
+    return {'first_date': dates[0] if dates else None, 'last_date': dates[-1] if dates else None,
+            'rows': len(dates), 'sha256': hashlib.sha256(data).hexdigest(), 'size': st.st_size, 'mtime': st.st_mtime}
+
+#Names of the index among names, looked up in batches.
+def indexed_names(con, names, batch=500):
+    found = set()
+    for i in range(0, len(names), batch):
+        part = names[i:i + batch]
+        found.update(row[0] for row in con.execute('SELECT name FROM files WHERE name IN (' +
+                                                   ','.join('?' * len(part)) + ')', part))
+    return found
+
+#Entries of the files of wth_dir given by name. Entries of files changed since they were
+#indexed are scanned again (their sources are kept). Files not in the index, or left with no
+#records, are left out.
+def lookup(con, wth_dir, names):
+    entries = {}
+    for name in names:
+        row = con.execute('SELECT * FROM files WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            continue
+        entry = dict(row)
+        path = wth_dir + '/' + name
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_size != entry['size'] or st.st_mtime != entry['mtime']:
+            entry.update(scan_wth(path))
+            if entry['last_date'] is None:
+                con.execute('DELETE FROM files WHERE name = ?', (name,))
+                continue
+            save_entry(con, entry)
+        entries[name] = entry
+    con.commit()
+    return entries
+
+def save_entry(con, entry):
+    entry['updated'] = datetime.now().isoformat()
+    con.execute('INSERT OR REPLACE INTO files VALUES (:name, :first_date, :last_date, :rows, :sha256, :size, :mtime, '
+                ':corr_last, :prelim_first, :prelim_last, :updated)', entry)
+
+#Dates of the records of the WTH file path after the day after ('%Y%j' integer).
+def new_dates(path, after):
+    with open(path, 'r') as f:
+        dates = [int(line.split()[0]) for line in [line for line in f if line.strip()][HEADER_LINES:]]
+    return [d for d in dates if d > after]
+
+#Entry of a file appended to from its previous entry, the new rows in the update file new_file
+#(if any) and a stat, without reading the file itself.
+def appended_entry(path, prev, new_file=None):
+    dates = new_dates(new_file, prev['last_date']) if new_file is not None and os.path.exists(new_file) else []
+    st = os.stat(path)
+    return {'first_date': prev['first_date'] if prev['first_date'] is not None else (dates[0] if dates else None),
+            'last_date': dates[-1] if dates else prev['last_date'], 'rows': prev['rows'] + len(dates),
+            'sha256': None, 'size': st.st_size, 'mtime': st.st_mtime}
+
+#Indexes the files just written in wth_dir. corr_last is the last date of corrected CHIRPS in
+#the run ('%Y%j' integer, None if there was none); the days after it came from preliminary
+#CHIRPS. old has the previous entries of the files that were appended to (by name): only their
+#days after the previous last date are new, the rest keep their sources. With new_dir (the
+#update files appended), the files with an indexed previous entry are not read: their new rows
+#are the ones of the update file after the previous last date.
+def record(con, wth_dir, names, corr_last, old=None, new_dir=None):
+    old = old or {}
+    corr_last = corr_last or 0
+    for name in names:
+        if not os.path.exists(wth_dir + '/' + name):
+            continue
+        prev = old.get(name)
+        if new_dir is not None and prev is not None and prev.get('rows') is not None and prev['last_date'] is not None:
+            entry = appended_entry(wth_dir + '/' + name, prev, new_dir + '/' + name)
+        else:
+            entry = scan_wth(wth_dir + '/' + name)
+        entry['name'] = name
+        if entry['last_date'] is None:
+            print(name, 'has no records, it is not indexed.')
+            con.execute('DELETE FROM files WHERE name = ?', (name,))
+            continue
+
+        from_day = entry['first_date'] if prev is None or prev['last_date'] is None else next_day(prev['last_date'])
+        p_first = prev['prelim_first'] if prev is not None else None
+        p_last = prev['prelim_last'] if prev is not None else None
+        if entry['last_date'] > corr_last and entry['last_date'] >= from_day:
+            p_first = min(p_first or entry['last_date'], max(from_day, next_day(corr_last) if corr_last else 0))
+            p_last = entry['last_date']
+        c_last = min(corr_last, entry['last_date']) if corr_last >= from_day else None
+        if prev is not None and prev['corr_last'] is not None:
+            c_last = max(c_last or 0, prev['corr_last'])
+        entry.update({'corr_last': c_last, 'prelim_first': p_first, 'prelim_last': p_last})
+        save_entry(con, entry)
+    con.commit()
+
+#Sets the sources of files whose preliminary CHIRPS days up to corr_last ('%Y%j' integer) were
+#replaced with corrected CHIRPS.
+def clear_prelim(con, wth_dir, names, corr_last):
+    for name in names:
+        row = con.execute('SELECT * FROM files WHERE name = ?', (name,)).fetchone()
+        if row is None or corr_last is None:
+            continue
+        entry = dict(row)
+        st = os.stat(wth_dir + '/' + name)  # Only RAIN characters were rewritten: same rows and dates.
+        entry.update({'sha256': None, 'size': st.st_size, 'mtime': st.st_mtime})
+        if entry['prelim_first'] is not None:
+            if entry['prelim_last'] <= corr_last:
+                entry['prelim_first'] = entry['prelim_last'] = None
+            else:
+                entry['prelim_first'] = max(entry['prelim_first'], next_day(corr_last))
+        entry['corr_last'] = max(entry['corr_last'] or 0, min(corr_last, entry['last_date']))
+        save_entry(con, entry)
+    con.commit()
+
+#Files whose last date is before day ('%Y%j' integer), and files with preliminary CHIRPS days.
+def stale(con, day):
+    return [row[0] for row in con.execute('SELECT name FROM files WHERE last_date < ? ORDER BY name', (day,))]
+
+def with_prelim(con):
+    return [row[0] for row in con.execute('SELECT name FROM files WHERE prelim_first IS NOT NULL ORDER BY name')]
+
+#Prints a summary of the index of wth_dir, and the files not updated up to before (YYYYMMDD).
+def status(wth_dir, before=None):
+    con = open_index(wth_dir)
+    n, first, last_min, last_max = con.execute('SELECT COUNT(*), MIN(first_date), MIN(last_date), MAX(last_date) '
+                                               'FROM files').fetchone()
+    print(n, 'WTH file(s) indexed in', wth_dir)
+    if n:
+        print('First date:', first, '| last dates from', last_min, 'to', last_max)
+        for row in con.execute('SELECT last_date, COUNT(*) FROM files GROUP BY last_date ORDER BY last_date'):
+            print('  ending on', row[0], ':', row[1], 'file(s)')
+        print(len(with_prelim(con)), 'file(s) with preliminary CHIRPS days.')
+    if before is not None:
+        names = stale(con, int(datetime.strptime(str(before), '%Y%m%d').strftime('%Y%j')))
+        print(len(names), 'file(s) ending before', before, ':', ' '.join(names))
+    con.close()